@@ -0,0 +1,389 @@
+# Copyright 2022 Curtin University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import csv
+import math
+import multiprocessing
+import os
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import click
+
+from ingest import get_field, read_records
+from predict_language import list_files, read_csv_gz
+
+ISO_LANGUAGE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "iso_language.csv")
+
+# The folder of the output folder that the summary and the cube are written to, which is not read as output files
+ANALYSIS_FOLDER = "analysis"
+
+# The extensions of the output files of predict-language
+OUTPUT_EXTENSIONS = (".csv.gz", ".csv.zst", ".parquet", ".arrow")
+
+# The columns of the summary, as selected by analysis.sql
+SUMMARY_COLUMNS = ["name", "language", "count", "percent", "avg_score", "std_score"]
+
+# The name and language of the outputs without a title or abstract, which have no language, as in analysis.sql
+NO_LANGUAGE = "null"
+UNKNOWN_NAME = "Unknown: no title or abstract"
+
+# The paths of the publication year and crossref type in the dump files, as in the doi table read by graph_data.sql
+DEFAULT_METADATA_FIELDS = {"doi": "doi", "published_year": "crossref.published_year", "crossref_type": "crossref.type"}
+
+# The metadata of each DOI, which is set before the worker processes are forked, so that they share one copy
+_metadata = {}
+
+
+class RunningStats:
+    """The count, mean and variance of a stream of values, updated one value at a time with Welford's algorithm and
+    merged with the statistics of other streams, so that they are computed in a single pass over each shard."""
+
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def add(self, value: float):
+        """Add a value.
+
+        :param value: the value.
+        :return: None.
+        """
+
+        self.n += 1
+        delta = value - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (value - self.mean)
+
+    def merge(self, other: "RunningStats"):
+        """Merge the statistics of another stream into these statistics.
+
+        :param other: the statistics of the other stream.
+        :return: None.
+        """
+
+        n = self.n + other.n
+        if n == 0:
+            return
+        delta = other.mean - self.mean
+        self.m2 += other.m2 + delta * delta * self.n * other.n / n
+        self.mean += delta * other.n / n
+        self.n = n
+
+    def get_mean(self) -> Optional[float]:
+        """The mean, or None when there are no values, like AVG in BigQuery."""
+
+        return self.mean if self.n > 0 else None
+
+    def get_std(self) -> Optional[float]:
+        """The sample standard deviation, or None when there are less than two values, like STDDEV in BigQuery."""
+
+        return math.sqrt(self.m2 / (self.n - 1)) if self.n > 1 else None
+
+
+class ShardSummary:
+    """The statistics of the outputs of one or more shards: the number of outputs and the scores of each language, and
+    the number of DOIs and the scores of each year, crossref type and language."""
+
+    def __init__(self):
+        self.counts = {}
+        self.scores = {}
+        self.cube = {}
+
+    def add(
+        self, language: Optional[str], score: Optional[float], metadata: Optional[Tuple] = None, new_doi: bool = True
+    ):
+        """Add an output.
+
+        :param language: the language, or None when there was no title or abstract.
+        :param score: the score of the language.
+        :param metadata: the publication year and crossref type of the DOI, when they are known.
+        :param new_doi: whether the DOI is counted in the cube, or was already counted for the language.
+        :return: None.
+        """
+
+        self.counts[language] = self.counts.get(language, 0) + 1
+        if score is not None:
+            self.scores.setdefault(language, RunningStats()).add(score)
+        if metadata is not None and language is not None:
+            key = (*metadata, language)
+            cell = self.cube.get(key)
+            if cell is None:
+                cell = self.cube[key] = [0, RunningStats()]
+            if new_doi:
+                cell[0] += 1
+            if score is not None:
+                cell[1].add(score)
+
+    def merge(self, other: "ShardSummary"):
+        """Merge the statistics of other shards into this summary.
+
+        :param other: the summary of the other shards.
+        :return: None.
+        """
+
+        for language, count in other.counts.items():
+            self.counts[language] = self.counts.get(language, 0) + count
+        for language, stats in other.scores.items():
+            self.scores.setdefault(language, RunningStats()).merge(stats)
+        for key, (total, stats) in other.cube.items():
+            cell = self.cube.get(key)
+            if cell is None:
+                cell = self.cube[key] = [0, RunningStats()]
+            cell[0] += total
+            cell[1].merge(stats)
+
+
+def load_iso_languages(path: str = ISO_LANGUAGE_PATH) -> Dict[str, str]:
+    """Load the names of the languages.
+
+    :param path: the path to iso_language.csv.
+    :return: the name of each language code.
+    """
+
+    names = {}
+    with open(path, encoding="utf-8", newline="") as f:
+        for row in csv.DictReader(f):
+            # analysis.sql takes the MAX of the names of each code
+            names[row["code"]] = max(names.get(row["code"], row["name"]), row["name"])
+    return names
+
+
+def read_output_rows(path: str, columns: List[str] = ("doi", "language", "score")) -> Iterable[Tuple]:
+    """Read columns of an output file of predict-language.
+
+    :param path: the path to a CSV, Parquet or Arrow IPC output file.
+    :param columns: the columns to read, see OUTPUT_COLUMNS.
+    :return: yield the values of the columns of each row, with None for missing values and the score as a float.
+    """
+
+    columns = list(columns)
+    if path.endswith(".parquet") or path.endswith(".arrow"):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        if path.endswith(".parquet"):
+            batches = pq.ParquetFile(path).iter_batches(columns=columns)
+        else:
+            reader = pa.ipc.open_file(path)
+            batches = (reader.get_batch(i).select(columns) for i in range(reader.num_record_batches))
+        for batch in batches:
+            yield from zip(*(batch.column(column).to_pylist() for column in columns))
+        return
+
+    rows = read_csv_gz(path, skip_header=False)
+    header = next(rows, None)
+    if header is None:
+        return
+    indexes = [header.index(column) for column in columns]
+    score = columns.index("score") if "score" in columns else None
+    for row in rows:
+        values = [row[i] or None for i in indexes]
+        if score is not None and values[score] is not None:
+            values[score] = float(values[score])
+        yield tuple(values)
+
+
+def summarise_shard(path: str) -> ShardSummary:
+    """Summarise the outputs of a shard.
+
+    The DOIs of each year, crossref type and language are counted once per shard, like the COUNT(DISTINCT doi) of
+    graph_data.sql, which is exact when the rows of each DOI are in the same output file, as they are when the input
+    archives are built with ingest.py and are not split with --max-unit-size.
+
+    :param path: the path to the output file.
+    :return: the summary.
+    """
+
+    summary = ShardSummary()
+    seen = set()
+    for doi, language, score in read_output_rows(path):
+        metadata = _metadata.get(doi)
+        new_doi = True
+        if metadata is not None:
+            # Only the DOIs are counted once, the scores of every row are averaged as in graph_data.sql
+            new_doi = (doi, language) not in seen
+            seen.add((doi, language))
+        summary.add(language, score, metadata, new_doi)
+    return summary
+
+
+def load_metadata(
+    paths: List[str], fields: Dict[str, str] = DEFAULT_METADATA_FIELDS, start_year: int = 2000, end_year: int = 2021
+) -> Dict[str, Tuple[int, str]]:
+    """Load the publication year and crossref type of each DOI from dump files, keeping the DOIs published between
+    start_year and end_year, as graph_data.sql does.
+
+    :param paths: the paths to the dump files, see ingest.read_records.
+    :param fields: the paths of the DOI, publication year and crossref type in the records.
+    :param start_year: the first publication year.
+    :param end_year: the last publication year.
+    :return: the publication year and crossref type of each upper case DOI.
+    """
+
+    metadata = {}
+    for path in paths:
+        for record in read_records(path):
+            doi, year = get_field(record, fields["doi"]), get_field(record, fields["published_year"])
+            if doi is None or year in (None, ""):
+                continue
+            year = int(year)
+            if start_year <= year <= end_year:
+                crossref_type = get_field(record, fields["crossref_type"]) or None
+                metadata[str(doi).strip().upper()] = (year, crossref_type)
+    return metadata
+
+
+def summary_rows(summary: ShardSummary, names: Dict[str, str]) -> List[List]:
+    """Make the rows of the analysis.sql summary.
+
+    :param summary: the summary of all of the shards.
+    :param names: the name of each language code.
+    :return: the name, language, count, percent, average score and standard deviation of the scores of each language,
+    most outputs first.
+    """
+
+    total = sum(summary.counts.values())
+    rows = []
+    for language, count in summary.counts.items():
+        stats = summary.scores.get(language, RunningStats())
+        rows.append(
+            [
+                names.get(language, UNKNOWN_NAME),
+                NO_LANGUAGE if language is None else language,
+                count,
+                100 * count / total,
+                stats.get_mean(),
+                stats.get_std(),
+            ]
+        )
+    rows.sort(key=lambda row: -row[2])
+    return rows
+
+
+def cube_table(summary: ShardSummary, names: Dict[str, str]):
+    """Make the year x crossref type x language cube that graphs.py reads, with the total and average score columns.
+
+    Languages without a name are left out, as graph_data.sql joins the languages to iso_language.
+
+    :param summary: the summary of all of the shards.
+    :param names: the name of each language code.
+    :return: a pandas DataFrame.
+    """
+
+    import pandas as pd
+
+    rows = []
+    for (year, crossref_type, code), (total, stats) in summary.cube.items():
+        if code in names:
+            mean = stats.get_mean()
+            rows.append(
+                [
+                    year,
+                    crossref_type,
+                    code,
+                    names[code],
+                    total,
+                    0.0 if mean is None else mean * total,
+                    0 if mean is None else total,
+                ]
+            )
+    cube = pd.DataFrame(
+        rows,
+        columns=["published_year", "crossref_type", "code", "name", "total", "avg_score_sum", "avg_score_weight"],
+    )
+    cube["published_year"] = cube.published_year.astype("int16")
+    for col in ["crossref_type", "code", "name"]:
+        cube[col] = cube[col].astype("category")
+    for col in ["total", "avg_score_weight"]:
+        cube[col] = cube[col].astype("int64")
+    return cube
+
+
+@click.command()
+@click.argument("output-path", type=click.Path(exists=True, file_okay=False, dir_okay=True))
+@click.option(
+    "--summary-path",
+    type=click.Path(file_okay=True, dir_okay=False),
+    default=None,
+    help="The CSV file to write the summary to, defaults to summary.csv in the analysis folder of the output folder",
+)
+@click.option(
+    "--metadata-path",
+    type=click.Path(exists=True, file_okay=False, dir_okay=True),
+    default=None,
+    help="A folder of dump files with the publication year and crossref type of each DOI, see ingest.py, to build the "
+    "year x crossref type x language cube from",
+)
+@click.option("--metadata-pattern", type=click.STRING, default="*.jsonl*", help="The file pattern of the dump files")
+@click.option(
+    "--cube-path",
+    type=click.Path(file_okay=True, dir_okay=False),
+    default=None,
+    help="The Parquet file to write the cube to, which graphs.py reads with --cube-path, defaults to cube.parquet in "
+    "the analysis folder of the output folder",
+)
+@click.option("--start-year", type=click.INT, default=2000, help="The first publication year of the cube")
+@click.option("--end-year", type=click.INT, default=2021, help="The last publication year of the cube")
+@click.option(
+    "--num-workers", type=click.INT, default=os.cpu_count(), help="The number of processes that read output files"
+)
+def main(
+    output_path: str,
+    summary_path: Optional[str],
+    metadata_path: Optional[str],
+    metadata_pattern: str,
+    cube_path: Optional[str],
+    start_year: int,
+    end_year: int,
+    num_workers: int,
+):
+    """Summarise the output files of predict-language like analysis.sql, and optionally build the cube of
+    graph_data.sql, without loading them into BigQuery."""
+
+    global _metadata
+
+    paths = sorted(path for path in list_files(output_path, "*") if path.endswith(OUTPUT_EXTENSIONS))
+    print(f"Found {len(paths)} output files in {output_path}")
+    start = time.time()
+    if metadata_path is not None:
+        _metadata = load_metadata(list_files(metadata_path, metadata_pattern), start_year=start_year, end_year=end_year)
+        print(f"Loaded the metadata of {len(_metadata)} DOIs in {time.time() - start:.2f}s")
+
+    summary = ShardSummary()
+    with multiprocessing.get_context("fork").Pool(num_workers) as pool:
+        for shard_summary in pool.imap_unordered(summarise_shard, paths):
+            summary.merge(shard_summary)
+
+    names = load_iso_languages()
+    analysis_path = os.path.join(output_path, ANALYSIS_FOLDER)
+    os.makedirs(analysis_path, exist_ok=True)
+    summary_path = summary_path or os.path.join(analysis_path, "summary.csv")
+    with open(summary_path, "w", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(SUMMARY_COLUMNS)
+        writer.writerows(summary_rows(summary, names))
+    print(f"Wrote the summary of {sum(summary.counts.values())} outputs to {summary_path}")
+
+    if metadata_path is not None:
+        cube_path = cube_path or os.path.join(analysis_path, "cube.parquet")
+        cube = cube_table(summary, names)
+        cube.to_parquet(cube_path, index=False)
+        print(f"Wrote the cube with {len(cube)} cells to {cube_path}")
+    print(f"Finished in {time.time() - start:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,599 @@
+# Copyright 2022 Curtin University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import collections
+import csv
+import gzip
+import itertools
+import json
+import multiprocessing
+import os
+import random
+import re
+import resource
+import tempfile
+import time
+import timeit
+from typing import Dict, List, Optional
+
+import click
+
+from compression import available_gzip_readers, open_input, open_output_file
+from engines import ENGINES, load_engine
+from predict_language import (
+    METRICS,
+    OUTPUT_FORMATS,
+    STAGES,
+    LanguagePredictor,
+    is_junk,
+    list_files,
+    memo_summary,
+    preprocess_row,
+    read_csv_gz,
+)
+from service import LATENCY_PERCENTILES, RECORD_FIELDS, percentile
+
+# A sample of stripped fields, in roughly the proportions seen in the Crossref and MAG titles
+JUNK_SAMPLE = [
+    "Exploring the Mysteries of Cannabis through Gas Chromatography",
+    "Convolution on L p-spaces of a locally compact group",
+    "Editorial",
+    "Front Matter",
+    "Cytologic diagnosis of vaginal stump fallopian tube prolapse after hysterectomy"
+    "&amp;mdash;A case report&amp;mdash;",
+    "Exploring the Mysteries of <i>Cannabis</i> through Gas Chromatography",
+    "Fruit yield of European cranberry (Oxycoccus palustris Pers.) in different plant communities of peatlands",
+    "10.13003/5jchdy",
+    "https://open.coki.ac",
+    "[NO TITLE AVAILABLE]",
+]
+
+
+# Words of each language that the synthetic titles and abstracts are made from
+SYNTHETIC_WORDS = {
+    "en": (
+        "the of and study analysis effect patients results method model learning health water new using between"
+    ).split(),
+    "fr": "le la les des étude analyse effet patients résultats méthode modèle santé eau nouvelle entre pour".split(),
+    "de": (
+        "der die das und Untersuchung Analyse Wirkung Patienten Ergebnisse Methode Modell Gesundheit Wasser neue"
+    ).split(),
+    "es": (
+        "el la los las estudio análisis efecto pacientes resultados método modelo salud agua nueva entre para"
+    ).split(),
+    "pt": "o a os das estudo análise efeito pacientes resultados método modelo saúde água nova entre para".split(),
+}
+
+# Titles that many works share, such as journal boilerplate
+BOILERPLATE_TITLES = ["Editorial", "Front Matter", "Index", "Book Review", "Contents", "Erratum"]
+
+
+def synthetic_sentence(rng: random.Random, language: str, length: int):
+    """Make a sentence from the words of a language.
+
+    :param rng: the random number generator.
+    :param language: the language code, one of SYNTHETIC_WORDS.
+    :param length: the number of words.
+    :return: the sentence.
+    """
+
+    return " ".join(rng.choices(SYNTHETIC_WORDS[language], k=length)).capitalize()
+
+
+def synthetic_row(rng: random.Random, i: int):
+    """Make a synthetic input row in the layout that process_archive reads.
+
+    The row has a mix of plain, HTML and JATS marked up titles and abstracts, DOIs and URLs as titles, the
+    [NO TITLE AVAILABLE] placeholder, boilerplate titles, identical MAG and Crossref titles and empty fields.
+
+    :param rng: the random number generator.
+    :param i: the row number.
+    :return: the doi, mag_title, crossref_title, mag_abstract and crossref_abstract.
+    """
+
+    doi = f"10.{rng.randint(1000, 99999)}/SYNTHETIC.{i}"
+    language = rng.choices(list(SYNTHETIC_WORDS), weights=[80, 6, 6, 5, 3])[0]
+
+    # Crossref title
+    r = rng.random()
+    if r < 0.05:
+        crossref_title = ""
+    elif r < 0.06:
+        crossref_title = doi
+    elif r < 0.07:
+        crossref_title = f"https://doi.org/{doi}"
+    elif r < 0.08:
+        crossref_title = "[NO TITLE AVAILABLE]"
+    elif r < 0.13:
+        crossref_title = rng.choice(BOILERPLATE_TITLES)
+    else:
+        words = synthetic_sentence(rng, language, rng.randint(4, 20)).split()
+        if rng.random() < 0.2:
+            j = rng.randrange(len(words))
+            words[j] = f"<i>{words[j]}</i>"
+        if rng.random() < 0.05:
+            words.insert(rng.randrange(len(words)), "&amp;")
+        crossref_title = " ".join(words)
+
+    # MAG title
+    r = rng.random()
+    if r < 0.4:
+        mag_title = ""
+    elif r < 0.8:
+        mag_title = crossref_title
+    else:
+        mag_title = synthetic_sentence(rng, language, rng.randint(4, 20))
+
+    # Abstracts
+    crossref_abstract = ""
+    if rng.random() < 0.3:
+        crossref_abstract = synthetic_sentence(rng, language, rng.randint(50, 300))
+        if rng.random() < 0.8:
+            crossref_abstract = f"<jats:title>Abstract</jats:title>\n<jats:p>{crossref_abstract}</jats:p>"
+    mag_abstract = ""
+    if rng.random() < 0.4:
+        mag_abstract = synthetic_sentence(rng, language, rng.randint(50, 300))
+
+    return [doi, mag_title, crossref_title, mag_abstract, crossref_abstract]
+
+
+def peak_rss_mb():
+    """Get the peak resident set size of this process.
+
+    :return: the peak RSS in MB.
+    """
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_pipeline(
+    csv_paths: List[str],
+    output_path: str,
+    model_path: str,
+    batch_size: int,
+    output_format: str,
+    memo_size: int = 0,
+    max_text_chars: Optional[int] = None,
+    threaded_io: bool = False,
+    pipelined: bool = False,
+):
+    """Run process_archive over archives, as a worker of predict-language does, and sum the time spent in each stage.
+
+    :param csv_paths: the archives.
+    :param output_path: the output directory.
+    :param model_path: the path to the fasttext model.
+    :param batch_size: the number of rows in a batch.
+    :param output_format: the output format, one of OUTPUT_FORMATS.
+    :param memo_size: the maximum size of the memo in bytes, 0 to not use a memo.
+    :param max_text_chars: the maximum number of characters of text to predict, longer texts are truncated.
+    :param threaded_io: whether to decompress the input and compress the output in background threads.
+    :param pipelined: whether to read and write in background threads, see process_archive.
+    :return: the number of rows, the seconds spent in each stage, the metrics summed over the archives and the peak
+    RSS in MB.
+    """
+
+    predictor = LanguagePredictor(model_path)
+    metrics = collections.Counter()
+    for csv_path in csv_paths:
+        result = predictor.process_archive(
+            csv_path,
+            output_path,
+            memo_size=memo_size,
+            batch_size=batch_size,
+            output_format=output_format,
+            max_text_chars=max_text_chars,
+            threaded_io=threaded_io,
+            pipelined=pipelined,
+        )
+        metrics.update({key: value for key, value in result.items() if key in METRICS})
+
+    seconds = {stage: metrics[f"{stage}_seconds"] for stage in STAGES}
+    return dict(rows=metrics["rows"], seconds=seconds, metrics=metrics, peak_rss_mb=peak_rss_mb())
+
+
+def rss_mb():
+    """Get the current resident set size of this process, from /proc on Linux.
+
+    :return: the RSS in MB.
+    """
+
+    with open("/proc/self/statm") as f:
+        pages = int(f.read().split()[1])
+    return pages * resource.getpagesize() / 1024 / 1024
+
+
+def run_engine(engine_name: str, model_path: str, texts: List[str], batch_size: int):
+    """Load an engine and predict the language of texts in batches.
+
+    :param engine_name: the language identification engine, one of ENGINES.
+    :param model_path: the path to the model.
+    :param texts: the pre-processed texts.
+    :param batch_size: the number of texts in a batch.
+    :return: the load time in seconds, the memory used by the model in MB, the prediction time in seconds and the
+    labels.
+    """
+
+    rss_before = rss_mb()
+    start = time.perf_counter()
+    engine = load_engine(model_path, engine_name)
+    load_seconds = time.perf_counter() - start
+    model_mb = rss_mb() - rss_before
+
+    start = time.perf_counter()
+    labels = []
+    for i in range(0, len(texts), batch_size):
+        labels.extend(engine.predict_batch(texts[i : i + batch_size])[0])
+    seconds = time.perf_counter() - start
+
+    return dict(load_seconds=load_seconds, model_mb=model_mb, seconds=seconds, labels=labels)
+
+
+def legacy_is_junk(text: str):
+    """The checks that preprocess_text made before is_junk: a string comparison, an uncompiled DOI regex and
+    validators.url.
+
+    :param text: the stripped text.
+    :return: whether the text should be thrown away.
+    """
+
+    import validators
+
+    if text == "[NO TITLE AVAILABLE]":
+        return True
+    if re.match(r"^10.\d{4,9}/[-._;()/:A-Z0-9]+$", text, re.IGNORECASE) is not None:
+        return True
+    return bool(validators.url(text))
+
+
+async def http_request(
+    reader: asyncio.StreamReader, writer: asyncio.StreamWriter, method: str, path: str, body: Optional[Dict] = None
+):
+    """Send an HTTP/1.1 request on a keep-alive connection and read its response.
+
+    :param reader: the stream of the connection to read from.
+    :param writer: the stream of the connection to write to.
+    :param method: the HTTP method.
+    :param path: the path.
+    :param body: the JSON body.
+    :return: the status and the JSON response.
+    """
+
+    payload = b"" if body is None else json.dumps(body).encode("utf-8")
+    writer.write(
+        f"{method} {path} HTTP/1.1\r\nHost: localhost\r\nContent-Type: application/json\r\n"
+        f"Content-Length: {len(payload)}\r\n\r\n".encode("latin-1") + payload
+    )
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        if name.strip().lower() == "content-length":
+            length = int(value)
+    return status, json.loads(await reader.readexactly(length))
+
+
+async def run_load_test(connect, num_requests: int, concurrency: int, records_per_request: int, seed: int = 42) -> Dict:
+    """Send requests with synthetic records to the language service from concurrent clients.
+
+    :param connect: a function that opens a connection to the service and returns its reader and writer.
+    :param num_requests: the total number of requests.
+    :param concurrency: the number of clients, each with its own connection, that send one request at a time.
+    :param records_per_request: the number of records in each request.
+    :param seed: the random seed.
+    :return: the latency of each request in seconds, the total time and the metrics of the service.
+    """
+
+    rng = random.Random(seed)
+    bodies = [
+        {
+            "records": [
+                dict(zip(RECORD_FIELDS, synthetic_row(rng, i * records_per_request + j)))
+                for j in range(records_per_request)
+            ]
+        }
+        for i in range(num_requests)
+    ]
+    latencies = []
+    remaining = iter(bodies)
+
+    async def client():
+        reader, writer = await connect()
+        try:
+            for body in remaining:
+                start = time.perf_counter()
+                status, _ = await http_request(reader, writer, "POST", "/predict", body)
+                if status != 200:
+                    raise RuntimeError(f"The service returned status {status}")
+                latencies.append(time.perf_counter() - start)
+        finally:
+            writer.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    seconds = time.perf_counter() - start
+
+    reader, writer = await connect()
+    _, metrics = await http_request(reader, writer, "GET", "/metrics")
+    writer.close()
+    return {"latencies": latencies, "seconds": seconds, "metrics": metrics}
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command("junk-classifier")
+@click.option("--number", type=click.INT, default=10000, help="The number of times to classify the sample")
+def junk_classifier_cmd(number: int):
+    """Compare is_junk with the previous DOI, URL and placeholder checks."""
+
+    try:
+        import validators  # noqa: F401
+    except ImportError:
+        raise click.ClickException("validators is needed to run the previous checks: pip install validators")
+
+    disagreements = [text for text in JUNK_SAMPLE if is_junk(text) != legacy_is_junk(text)]
+    for text in disagreements:
+        print(f"Disagreement: {text}")
+
+    legacy_time = timeit.timeit(lambda: [legacy_is_junk(text) for text in JUNK_SAMPLE], number=number)
+    junk_time = timeit.timeit(lambda: [is_junk(text) for text in JUNK_SAMPLE], number=number)
+    calls = number * len(JUNK_SAMPLE)
+    print(f"Previous checks: {legacy_time / calls * 1e6:.3f} us per field")
+    print(f"is_junk: {junk_time / calls * 1e6:.3f} us per field")
+    print(f"Speedup: {legacy_time / junk_time:.1f}x, disagreements: {len(disagreements)}")
+
+
+@cli.command("compression")
+@click.argument("csv-path", type=click.Path(exists=True, file_okay=True, dir_okay=False))
+def compression_cmd(csv_path: str):
+    """Compare the throughput of the decompressors and compressors on an archive."""
+
+    for reader in available_gzip_readers():
+        for threaded in [False, True]:
+            start = time.perf_counter()
+            with open_input(csv_path, reader=reader, threaded=threaded) as f:
+                data = f.read()
+            seconds = time.perf_counter() - start
+            print(f"Read {reader}, threaded: {threaded}: {len(data) / seconds / 1e6:.1f} MB/s")
+
+    configs = [("gzip", level) for level in [1, 6, 9]]
+    try:
+        import zstandard  # noqa: F401
+
+        configs += [("zstd", level) for level in [1, 3, 9]]
+    except ImportError:
+        pass
+    with tempfile.TemporaryDirectory() as tmp:
+        for compression, level in configs:
+            for threaded in [False, True]:
+                path = os.path.join(tmp, f"output.{compression}")
+                start = time.perf_counter()
+                with open_output_file(path, compression=compression, level=level, threaded=threaded) as f:
+                    f.write(data)
+                seconds = time.perf_counter() - start
+                ratio = len(data) / os.path.getsize(path)
+                print(
+                    f"Write {compression} level {level}, threaded: {threaded}: "
+                    f"{len(data) / seconds / 1e6:.1f} MB/s, ratio: {ratio:.2f}"
+                )
+
+
+@cli.command("generate-corpus")
+@click.argument("output-path", type=click.Path(exists=True, file_okay=False, dir_okay=True))
+@click.option("--num-files", type=click.INT, default=4, help="The number of .csv.gz files to make")
+@click.option("--rows-per-file", type=click.INT, default=25000, help="The number of rows in each file")
+@click.option("--seed", type=click.INT, default=42, help="The random seed")
+def generate_corpus_cmd(output_path: str, num_files: int, rows_per_file: int, seed: int):
+    """Generate synthetic .csv.gz archives in the layout that predict-language reads."""
+
+    rng = random.Random(seed)
+    for i in range(num_files):
+        path = os.path.join(output_path, f"{i:012d}.csv.gz")
+        with gzip.open(path, "wt", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["doi", "mag_title", "crossref_title", "mag_abstract", "crossref_abstract"])
+            for j in range(rows_per_file):
+                writer.writerow(synthetic_row(rng, i * rows_per_file + j))
+        print(f"Generated: {path}")
+
+
+@cli.command("train-model")
+@click.argument("model-path", type=click.Path(file_okay=True, dir_okay=False))
+@click.option("--seed", type=click.INT, default=42, help="The random seed")
+def train_model_cmd(model_path: str, seed: int):
+    """Train a tiny fasttext language model on the synthetic words, so that the benchmarks can run offline."""
+
+    import fasttext
+
+    rng = random.Random(seed)
+    with tempfile.NamedTemporaryFile("w", suffix=".txt") as f:
+        for _ in range(5000):
+            language = rng.choice(list(SYNTHETIC_WORDS))
+            f.write(f"__label__{language} {synthetic_sentence(rng, language, rng.randint(3, 30)).lower()}\n")
+        f.flush()
+        model = fasttext.train_supervised(f.name, dim=16, epoch=5, minn=2, maxn=4, thread=1, verbose=0)
+    model.save_model(model_path)
+    print(f"Saved model: {model_path}")
+
+
+@cli.command("pipeline")
+@click.argument("input-path", type=click.Path(exists=True, file_okay=False, dir_okay=True))
+@click.option(
+    "--model-path",
+    type=click.Path(exists=True, file_okay=True, dir_okay=False),
+    required=True,
+    help="The fasttext model, such as lid.176.bin or a model made with train-model",
+)
+@click.option("--file-pattern", type=click.STRING, default="*.csv.gz", help="The file pattern of the archives")
+@click.option(
+    "--batch-size", type=click.INT, multiple=True, default=[10000], help="The batch sizes to compare, can be repeated"
+)
+@click.option(
+    "--output-format",
+    type=click.Choice(list(OUTPUT_FORMATS)),
+    multiple=True,
+    default=["csv"],
+    help="The output formats to compare, can be repeated",
+)
+@click.option(
+    "--memo-size",
+    type=click.FLOAT,
+    default=64,
+    help="The size in megabytes of the memo of pre-processed fields and predictions, 0 to not use a memo",
+)
+@click.option(
+    "--max-text-chars",
+    type=click.IntRange(min=1),
+    default=None,
+    help="Truncate the text of each row to this many characters before predicting",
+)
+@click.option(
+    "--threaded-io/--no-threaded-io",
+    default=True,
+    help="Whether to decompress the input and compress the output in background threads",
+)
+@click.option(
+    "--pipelined/--no-pipelined", default=False, help="Whether to read and write batches in background threads"
+)
+def pipeline_cmd(
+    input_path: str,
+    model_path: str,
+    file_pattern: str,
+    batch_size: List[int],
+    output_format: List[str],
+    memo_size: float,
+    max_text_chars: Optional[int],
+    threaded_io: bool,
+    pipelined: bool,
+):
+    """Time the read, preprocess, predict and write stages of process_archive for each configuration, with the same
+    defaults as predict-language.
+
+    Each configuration runs in a fresh process so that its peak RSS is measured separately.
+    """
+
+    csv_paths = sorted(list_files(input_path, file_pattern))
+    context = multiprocessing.get_context("fork")
+    for size, fmt in itertools.product(batch_size, output_format):
+        with tempfile.TemporaryDirectory() as tmp, context.Pool(1) as pool:
+            result = pool.apply(
+                run_pipeline,
+                (
+                    csv_paths,
+                    tmp,
+                    model_path,
+                    size,
+                    fmt,
+                    int(memo_size * 1024 * 1024),
+                    max_text_chars,
+                    threaded_io,
+                    pipelined,
+                ),
+            )
+        stages = ", ".join(f"{stage}: {seconds:.2f}s" for stage, seconds in result["seconds"].items())
+        print(
+            f"batch size: {size}, output format: {fmt}, rows: {result['rows']}, {stages}, "
+            f"rows/sec: {result['rows'] / max(result['metrics']['seconds'], 1e-9):.0f}, "
+            f"peak RSS: {result['peak_rss_mb']:.0f}MB"
+            f"{memo_summary(result['metrics'])}"
+        )
+
+
+@cli.command("compare-engines")
+@click.argument("csv-path", type=click.Path(exists=True, file_okay=True, dir_okay=False))
+@click.option(
+    "--model-path",
+    type=click.Path(exists=True, file_okay=True, dir_okay=False),
+    multiple=True,
+    required=True,
+    help="The models to compare, such as lid.176.bin and lid.176.ftz, can be repeated. The first model is the "
+    "reference that the others are compared with",
+)
+@click.option(
+    "--engine",
+    type=click.Choice(list(ENGINES)),
+    multiple=True,
+    default=["fasttext"],
+    help="The engine of each model, in the same order, the last engine is used for the remaining models",
+)
+@click.option("--num-rows", type=click.INT, default=100000, help="The number of rows of the archive to classify")
+@click.option("--batch-size", type=click.INT, default=10000, help="The number of rows sent to the model at once")
+def compare_engines_cmd(csv_path: str, model_path: List[str], engine: List[str], num_rows: int, batch_size: int):
+    """Compare the load time, memory, throughput and agreement of language identification engines on an archive.
+
+    Each engine runs in a fresh process so that the memory used by its model is measured separately.
+    """
+
+    texts = [preprocess_row(row)[1] for row in itertools.islice(read_csv_gz(csv_path), num_rows)]
+    num_texts = sum(text != "" for text in texts)
+    engines = list(engine) + [engine[-1]] * (len(model_path) - len(engine))
+    context = multiprocessing.get_context("fork")
+    reference = None
+    for engine_name, path in zip(engines, model_path):
+        with context.Pool(1) as pool:
+            result = pool.apply(run_engine, (engine_name, path, texts, batch_size))
+        if reference is None:
+            reference = result["labels"]
+        agreement = sum(
+            label == reference_label
+            for label, reference_label in zip(result["labels"], reference)
+            if reference_label is not None
+        )
+        print(
+            f"{engine_name} {os.path.basename(path)}: load time: {result['load_seconds']:.2f}s, "
+            f"model memory: {result['model_mb']:.1f}MB, rows/sec: {len(texts) / result['seconds']:.0f}, "
+            f"agreement with {os.path.basename(model_path[0])}: {agreement / max(num_texts, 1):.2%}"
+        )
+
+
+@cli.command("load-test")
+@click.option("--host", type=click.STRING, default="127.0.0.1", help="The host of the language service")
+@click.option("--port", type=click.INT, default=8080, help="The port of the language service")
+@click.option("--unix-socket", type=click.Path(), default=None, help="The Unix socket of the language service")
+@click.option("--num-requests", type=click.INT, default=10000, help="The number of requests to send")
+@click.option("--concurrency", type=click.INT, default=64, help="The number of clients sending requests at once")
+@click.option("--records-per-request", type=click.INT, default=1, help="The number of records in each request")
+def load_test_cmd(
+    host: str, port: int, unix_socket: Optional[str], num_requests: int, concurrency: int, records_per_request: int
+):
+    """Measure the latency and throughput of a running language service, see service.py."""
+
+    def connect():
+        if unix_socket is not None:
+            return asyncio.open_unix_connection(unix_socket)
+        return asyncio.open_connection(host, port)
+
+    result = asyncio.run(run_load_test(connect, num_requests, concurrency, records_per_request))
+    latencies = result["latencies"]
+    percentiles = ", ".join(f"p{q}: {percentile(latencies, q) * 1000:.1f}ms" for q in LATENCY_PERCENTILES)
+    print(
+        f"Requests: {len(latencies)}, requests/sec: {len(latencies) / result['seconds']:.0f}, "
+        f"records/sec: {len(latencies) * records_per_request / result['seconds']:.0f}, latency {percentiles}"
+    )
+    metrics = result["metrics"]
+    print(
+        f"Service: batches: {metrics['batches']}, mean batch size: {metrics['mean_batch_size']:.1f}, "
+        + ", ".join(f"p{q}: {metrics[f'p{q}_latency_ms']:.1f}ms" for q in LATENCY_PERCENTILES)
+    )
+
+
+if __name__ == "__main__":
+    cli()
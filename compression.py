@@ -0,0 +1,272 @@
+# Copyright 2022 Curtin University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import gzip
+import io
+import queue
+import shutil
+import subprocess
+import threading
+from typing import Optional
+
+# The compression formats that output files can be written with and their file extensions
+COMPRESSIONS = {"gzip": ".gz", "zstd": ".zst"}
+
+# Decompressors that can be used to read gzip files, fastest first
+GZIP_READERS = ["isal", "pigz", "gzip"]
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def available_gzip_readers():
+    """List the gzip decompressors that are installed: the python-isal package, the pigz command and the gzip module.
+
+    :return: the names of the decompressors, fastest first.
+    """
+
+    readers = []
+    try:
+        import isal  # noqa: F401
+
+        readers.append("isal")
+    except ImportError:
+        pass
+    if shutil.which("pigz") is not None:
+        readers.append("pigz")
+    readers.append("gzip")
+    return readers
+
+
+class ThreadedReader(io.RawIOBase):
+    """Reads a file in a background thread, so that decompression overlaps with the work done on the data.
+
+    zlib, isal and zstd release the GIL while they decompress, so the background thread runs in parallel with the
+    thread that parses the data. At most max_chunks chunks are read ahead.
+    """
+
+    def __init__(self, raw, chunk_size: int = CHUNK_SIZE, max_chunks: int = 4):
+        """Start reading.
+
+        :param raw: the file to read.
+        :param chunk_size: the number of bytes to read at a time.
+        :param max_chunks: the maximum number of chunks that are read ahead.
+        """
+
+        super().__init__()
+        self.raw = raw
+        self.chunk_size = chunk_size
+        self.queue = queue.Queue(max_chunks)
+        self.stopped = threading.Event()
+        self.chunk = b""
+        self.pos = 0
+        self.eof = False
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _put(self, item):
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def _run(self):
+        try:
+            while not self.stopped.is_set():
+                chunk = self.raw.read(self.chunk_size)
+                self._put(chunk)
+                if not chunk:
+                    break
+        except BaseException as e:
+            self._put(e)
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if self.pos >= len(self.chunk):
+            if self.eof:
+                return 0
+            item = self.queue.get()
+            if isinstance(item, BaseException):
+                raise item
+            if not item:
+                self.eof = True
+                return 0
+            self.chunk = item
+            self.pos = 0
+        n = min(len(b), len(self.chunk) - self.pos)
+        b[:n] = self.chunk[self.pos : self.pos + n]
+        self.pos += n
+        return n
+
+    def close(self):
+        if not self.closed:
+            self.stopped.set()
+            self.thread.join()
+            self.raw.close()
+        super().close()
+
+
+class ThreadedWriter(io.RawIOBase):
+    """Writes to a file in a background thread, so that compression overlaps with the work that produces the data."""
+
+    def __init__(self, raw, max_chunks: int = 4):
+        """Start the writer thread.
+
+        :param raw: the file to write to.
+        :param max_chunks: the maximum number of chunks waiting to be written.
+        """
+
+        super().__init__()
+        self.raw = raw
+        self.queue = queue.Queue(max_chunks)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            chunk = self.queue.get()
+            if chunk is None:
+                break
+            if self.error is None:
+                try:
+                    self.raw.write(chunk)
+                except BaseException as e:
+                    self.error = e
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        if self.error is not None:
+            raise self.error
+        self.queue.put(bytes(b))
+        return len(b)
+
+    def close(self):
+        if not self.closed:
+            self.queue.put(None)
+            self.thread.join()
+            self.raw.close()
+            if self.error is not None:
+                raise self.error
+        super().close()
+
+
+class ProcessFile(io.RawIOBase):
+    """The stdout or stdin of an external compression process, such as pigz, that checks its exit code on close."""
+
+    def __init__(self, process: subprocess.Popen, mode: str):
+        """Wrap the process.
+
+        :param process: the process.
+        :param mode: r to read its stdout or w to write to its stdin.
+        """
+
+        super().__init__()
+        self.process = process
+        self.file = process.stdout if mode == "r" else process.stdin
+
+    def readable(self):
+        return self.file is self.process.stdout
+
+    def writable(self):
+        return self.file is self.process.stdin
+
+    def readinto(self, b):
+        n = self.file.readinto(b)
+        if n == 0 and self.process.wait() != 0:
+            raise OSError(f"{self.process.args[0]} exited with code {self.process.returncode}")
+        return n
+
+    def write(self, b):
+        return self.file.write(b)
+
+    def close(self):
+        if not self.closed:
+            self.file.close()
+            if self.process.wait() != 0 and self.writable():
+                raise OSError(f"{self.process.args[0]} exited with code {self.process.returncode}")
+        super().close()
+
+
+def open_input(path: str, reader: Optional[str] = None, threaded: bool = False):
+    """Open a compressed input file for reading.
+
+    Files ending in .zst are decompressed with zstandard, files ending in .gz with the fastest available gzip
+    decompressor and any other files are read as is.
+
+    :param path: the path to the file.
+    :param reader: the gzip decompressor to use, one of GZIP_READERS, defaults to the fastest available one.
+    :param threaded: whether to decompress in a background thread.
+    :return: a binary file object.
+    """
+
+    if path.endswith(".zst"):
+        import zstandard
+
+        f = zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), closefd=True)
+    elif path.endswith(".gz"):
+        if reader is None:
+            reader = available_gzip_readers()[0]
+        if reader == "isal":
+            from isal import igzip
+
+            f = igzip.open(path, "rb")
+        elif reader == "pigz":
+            process = subprocess.Popen(["pigz", "-dc", path], stdout=subprocess.PIPE)
+            f = ProcessFile(process, "r")
+        else:
+            f = gzip.open(path, "rb")
+    else:
+        f = open(path, "rb")
+
+    if threaded:
+        f = ThreadedReader(f)
+    return io.BufferedReader(f, CHUNK_SIZE) if isinstance(f, io.RawIOBase) else f
+
+
+def open_output_file(path: str, compression: str = "gzip", level: Optional[int] = None, threaded: bool = False):
+    """Open a compressed output file for writing.
+
+    gzip files are compressed with pigz when it is installed, which compresses on all cores, and with the gzip module
+    otherwise.
+
+    :param path: the path to the file.
+    :param compression: gzip or zstd.
+    :param level: the compression level, defaults to 6 for gzip and 3 for zstd.
+    :param threaded: whether to compress in a background thread.
+    :return: a binary file object.
+    """
+
+    if compression == "zstd":
+        import zstandard
+
+        level = 3 if level is None else level
+        f = zstandard.ZstdCompressor(level=level).stream_writer(open(path, "wb"), closefd=True)
+    else:
+        level = 6 if level is None else level
+        if shutil.which("pigz") is not None:
+            with open(path, "wb") as out:
+                process = subprocess.Popen(["pigz", f"-{level}", "-c"], stdin=subprocess.PIPE, stdout=out)
+            f = ProcessFile(process, "w")
+        else:
+            f = gzip.open(path, "wb", compresslevel=level)
+
+    if threaded:
+        f = ThreadedWriter(f)
+    return io.BufferedWriter(f, CHUNK_SIZE) if isinstance(f, io.RawIOBase) else f
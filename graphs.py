@@ -1,12 +1,22 @@
+import hashlib
+import json
 import plotly.express as px
+import plotly.io as pio
 import pandas as pd
 import os
 from pathlib import Path
+from typing import Callable, List, NamedTuple, Optional
+
+import click
 
 QUERY_SQL = Path('graph_data.sql')
 GRAPH_DIR = Path('output_graphs')
 CSV_FILE = 'downloaded_data.csv'
 CSV_PATH = GRAPH_DIR / CSV_FILE
+CUBE_FILE = 'cube.parquet'
+CUBE_PATH = GRAPH_DIR / CUBE_FILE
+FINGERPRINTS_FILE = 'charts.json'
+FINGERPRINTS_PATH = GRAPH_DIR / FINGERPRINTS_FILE
 PROJECT = 'coki-scratch-space'
 COUNT_COLUMNS = [
     'oa',
@@ -22,6 +32,15 @@ COUNT_COLUMNS = [
     'cc_licensed'
 ]
 
+# The dimensions of the cube, which is the grain of the downloaded data
+DIMENSIONS = ['published_year', 'crossref_type', 'code', 'name']
+
+# The columns that are summed when the cube is rolled up
+SUM_COLUMNS = ['total'] + [f'count_{col}' for col in dict.fromkeys(COUNT_COLUMNS)]
+
+# The averages, which are stored as sums weighted by the number of outputs they are averaged over
+MEAN_COLUMNS = ['avg_score', 'mean_citations', 'mean_citations2y']
+
 LARGE_LANGUAGES = [
     'de',
     'fr',
@@ -89,229 +108,362 @@ def download_data():
     data.to_csv(CSV_PATH, index=False)
 
 
-def graphs():
-    downloaded = pd.read_csv(CSV_PATH)
-
-    # Pie All Years
-    graph_data = concatenate_others(downloaded)
-    fig = px.pie(graph_data, values='total', names='index', labels=LABELS)
-    fig.write_image(GRAPH_DIR / 'pie_all_years.png')
-    fig.write_html(GRAPH_DIR / 'pie_all_years.html')
-
-    # Pie All Years Non-English
-    graph_data = concatenate_others(downloaded[downloaded.code != 'en'], slices=15)
-    fig = px.pie(graph_data, values='total', names='index', labels=LABELS)
-    fig.write_image(GRAPH_DIR / 'pie_allyears_nonenglish.png')
-    fig.write_html(GRAPH_DIR / 'pie_allyears_nonenglish.html')
-
-    # Pie 2020
-    graph_data = concatenate_others(downloaded[downloaded.published_year == 2020], slices=7)
-    fig = px.pie(graph_data, values='total', names='index', labels=LABELS)
-    fig.write_image(GRAPH_DIR / 'pie_2020.png')
-    fig.write_html(GRAPH_DIR / 'pie_2020.html')
-
-    # Pie 2020 Non-English
-    graph_data = concatenate_others(downloaded[(downloaded.code != 'en') &
-                                               (downloaded.published_year == 2020)], slices=15)
-    fig = px.pie(graph_data, values='total', names='index', labels=LABELS)
-    fig.write_image(GRAPH_DIR / 'pie_2020_nonenglish.png')
-    fig.write_html(GRAPH_DIR / 'pie_2020_nonenglish.html')
-
-    # Pie by Crossref Type: English
-    graph_data = concatenate_others(downloaded[downloaded.code == 'en'],
-                                    value_column='total',
-                                    group_column='crossref_type')
-    fig = px.pie(graph_data, values='total', names='index', labels=LABELS)
-    fig.write_image(GRAPH_DIR / 'pie_crtype_en.png')
-    fig.write_html(GRAPH_DIR / 'pie_crtype_en.html')
-
-    # Pie by Crossref Type: German
-    graph_data = concatenate_others(downloaded[downloaded.code == 'de'],
-                                    value_column='total',
-                                    group_column='crossref_type')
-    fig = px.pie(graph_data, values='total', names='index', labels=LABELS)
-    fig.write_image(GRAPH_DIR / 'pie_crtype_de.png')
-    fig.write_html(GRAPH_DIR / 'pie_crtype_de.html')
-
-    # Pie by Crossref Type: French
-    graph_data = concatenate_others(downloaded[downloaded.code == 'fr'],
-                                    value_column='total',
-                                    group_column='crossref_type')
-    fig = px.pie(graph_data, values='total', names='index', labels=LABELS)
-    fig.write_image(GRAPH_DIR / 'pie_crtype_fr.png')
-    fig.write_html(GRAPH_DIR / 'pie_crtype_fr.html')
-
-    # Sunburst of Crossref Type by Language (large languages plus english)
-    graph_data = downloaded[downloaded.code.isin(LARGE_LANGUAGES + ['en'])].groupby(['name', 'crossref_type']).sum()
-    graph_data.reset_index(inplace=True)
-    fig = px.sunburst(graph_data,
-                      path=['name', 'crossref_type'],
-                      values='total',
-                      labels=LABELS)
-    fig.write_image(GRAPH_DIR / 'sunburst_crtype_large+en.png')
-    fig.write_html(GRAPH_DIR / 'sunburst_crtype_large+en.html')
-
-    # Stacked Bar of Crossref Types by Langauge (large languages plus English)
-    language_totals = downloaded[['name', 'total']].groupby('name').sum().to_dict()['total']
-    graph_data['language_total'] = graph_data.name.map(language_totals)
-    graph_data.sort_values(['language_total', 'total'], ascending=False, inplace=True)
-    graph_data['pc_crossref_type'] = graph_data.total / graph_data.language_total * 100
-    fig = px.bar(graph_data,
-                 x='name',
-                 y='pc_crossref_type',
-                 color='crossref_type',
-                 labels=LABELS,
-                 range_y=[0, 100])
-    fig.write_image(GRAPH_DIR / 'stackedbar_crtype_large+en.png')
-    fig.write_html(GRAPH_DIR / 'stackedbar_crtype_large+en.html')
-
-    # Languages Line Graph 2000 - 2020 - Totals
-    filtered = downloaded[downloaded.code.isin(LARGE_LANGUAGES)]
-    all_by_year = filtered.groupby(['name', 'published_year']).sum().reset_index()
-    fig = px.line(all_by_year,
-                  x='published_year',
-                  y='total',
-                  color='name',
-                  labels=LABELS
-                  )
-    fig.write_image(GRAPH_DIR / 'line_counts_overtime_largelang.png')
-    fig.write_html(GRAPH_DIR / 'line_counts_overtime_largelang.html')
-
-    # Languages Line Graph 2000 - 2020 proportions of total
-    filtered = downloaded[downloaded.code.isin(LARGE_LANGUAGES + ['en'])]
-    all_by_year = filtered.groupby(['name', 'published_year']).sum().reset_index()
-    year_totals = downloaded.groupby('published_year').sum().to_dict()['total']
-    all_by_year['year_total'] = all_by_year['published_year'].map(year_totals)
-    all_by_year['pc_of_year'] = all_by_year.total / all_by_year.year_total * 100
-    all_by_year.sort_values(['published_year', 'pc_of_year'], ascending=False, inplace=True)
-    fig = px.area(all_by_year,
-                  x='published_year',
-                  y='pc_of_year',
-                  color='name',
-                  labels=LABELS,
-                  range_y=[0, 100])
-    fig.write_image(GRAPH_DIR / 'area_pc_overtime_largelang.png')
-    fig.write_html(GRAPH_DIR / 'area_pc_overtime_largelang.html')
-
-    # Languages Line Graph 2000 - 2020 - Journal Articles Only
-    filtered = downloaded[(downloaded.code.isin(LARGE_LANGUAGES + ['en'])) &
-                          (downloaded.crossref_type == 'journal-article')]
-
-    all_by_year = filtered.groupby(['name', 'published_year']).sum().reset_index()
-    fig = px.line(all_by_year,
-                  x='published_year',
-                  y='total',
-                  color='name',
-                  labels=LABELS)
-    fig.write_image(GRAPH_DIR / 'line_counts_overtime_journal-articles_largelang.png')
-    fig.write_html(GRAPH_DIR / 'line_counts_overtime_journal-articles_largelang.html')
-
-    # Set up percentages for each year and for all years
-    combined_years = downloaded.groupby(['code', 'name']).sum().reset_index()
-    combined_years.sort_values('total', ascending=False, inplace=True)
-
-    by_years = downloaded.groupby(['published_year', 'code', 'name']).sum().reset_index()
-    by_years.sort_values('total', ascending=False, inplace=True)
-    for df in [by_years, combined_years]:
-        for col in COUNT_COLUMNS:
-            colname = f'pc_{col}'
-            df[colname] = df[f'count_{col}'] / df.total * 100
-            if LABELS.get(colname):
-                df[LABELS.get(colname)] = df[colname]
-        df['pc_doaj_apc'] = df.pc_doaj - df.pc_diamond
-        df['DOAJ Journal with APCs (%)'] = df['pc_doaj_apc']
-        df['pc_closed'] = 100 - df.pc_oa
-        df['Closed (%)'] = df['pc_closed']
-
-    # OA Classes for all time, large languages
-    fig = px.bar(combined_years[combined_years.code.isin(LARGE_LANGUAGES + ['en'])],
-                 x='name',
-                 y=OA_CLASS_YS,
-                 labels=LABELS,
-                 color_discrete_map=oatypes_palette,
-                 range_y=[0, 100])
-    fig.write_image(GRAPH_DIR / 'stackedbar_oaclasses_alltime_largelang.png')
-    fig.write_html(GRAPH_DIR / 'stackedbar_oaclasses_alltime_largelang.html')
-
-    # OA Classes for 2020, large languages
-    fig = px.bar(by_years[(by_years.code.isin(LARGE_LANGUAGES + ['en'])) &
-                          (by_years.published_year == 2020)],
-                 x='name',
-                 y=OA_CLASS_YS,
-                 labels=LABELS,
-                 color_discrete_map=oatypes_palette,
-                 range_y=[0, 100])
-    fig.write_image(GRAPH_DIR / 'stackedbar_oaclasses_2020_largelang.png')
-    fig.write_html(GRAPH_DIR / 'stackedbar_oaclasses_2020_largelang.html')
-
-    # OA Classes for all time, Scandics
-    fig = px.bar(combined_years[combined_years.code.isin(SCANDICS + ['en'])],
-                 x='name',
-                 y=OA_CLASS_YS,
-                 labels=LABELS,
-                 color_discrete_map=oatypes_palette,
-                 range_y=[0, 100])
-    fig.write_image(GRAPH_DIR / 'stackedbar_oaclasses_alltime_scandics.png')
-    fig.write_html(GRAPH_DIR / 'stackedbar_oaclasses_alltime_scandics.html')
-
-    # OA Classes for 2020, Scandics
-    fig = px.bar(by_years[(by_years.code.isin(SCANDICS + ['en'])) &
-                          (by_years.published_year == 2020)],
-                 x='name',
-                 y=OA_CLASS_YS,
-                 labels=LABELS,
-                 color_discrete_map=oatypes_palette,
-                 range_y=[0, 100])
-    fig.write_image(GRAPH_DIR / 'stackedbar_oaclasses_2020_scandics.png')
-    fig.write_html(GRAPH_DIR / 'stackedbar_oaclasses_2020_scandics.html')
-
-    # OA Classes for 2020, Scandics
-    fig = px.bar(by_years[(by_years.code.isin(['en', 'de', 'fr', 'nl', 'no', 'da', 'hu', 'pl', 'bg'])) &
-                          (by_years.published_year == 2020)],
-                 x='name',
-                 y=OA_CLASS_YS,
-                 labels=LABELS,
-                 color_discrete_map=oatypes_palette,
-                 range_y=[0, 100])
-    fig.write_image(GRAPH_DIR / 'stackedbar_oaclasses_2020_northeuropecompare.png')
-    fig.write_html(GRAPH_DIR / 'stackedbar_oaclasses_2020_northeuropecompare.html')
-
-    # Mean citations for journal articles by language for 2020
-    graph_data = downloaded[(downloaded.published_year == 2020) &
-                            (downloaded.crossref_type == 'journal-article') &
-                            (downloaded.code.isin(LARGE_LANGUAGES + ['en']))]
-    graph_data.sort_values('total', ascending=False, inplace=True)
-    fig = px.bar(graph_data,
-                 x='name',
-                 y='mean_citations')
-    fig.write_image(GRAPH_DIR / 'bar_meancites_2020_large.png')
-    fig.write_html(GRAPH_DIR / 'bar_meancites_2020_large.html')
-
-    # Mean citations at 2years for journal articles by language for 2000-2019
-    graph_data = downloaded[(downloaded.published_year.isin(range(2000, 2020))) &
-                            (downloaded.crossref_type == 'journal-article') &
-                            (downloaded.code.isin(LARGE_LANGUAGES + ['en']))]
-    graph_data.sort_values(['published_year', 'total'], ascending=False, inplace=True)
-    fig = px.line(graph_data,
-                  x='published_year',
-                  y='mean_citations2y',
-                  color='name')
-    fig.write_image(GRAPH_DIR / 'line_meancites2y_2000-2019_large.png')
-    fig.write_html(GRAPH_DIR / 'line_meancites2y_2000-2019_large.html')
+def build_cube(downloaded: pd.DataFrame) -> pd.DataFrame:
+    """Build the year x crossref type x language cube from the downloaded data.
+
+    The counts are stored as integers and the dimensions as categories. Averages can not be summed, so each one is
+    stored as its sum, weighted by the number of outputs, and the number of outputs it is averaged over, which are
+    zero when the average is unknown.
+
+    :param downloaded: the data downloaded with graph_data.sql.
+    :return: the cube.
+    """
+
+    cube = downloaded[DIMENSIONS + SUM_COLUMNS].copy()
+    cube['published_year'] = cube.published_year.astype('int16')
+    for col in ['crossref_type', 'code', 'name']:
+        cube[col] = cube[col].astype('category')
+    for col in SUM_COLUMNS:
+        cube[col] = cube[col].astype('int64')
+    for col in MEAN_COLUMNS:
+        known = downloaded[col].notna()
+        cube[f'{col}_sum'] = (downloaded[col] * downloaded.total).where(known, 0.0)
+        cube[f'{col}_weight'] = downloaded.total.where(known, 0).astype('int64')
+    return cube
+
+
+def load_cube(cube_path: Optional[str] = None) -> pd.DataFrame:
+    """Load the cube from its Parquet file, which needs pyarrow, building it from the downloaded data first when the
+    data has been downloaded since the cube was built.
+
+    :param cube_path: the path to a cube to load instead, such as one built from output files by analysis.py.
+    :return: the cube.
+    """
+
+    if cube_path is not None:
+        return pd.read_parquet(cube_path)
+    if CUBE_PATH.is_file() and CUBE_PATH.stat().st_mtime >= CSV_PATH.stat().st_mtime:
+        return pd.read_parquet(CUBE_PATH)
+
+    cube = build_cube(pd.read_csv(CSV_PATH))
+    cube.to_parquet(CUBE_PATH, index=False)
+    return cube
+
+
+class Cube:
+    """Rolls up the cube along some of its dimensions, keeping each roll-up so that charts of the same data share
+    it."""
+
+    def __init__(self, data: pd.DataFrame):
+        """Create a cube.
+
+        :param data: the cube built by build_cube.
+        """
+
+        self.data = data
+        self.rollups = {}
+
+    def rollup(self,
+               by: list,
+               published_years: list = None,
+               crossref_types: list = None,
+               codes: list = None,
+               exclude_codes: list = None) -> pd.DataFrame:
+        """Sum the counts of the outputs that match the filters by some of the dimensions and compute their averages.
+
+        :param by: the dimensions to group by.
+        :param published_years: only include these years.
+        :param crossref_types: only include these crossref types.
+        :param codes: only include these languages.
+        :param exclude_codes: exclude these languages.
+        :return: a copy of the roll-up, with a row for each group.
+        """
+
+        filters = {'published_year': published_years, 'crossref_type': crossref_types, 'code': codes}
+        key = (tuple(by),
+               tuple((col, tuple(values)) for col, values in filters.items() if values is not None),
+               None if exclude_codes is None else tuple(exclude_codes))
+        if key not in self.rollups:
+            data = self.data
+            for col, values in filters.items():
+                if values is not None:
+                    data = data[data[col].isin(values)]
+            if exclude_codes is not None:
+                data = data[~data.code.isin(exclude_codes)]
+
+            # Cubes built by analysis.py only have some of the columns
+            columns = SUM_COLUMNS + [f'{col}_{part}' for col in MEAN_COLUMNS for part in ['sum', 'weight']]
+            columns = [col for col in columns if col in data.columns]
+            rolled = data.groupby(by, observed=True)[columns].sum().reset_index()
+            for col in by:
+                if isinstance(rolled[col].dtype, pd.CategoricalDtype):
+                    rolled[col] = rolled[col].astype(object)
+            for col in [col for col in MEAN_COLUMNS if f'{col}_sum' in rolled.columns]:
+                rolled[col] = rolled[f'{col}_sum'] / rolled[f'{col}_weight'].where(rolled[f'{col}_weight'] > 0)
+            self.rollups[key] = rolled
+
+        return self.rollups[key].copy()
+
+
+def add_percentages(df: pd.DataFrame):
+    """Add the percentage of the outputs in each open access category to a roll-up.
+
+    :param df: the roll-up.
+    :return: None.
+    """
+
+    for col in COUNT_COLUMNS:
+        colname = f'pc_{col}'
+        df[colname] = df[f'count_{col}'] / df.total * 100
+        if LABELS.get(colname):
+            df[LABELS.get(colname)] = df[colname]
+    df['pc_doaj_apc'] = df.pc_doaj - df.pc_diamond
+    df['DOAJ Journal with APCs (%)'] = df['pc_doaj_apc']
+    df['pc_closed'] = 100 - df.pc_oa
+    df['Closed (%)'] = df['pc_closed']
+
+
+def top_slices(group_column: str = 'name', slices: int = 7) -> Callable:
+    """Prepare a pie chart by keeping the largest slices of a roll-up and summing the rest into an Others slice.
+
+    :param group_column: the column with the names of the slices.
+    :param slices: the number of slices to keep.
+    :return: the function that prepares the roll-up.
+    """
+
+    def prepare(data: pd.DataFrame, cube: Cube) -> pd.DataFrame:
+        return concatenate_others(data, value_column='total', group_column=group_column, slices=slices)
+
+    return prepare
+
+
+def sort_by(columns: list) -> Callable:
+    """Prepare a chart by sorting a roll-up, largest first.
+
+    :param columns: the columns to sort by.
+    :return: the function that prepares the roll-up.
+    """
+
+    def prepare(data: pd.DataFrame, cube: Cube) -> pd.DataFrame:
+        return data.sort_values(columns, ascending=False)
+
+    return prepare
+
+
+def crossref_type_shares(data: pd.DataFrame, cube: Cube) -> pd.DataFrame:
+    """Add the percentage of the outputs of each language that are of each crossref type, largest languages first."""
+
+    language_totals = cube.rollup(['name']).set_index('name')['total']
+    data['language_total'] = data.name.map(language_totals)
+    data = data.sort_values(['language_total', 'total'], ascending=False)
+    data['pc_crossref_type'] = data.total / data.language_total * 100
+    return data
+
+
+def year_shares(data: pd.DataFrame, cube: Cube) -> pd.DataFrame:
+    """Add the percentage of the outputs of each year that are in each language."""
+
+    year_totals = cube.rollup(['published_year']).set_index('published_year')['total']
+    data['year_total'] = data['published_year'].map(year_totals)
+    data['pc_of_year'] = data.total / data.year_total * 100
+    return data.sort_values(['published_year', 'pc_of_year'], ascending=False)
+
+
+def oa_classes(data: pd.DataFrame, cube: Cube) -> pd.DataFrame:
+    """Add the percentage of the outputs in each open access category, largest languages first."""
+
+    data = data.sort_values('total', ascending=False)
+    add_percentages(data)
+    return data
+
+
+class Chart(NamedTuple):
+    """A chart: the roll-up of the cube that it shows, how the roll-up is prepared and how it is plotted."""
+
+    # The name of the chart, which is the name of its files
+    name: str
+    # The plotly express function that makes the figure, such as pie or bar
+    kind: str
+    # The dimensions to roll the cube up by
+    by: list
+    # The filters of the roll-up, see Cube.rollup
+    filters: dict
+    # The options of the plotly express function
+    options: dict
+    # A function of the roll-up and the cube that returns the data of the figure
+    prepare: Optional[Callable] = None
+    # The columns of the cube that the chart needs
+    columns: list = ['total']
+
+
+PIE_OPTIONS = dict(values='total', names='index', labels=LABELS)
+OA_CLASS_OPTIONS = dict(x='name', y=OA_CLASS_YS, labels=LABELS, color_discrete_map=oatypes_palette, range_y=[0, 100])
+LARGE_AND_ENGLISH = LARGE_LANGUAGES + ['en']
+NORTH_EUROPE = ['en', 'de', 'fr', 'nl', 'no', 'da', 'hu', 'pl', 'bg']
+JOURNAL_ARTICLES = ['journal-article']
+MEAN_CITATIONS_COLUMNS = ['total', 'mean_citations_sum', 'mean_citations_weight']
+MEAN_CITATIONS2Y_COLUMNS = ['total', 'mean_citations2y_sum', 'mean_citations2y_weight']
+
+CHARTS = [
+    Chart('pie_all_years', 'pie', ['name'], {}, PIE_OPTIONS, top_slices()),
+    Chart('pie_allyears_nonenglish', 'pie', ['name'], dict(exclude_codes=['en']), PIE_OPTIONS, top_slices(slices=15)),
+    Chart('pie_2020', 'pie', ['name'], dict(published_years=[2020]), PIE_OPTIONS, top_slices()),
+    Chart('pie_2020_nonenglish', 'pie', ['name'],
+          dict(published_years=[2020], exclude_codes=['en']), PIE_OPTIONS, top_slices(slices=15)),
+    Chart('pie_crtype_en', 'pie', ['crossref_type'], dict(codes=['en']), PIE_OPTIONS, top_slices('crossref_type')),
+    Chart('pie_crtype_de', 'pie', ['crossref_type'], dict(codes=['de']), PIE_OPTIONS, top_slices('crossref_type')),
+    Chart('pie_crtype_fr', 'pie', ['crossref_type'], dict(codes=['fr']), PIE_OPTIONS, top_slices('crossref_type')),
+    Chart('sunburst_crtype_large+en', 'sunburst', ['name', 'crossref_type'], dict(codes=LARGE_AND_ENGLISH),
+          dict(path=['name', 'crossref_type'], values='total', labels=LABELS)),
+    Chart('stackedbar_crtype_large+en', 'bar', ['name', 'crossref_type'], dict(codes=LARGE_AND_ENGLISH),
+          dict(x='name', y='pc_crossref_type', color='crossref_type', labels=LABELS, range_y=[0, 100]),
+          crossref_type_shares),
+    Chart('line_counts_overtime_largelang', 'line', ['name', 'published_year'], dict(codes=LARGE_LANGUAGES),
+          dict(x='published_year', y='total', color='name', labels=LABELS)),
+    Chart('area_pc_overtime_largelang', 'area', ['name', 'published_year'], dict(codes=LARGE_AND_ENGLISH),
+          dict(x='published_year', y='pc_of_year', color='name', labels=LABELS, range_y=[0, 100]), year_shares),
+    Chart('line_counts_overtime_journal-articles_largelang', 'line', ['name', 'published_year'],
+          dict(codes=LARGE_AND_ENGLISH, crossref_types=JOURNAL_ARTICLES),
+          dict(x='published_year', y='total', color='name', labels=LABELS)),
+    Chart('stackedbar_oaclasses_alltime_largelang', 'bar', ['code', 'name'], dict(codes=LARGE_AND_ENGLISH),
+          OA_CLASS_OPTIONS, oa_classes, SUM_COLUMNS),
+    Chart('stackedbar_oaclasses_2020_largelang', 'bar', ['published_year', 'code', 'name'],
+          dict(published_years=[2020], codes=LARGE_AND_ENGLISH), OA_CLASS_OPTIONS, oa_classes, SUM_COLUMNS),
+    Chart('stackedbar_oaclasses_alltime_scandics', 'bar', ['code', 'name'], dict(codes=SCANDICS + ['en']),
+          OA_CLASS_OPTIONS, oa_classes, SUM_COLUMNS),
+    Chart('stackedbar_oaclasses_2020_scandics', 'bar', ['published_year', 'code', 'name'],
+          dict(published_years=[2020], codes=SCANDICS + ['en']), OA_CLASS_OPTIONS, oa_classes, SUM_COLUMNS),
+    Chart('stackedbar_oaclasses_2020_northeuropecompare', 'bar', ['published_year', 'code', 'name'],
+          dict(published_years=[2020], codes=NORTH_EUROPE), OA_CLASS_OPTIONS, oa_classes, SUM_COLUMNS),
+    Chart('bar_meancites_2020_large', 'bar', ['published_year', 'code', 'name'],
+          dict(published_years=[2020], crossref_types=JOURNAL_ARTICLES, codes=LARGE_AND_ENGLISH),
+          dict(x='name', y='mean_citations'), sort_by(['total']), MEAN_CITATIONS_COLUMNS),
+    Chart('line_meancites2y_2000-2019_large', 'line', ['published_year', 'code', 'name'],
+          dict(published_years=range(2000, 2020), crossref_types=JOURNAL_ARTICLES, codes=LARGE_AND_ENGLISH),
+          dict(x='published_year', y='mean_citations2y', color='name'), sort_by(['published_year', 'total']),
+          MEAN_CITATIONS2Y_COLUMNS),
+]
+
+
+def chart_data(chart: Chart, cube: Cube) -> pd.DataFrame:
+    """Roll up and prepare the data of a chart.
+
+    :param chart: the chart.
+    :param cube: the cube.
+    :return: the data of the figure.
+    """
+
+    data = cube.rollup(chart.by, **chart.filters)
+    if chart.prepare is not None:
+        data = chart.prepare(data, cube)
+    return data
+
+
+def chart_fingerprint(chart: Chart, data: pd.DataFrame) -> str:
+    """Fingerprint a chart by its spec and its data, so that it is only rendered again when one of them changes.
+
+    :param chart: the chart.
+    :param data: the data of the figure.
+    :return: the fingerprint.
+    """
+
+    fingerprint = hashlib.sha256(repr((chart.kind, chart.by, chart.filters, chart.options)).encode())
+    fingerprint.update(repr(data.columns.tolist()).encode())
+    fingerprint.update(pd.util.hash_pandas_object(data, index=False).values.tobytes())
+    return fingerprint.hexdigest()
+
+
+def load_fingerprints() -> dict:
+    """Load the fingerprints of the charts that were rendered.
+
+    :return: the fingerprint of each chart by name.
+    """
+
+    if not FINGERPRINTS_PATH.is_file():
+        return {}
+    with open(FINGERPRINTS_PATH) as f:
+        return json.load(f)
+
+
+def graphs(charts: List[Chart] = CHARTS,
+           force: bool = False,
+           include_plotlyjs: str = 'cdn',
+           cube_path: Optional[str] = None):
+    """Render the charts whose spec or data changed since they were last rendered.
+
+    The HTML files reference a shared plotly.js instead of each embedding a copy, and the images are exported together
+    by a single Kaleido process, which needs kaleido 1.0 or greater, instead of one export at a time.
+
+    :param charts: the charts.
+    :param force: render every chart, even when it has not changed.
+    :param include_plotlyjs: cdn to load plotly.js from its CDN, or directory to write one plotly.min.js to the
+    output folder that every chart loads.
+    :param cube_path: the path to a cube to make the charts from instead of the downloaded data, charts that need
+    columns that it does not have are skipped.
+    :return: the names of the charts that were rendered.
+    """
+
+    cube = Cube(load_cube(cube_path))
+    fingerprints = load_fingerprints()
+    figs, image_paths, rendered = [], [], {}
+    for chart in charts:
+        if not set(chart.columns) <= set(cube.data.columns):
+            continue
+        data = chart_data(chart, cube)
+        fingerprint = chart_fingerprint(chart, data)
+        html_path, image_path = GRAPH_DIR / f'{chart.name}.html', GRAPH_DIR / f'{chart.name}.png'
+        if not force and fingerprints.get(chart.name) == fingerprint and html_path.is_file() and image_path.is_file():
+            continue
+
+        fig = getattr(px, chart.kind)(data, **chart.options)
+        fig.write_html(html_path, include_plotlyjs=include_plotlyjs)
+        figs.append(fig)
+        image_paths.append(image_path)
+        rendered[chart.name] = fingerprint
+
+    if figs:
+        pio.write_images(figs, image_paths)
+    fingerprints.update(rendered)
+    with open(FINGERPRINTS_PATH, 'w') as f:
+        json.dump(fingerprints, f, indent=2)
+    return list(rendered)
 
 
 def concatenate_others(df: pd.DataFrame,
                        value_column: str = 'total',
                        group_column: str = 'name',
                        slices: int = 7) -> pd.DataFrame:
-    temp = df.groupby(group_column).sum()
-    temp.sort_values(value_column, ascending=False, inplace=True)
-    others = pd.DataFrame({'total': [temp.iloc[slices:][value_column].sum()]}, index=['Others'])
-
-    return temp.iloc[:slices][[value_column]].append(others).reset_index()
+    """Keep the largest slices of a roll-up and sum the rest into an Others slice.
+
+    :param df: the roll-up, with a row for each value of group_column.
+    :param value_column: the column to sum.
+    :param group_column: the column with the names of the slices.
+    :param slices: the number of slices to keep.
+    :return: the slices, with their names in the index column.
+    """
+
+    temp = df.set_index(group_column).sort_values(value_column, ascending=False)
+    others = pd.DataFrame({value_column: [temp.iloc[slices:][value_column].sum()]}, index=['Others'])
+
+    return pd.concat([temp.iloc[:slices][[value_column]], others]).reset_index()
+
+
+@click.command()
+@click.option('--force', is_flag=True, help='Render every chart, even the charts whose data has not changed')
+@click.option('--plotlyjs',
+              type=click.Choice(['cdn', 'directory']),
+              default='cdn',
+              help='Load plotly.js from its CDN, or from one plotly.min.js in the output folder')
+@click.option('--cube-path',
+              type=click.Path(exists=True, file_okay=True, dir_okay=False),
+              default=None,
+              help='Make the charts from a cube built by analysis.py instead of the downloaded data')
+def main(force: bool, plotlyjs: str, cube_path: Optional[str]):
+    if cube_path is None and not CSV_PATH.is_file():
+        download_data()
+    rendered = graphs(force=force, include_plotlyjs=plotlyjs, cube_path=cube_path)
+    print(f'Rendered {len(rendered)} of {len(CHARTS)} charts')
 
 
 if __name__ == '__main__':
-    if not CSV_PATH.is_file():
-        download_data()
-    graphs()
+    main()
@@ -0,0 +1,306 @@
+# Copyright 2022 Curtin University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import csv
+import io
+import json
+import multiprocessing
+import os
+import time
+from typing import Dict, Iterable, List, Optional
+
+import click
+
+from compression import open_input
+from predict_language import CsvWriter, list_files
+
+# The columns of the input archives of predict-language, as exported from create_dataset.sql
+INPUT_COLUMNS = ["doi", "mag_title", "crossref_title", "mag_abstract", "crossref_abstract"]
+
+# The paths of the fields of a raw record, which default to the columns of the doi table read by create_dataset.sql.
+# crossref_titles can be a list of titles, which gives a row for each title.
+DEFAULT_FIELDS = {
+    "doi": "doi",
+    "mag_title": "mag.OriginalTitle",
+    "crossref_titles": "crossref.title",
+    "mag_abstract": "mag.abstract",
+    "crossref_abstract": "crossref.abstract",
+}
+
+NO_TITLE_AVAILABLE = "[NO TITLE AVAILABLE]"
+
+
+def get_field(record: Dict, path: str):
+    """Get a field of a raw record.
+
+    :param record: the record, a JSON object or a CSV row.
+    :param path: the path of the field, with dots between the names of nested fields, or the name of a CSV column.
+    :return: the value, or None when the field or one of its parents is missing.
+    """
+
+    if path in record:
+        return record[path]
+    value = record
+    for name in path.split("."):
+        if not isinstance(value, dict):
+            return None
+        value = value.get(name)
+    return value
+
+
+def clean_text(value: Optional[str], remove: Optional[str] = None):
+    """Clean a text field like create_dataset.sql: trim it, remove NUL characters and make it NULL when it is empty.
+
+    :param value: the value.
+    :param remove: a string to remove after trimming, as the [NO TITLE AVAILABLE] of Crossref titles is.
+    :return: the text, or None.
+    """
+
+    if value is None:
+        return None
+    value = str(value).strip()
+    if remove is not None:
+        value = value.replace(remove, "")
+    return value.replace("\x00", "") or None
+
+
+def transform_record(record: Dict, fields: Dict[str, str] = DEFAULT_FIELDS):
+    """Transform a raw record into input rows like create_dataset.sql.
+
+    The DOI is trimmed and upper cased. As the SQL unnests the Crossref titles, a record gets a row for each of its
+    Crossref titles and records without any Crossref titles get no rows.
+
+    :param record: the record.
+    :param fields: the paths of the fields, see DEFAULT_FIELDS.
+    :return: yield the doi, mag_title, crossref_title, mag_abstract and crossref_abstract of each row, with None for
+    NULL values.
+    """
+
+    doi = get_field(record, fields["doi"])
+    doi = None if doi is None else str(doi).strip().upper()
+    mag_title = clean_text(get_field(record, fields["mag_title"]))
+    mag_abstract = clean_text(get_field(record, fields["mag_abstract"]))
+    crossref_abstract = clean_text(get_field(record, fields["crossref_abstract"]))
+
+    titles = get_field(record, fields["crossref_titles"])
+    if titles is None:
+        titles = []
+    elif not isinstance(titles, list):
+        titles = [titles]
+    for title in titles:
+        yield [doi, mag_title, clean_text(title, NO_TITLE_AVAILABLE), mag_abstract, crossref_abstract]
+
+
+def read_records(path: str):
+    """Read the records of a raw dump file: JSON lines, or a CSV file with a header, which can be gzip or zstd
+    compressed.
+
+    :param path: the path to the file, which ends with .jsonl or .csv before any compression extension.
+    :return: yield each record to conserve memory.
+    """
+
+    with io.TextIOWrapper(open_input(path), encoding="utf-8", newline="") as f:
+        if ".csv" in os.path.basename(path):
+            yield from csv.DictReader(f)
+        else:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def shard_file_name(worker: int, shard: int):
+    """The name of a shard, which sorts like the names of the files exported from BigQuery, e.g. 000100000002.csv.gz.
+
+    :param worker: the number of the worker that wrote the shard.
+    :param shard: the number of the shard of the worker.
+    :return: the file name.
+    """
+
+    return f"{worker:04d}{shard:08d}.csv.gz"
+
+
+def balance_files(paths: List[str], num_workers: int):
+    """Assign dump files to workers so that each worker reads about the same number of bytes, largest files first.
+
+    :param paths: the paths to the files.
+    :param num_workers: the number of workers.
+    :return: the paths of the files of each worker, leaving out workers without files.
+    """
+
+    assigned = [[] for _ in range(num_workers)]
+    sizes = [0] * num_workers
+    for path in sorted(paths, key=lambda p: (-os.path.getsize(p), p)):
+        worker = sizes.index(min(sizes))
+        assigned[worker].append(path)
+        sizes[worker] += os.path.getsize(path)
+    return [paths for paths in assigned if paths]
+
+
+def write_shards(
+    rows: Iterable[List], output_path: str, worker: int, shard_size: int, compression_level: Optional[int] = None
+):
+    """Write input rows to shards of about the same size, starting a new shard when the rows written to the current
+    one reach shard_size bytes and the next row is of another DOI.
+
+    :param rows: the rows.
+    :param output_path: the folder to write the shards to.
+    :param worker: the number of the worker, which is the prefix of its shard names.
+    :param shard_size: the uncompressed size of each shard in bytes.
+    :param compression_level: the gzip compression level.
+    :return: the number of rows written and the names of the shards.
+    """
+
+    shards, shard, shard_bytes, num_rows, last_doi = [], None, 0, 0, None
+
+    # Each shard is written to a temporary file and renamed when it is closed, so that an interrupted ingest never
+    # leaves a truncated archive that predict-language would read
+    def close_shard():
+        shard.close()
+        shard_path = os.path.join(output_path, shards[-1])
+        os.replace(f"{shard_path}.tmp", shard_path)
+
+    for row in rows:
+        # The rows of a DOI, one for each of its Crossref titles, are kept in the same shard
+        if shard is not None and shard_bytes >= shard_size and row[0] != last_doi:
+            close_shard()
+            shard = None
+        if shard is None:
+            name = shard_file_name(worker, len(shards))
+            shard = CsvWriter(os.path.join(output_path, f"{name}.tmp"), level=compression_level, columns=INPUT_COLUMNS)
+            shards.append(name)
+            shard_bytes = 0
+
+        shard.write_rows([row])
+        # The size of the row without quoting, which is close enough to balance the shards
+        shard_bytes += sum(len(value.encode("utf-8")) for value in row if value is not None) + len(row)
+        num_rows += 1
+        last_doi = row[0]
+
+    if shard is not None:
+        close_shard()
+    return num_rows, shards
+
+
+def ingest_files(
+    paths: List[str],
+    output_path: str,
+    worker: int,
+    shard_size: int,
+    fields: Dict[str, str] = DEFAULT_FIELDS,
+    compression_level: Optional[int] = None,
+):
+    """Transform the records of dump files and write them to shards.
+
+    :param paths: the paths to the dump files.
+    :param output_path: the folder to write the shards to.
+    :param worker: the number of the worker, which is the prefix of its shard names.
+    :param shard_size: the uncompressed size of each shard in bytes.
+    :param fields: the paths of the fields of the records.
+    :param compression_level: the gzip compression level.
+    :return: a dictionary with the number of records and rows and the names of the shards.
+    """
+
+    num_records = 0
+
+    def transform():
+        nonlocal num_records
+        for path in paths:
+            for record in read_records(path):
+                num_records += 1
+                yield from transform_record(record, fields)
+
+    num_rows, shards = write_shards(transform(), output_path, worker, shard_size, compression_level)
+    return {"worker": worker, "records": num_records, "rows": num_rows, "shards": shards}
+
+
+def _ingest_files_worker(args):
+    return ingest_files(*args)
+
+
+def parse_fields(options: Iterable[str]):
+    """Parse --field options, such as doi=DOI, into the paths of the fields of the records.
+
+    :param options: the options.
+    :return: DEFAULT_FIELDS with the given paths replaced.
+    """
+
+    fields = dict(DEFAULT_FIELDS)
+    for option in options:
+        name, sep, path = option.partition("=")
+        if not sep or name not in fields:
+            raise click.BadParameter(f"expected one of {', '.join(fields)}=<path>, got {option}", param_hint="--field")
+        fields[name] = path
+    return fields
+
+
+@click.command()
+@click.argument("dump-path", type=click.Path(exists=True, file_okay=False, dir_okay=True))
+@click.argument("output-path", type=click.Path(exists=True, file_okay=False, dir_okay=True))
+@click.option(
+    "--file-pattern",
+    type=click.STRING,
+    default="*.jsonl*",
+    help="The file pattern of the dump files: JSON lines or CSV files, optionally gzip or zstd compressed",
+)
+@click.option(
+    "--field",
+    "field_options",
+    type=click.STRING,
+    multiple=True,
+    help="The path of a field of the records, e.g. doi=DOI or crossref_titles=title for Crossref metadata, "
+    "defaults to the columns of the doi table",
+)
+@click.option("--shard-size", type=click.FLOAT, default=256, help="The uncompressed size of each shard in megabytes")
+@click.option(
+    "--num-workers", type=click.INT, default=os.cpu_count(), help="The number of processes that read dump files"
+)
+@click.option("--compression-level", type=click.IntRange(1, 9), default=None, help="The gzip compression level")
+def main(
+    dump_path: str,
+    output_path: str,
+    file_pattern: str,
+    field_options: List[str],
+    shard_size: float,
+    num_workers: int,
+    compression_level: Optional[int],
+):
+    """Build the input archives of predict-language from raw dump files, with the transformations of
+    create_dataset.sql, instead of exporting them from BigQuery."""
+
+    paths = list_files(dump_path, file_pattern)
+    print(f"Found {len(paths)} files in {dump_path}")
+    fields = parse_fields(field_options)
+    shard_bytes = int(shard_size * 1024 * 1024)
+
+    start = time.time()
+    assigned = balance_files(paths, num_workers)
+    tasks = [
+        (files, output_path, worker, shard_bytes, fields, compression_level) for worker, files in enumerate(assigned)
+    ]
+    with multiprocessing.Pool(max(len(tasks), 1)) as pool:
+        results = []
+        for result in pool.imap_unordered(_ingest_files_worker, tasks):
+            print(
+                f"Worker {result['worker']}: records: {result['records']}, rows: {result['rows']}, "
+                f"shards: {len(result['shards'])}"
+            )
+            results.append(result)
+
+    num_rows = sum(result["rows"] for result in results)
+    num_shards = sum(len(result["shards"]) for result in results)
+    print(f"Wrote {num_rows} rows to {num_shards} shards in {time.time() - start:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+# Copyright 2022 Curtin University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import sys
+from typing import Any, Callable, Optional
+
+# The approximate memory used by an entry besides its key and value: the ordered dict node and the key tuple
+ENTRY_OVERHEAD = 160
+
+
+def value_size(value: Any):
+    """Estimate the memory used by a memoized value.
+
+    :param value: a string, number, None or a tuple of them.
+    :return: the size in bytes.
+    """
+
+    size = sys.getsizeof(value)
+    if isinstance(value, tuple):
+        size += sum(sys.getsizeof(item) for item in value)
+    return size
+
+
+class LruMemo:
+    """A memo of the results of functions of short strings, such as pre-processing a field or predicting the language
+    of a text, that evicts the least recently used results when their total size is over max_bytes.
+
+    Fields such as "Editorial" or "Front Matter" and templated abstracts are repeated many times, so their results are
+    looked up instead of computed again. Strings longer than max_key_chars are rarely repeated and are not memoized.
+    Results are memoized by kind, for example preprocess or predict, and hits and misses are counted by kind.
+    """
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024, max_key_chars: int = 256):
+        """Create an empty memo.
+
+        :param max_bytes: the maximum approximate size of the memoized keys and results in bytes.
+        :param max_key_chars: the maximum length of the strings that are memoized.
+        """
+
+        self.max_bytes = max_bytes
+        self.max_key_chars = max_key_chars
+        self.entries = collections.OrderedDict()
+        self.bytes = 0
+        self.hits = collections.Counter()
+        self.misses = collections.Counter()
+
+    def memoizable(self, key: str):
+        """Returns whether a string is short enough to be memoized.
+
+        :param key: the string.
+        :return: whether it is memoized.
+        """
+
+        return 0 < len(key) <= self.max_key_chars
+
+    def get(self, kind: str, key: str) -> Optional[Any]:
+        """Get a memoized result and mark it as recently used.
+
+        :param kind: the kind of result.
+        :param key: the string.
+        :return: the result, or None if it is not memoized.
+        """
+
+        if not self.memoizable(key):
+            return None
+        entry = self.entries.get((kind, key))
+        if entry is None:
+            self.misses[kind] += 1
+            return None
+        self.hits[kind] += 1
+        self.entries.move_to_end((kind, key))
+        return entry[0]
+
+    def put(self, kind: str, key: str, value: Any):
+        """Memoize a result, evicting the least recently used results when the memo is full.
+
+        :param kind: the kind of result.
+        :param key: the string.
+        :param value: the result, which can not be None.
+        :return: None.
+        """
+
+        if not self.memoizable(key) or (kind, key) in self.entries:
+            return
+        size = sys.getsizeof(key) + value_size(value) + ENTRY_OVERHEAD
+        self.entries[(kind, key)] = (value, size)
+        self.bytes += size
+        while self.bytes > self.max_bytes and self.entries:
+            _, (_, evicted_size) = self.entries.popitem(last=False)
+            self.bytes -= evicted_size
+
+    def call(self, kind: str, func: Callable, key: str):
+        """Get the memoized result of a function of a string, calling the function and memoizing its result if it is
+        not memoized.
+
+        :param kind: the kind of result.
+        :param func: the function.
+        :param key: the string.
+        :return: the result.
+        """
+
+        value = self.get(kind, key)
+        if value is None:
+            value = func(key)
+            self.put(kind, key, value)
+        return value
@@ -0,0 +1,388 @@
+# Copyright 2022 Curtin University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import bisect
+import csv
+import gzip
+import heapq
+import io
+import itertools
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+import zlib
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import click
+
+from analysis import OUTPUT_EXTENSIONS, read_output_rows
+from ingest import balance_files
+from predict_language import OUTPUT_COLUMNS, list_files, read_csv_gz
+
+# The sparse index of the sorted shards: the first DOI, file name and offset of each block of rows
+INDEX_FILE_NAME = "doi_index.csv"
+INDEX_COLUMNS = ["first_doi", "file", "offset"]
+
+
+def shard_file_name(shard: int):
+    """The name of a DOI sorted shard.
+
+    :param shard: the number of the shard.
+    :return: the file name.
+    """
+
+    return f"doi-{shard:05d}.csv.gz"
+
+
+def write_runs(index: int, paths: List[str], run_path: str, run_rows: int) -> Tuple[List[str], int]:
+    """Sort the rows of output files by DOI, in runs of at most run_rows rows that fit in memory. The rows of the files
+    are read one file after another, so that small files are packed into the same runs.
+
+    :param index: the number of the group of output files, which the names of its runs start with.
+    :param paths: the paths to the output files.
+    :param run_path: the folder to write the runs to.
+    :param run_rows: the maximum number of rows in each run.
+    :return: the paths of the runs and the number of rows.
+    """
+
+    rows = itertools.chain.from_iterable(read_output_rows(path, OUTPUT_COLUMNS) for path in paths)
+    runs, num_rows = [], 0
+    while True:
+        run = sorted(itertools.islice(rows, run_rows), key=lambda row: row[0] or "")
+        if not run:
+            break
+        runs.append(os.path.join(run_path, f"{index:06d}-{len(runs):05d}.csv.gz"))
+        with gzip.open(runs[-1], "wt", encoding="utf-8", newline="", compresslevel=1) as f:
+            csv.writer(f).writerows(run)
+        num_rows += len(run)
+    return runs, num_rows
+
+
+def _write_runs_worker(args):
+    return write_runs(*args)
+
+
+def choose_row(rows: List[List[str]]) -> List[str]:
+    """Choose the row of a DOI that is kept among its duplicates, which the DOI has when it has several Crossref titles.
+
+    The rule does not depend on the order of the rows: rows with a language are preferred, then higher scores, then
+    longer titles, then titles that sort last.
+
+    :param rows: the doi, title, language and score of each duplicate.
+    :return: the row that is kept.
+    """
+
+    return max(rows, key=lambda row: (row[2] != "", float(row[3]) if row[3] else -1.0, len(row[1]), row[1]))
+
+
+def merge_runs(runs: List[str]) -> Iterable[List[str]]:
+    """Merge sorted runs, keeping one row for each DOI.
+
+    :param runs: the paths of the runs, which are all open at once.
+    :return: yield the rows sorted by DOI.
+    """
+
+    merged = heapq.merge(*(read_csv_gz(run, skip_header=False) for run in runs), key=lambda row: row[0])
+    for _, rows in itertools.groupby(merged, key=lambda row: row[0]):
+        yield choose_row(list(rows))
+
+
+def merge_to_run(runs: List[str], path: str) -> str:
+    """Merge sorted runs into a single run, keeping one row for each DOI, and delete them.
+
+    :param runs: the paths of the runs.
+    :param path: the path of the merged run.
+    :return: the path of the merged run.
+    """
+
+    with gzip.open(path, "wt", encoding="utf-8", newline="", compresslevel=1) as f:
+        csv.writer(f).writerows(merge_runs(runs))
+    for run in runs:
+        os.remove(run)
+    return path
+
+
+def _merge_to_run_worker(args):
+    return merge_to_run(*args)
+
+
+def reduce_runs(runs: List[str], run_path: str, fan_in: int, pool) -> List[str]:
+    """Merge runs in passes, fan_in runs at a time, until there are at most fan_in runs left, so that no more than
+    fan_in runs are open at once by any process.
+
+    Choosing a row for each DOI in the passes gives the same rows as choosing them in the final merge, because
+    choose_row does not depend on the order or grouping of the duplicates.
+
+    :param runs: the paths of the runs.
+    :param run_path: the folder to write the merged runs to.
+    :param fan_in: the maximum number of runs merged at once.
+    :param pool: the multiprocessing pool that merges the runs of a pass in parallel.
+    :return: the paths of the remaining runs.
+    """
+
+    merge_pass = 0
+    while len(runs) > fan_in:
+        merge_pass += 1
+        tasks = [
+            (runs[i : i + fan_in], os.path.join(run_path, f"pass{merge_pass:02d}-{i // fan_in:06d}.csv.gz"))
+            for i in range(0, len(runs), fan_in)
+        ]
+        runs = pool.map(_merge_to_run_worker, tasks)
+    return runs
+
+
+def gzip_member(rows: List[List[str]], level: int) -> bytes:
+    """Compress rows as a gzip member, which can be decompressed on its own or as part of the file it is in.
+
+    :param rows: the rows.
+    :param level: the compression level.
+    :return: the compressed rows.
+    """
+
+    text = io.StringIO()
+    csv.writer(text).writerows(rows)
+    return gzip.compress(text.getvalue().encode("utf-8"), compresslevel=level, mtime=0)
+
+
+def write_sorted_shards(
+    rows: Iterable[List[str]], output_path: str, shard_rows: int, block_rows: int, level: int = 6
+) -> Dict:
+    """Write DOI sorted rows to shards, each block of block_rows rows as a separate gzip member, and index the first
+    DOI and offset of each block.
+
+    The shards are still regular .csv.gz files with a header, and a lookup decompresses only the block of its DOI.
+
+    :param rows: the rows, sorted by DOI.
+    :param output_path: the folder to write the shards and the index to.
+    :param shard_rows: the number of rows in each shard.
+    :param block_rows: the number of rows in each block.
+    :param level: the compression level.
+    :return: the number of rows, shards and blocks.
+    """
+
+    num_rows, num_shards, num_blocks = 0, 0, 0
+    f = None
+
+    # The shards and the index are written to temporary files and renamed when they are closed, the index last, so that
+    # an interrupted merge never leaves a truncated shard or an index of missing shards
+    def close_shard():
+        f.close()
+        shard_path = os.path.join(output_path, name)
+        os.replace(f"{shard_path}.tmp", shard_path)
+
+    index_path = os.path.join(output_path, INDEX_FILE_NAME)
+    with open(f"{index_path}.tmp", "w", encoding="utf-8", newline="") as index_file:
+        index = csv.writer(index_file)
+        index.writerow(INDEX_COLUMNS)
+        while True:
+            block = list(itertools.islice(rows, block_rows))
+            if not block:
+                break
+            if f is None:
+                name = shard_file_name(num_shards)
+                f = open(os.path.join(output_path, f"{name}.tmp"), "wb")
+                f.write(gzip_member([OUTPUT_COLUMNS], level))
+                num_shards += 1
+                shard_row_count = 0
+
+            index.writerow([block[0][0], name, f.tell()])
+            f.write(gzip_member(block, level))
+            num_blocks += 1
+            num_rows += len(block)
+            shard_row_count += len(block)
+            if shard_row_count >= shard_rows:
+                close_shard()
+                f = None
+
+        if f is not None:
+            close_shard()
+    os.replace(f"{index_path}.tmp", index_path)
+    return {"rows": num_rows, "shards": num_shards, "blocks": num_blocks}
+
+
+def merge_output(
+    paths: List[str],
+    output_path: str,
+    run_rows: int = 1000000,
+    shard_rows: int = 5000000,
+    block_rows: int = 1000,
+    num_workers: Optional[int] = None,
+    level: int = 6,
+    fan_in: int = 256,
+) -> Dict:
+    """Merge output files of predict-language into DOI sorted and deduplicated shards with a sparse index.
+
+    The output files are split into groups of about the same size, whose rows are sorted in runs that fit in memory by
+    a pool of processes. The runs are then merged with k-way merges that keep one row of each run in memory, in as
+    many passes as it takes to merge at most fan_in runs at once.
+
+    :param paths: the paths to the output files.
+    :param output_path: the folder to write the shards and the index to.
+    :param run_rows: the maximum number of rows sorted in memory at once by each process.
+    :param shard_rows: the number of rows in each shard.
+    :param block_rows: the number of rows in each indexed block.
+    :param num_workers: the number of processes that sort and merge runs, defaults to the number of CPUs.
+    :param level: the compression level of the shards.
+    :param fan_in: the maximum number of runs that are merged at once, which each need an open file.
+    :return: the number of input rows, output rows, shards and blocks.
+    """
+
+    num_workers = num_workers or os.cpu_count()
+    run_path = tempfile.mkdtemp(prefix="runs-", dir=output_path)
+    try:
+        runs, num_input_rows = [], 0
+        with multiprocessing.Pool(num_workers) as pool:
+            tasks = [
+                (index, group, run_path, run_rows) for index, group in enumerate(balance_files(paths, num_workers))
+            ]
+            for group_runs, num_rows in pool.imap_unordered(_write_runs_worker, tasks):
+                runs.extend(group_runs)
+                num_input_rows += num_rows
+            runs = reduce_runs(sorted(runs), run_path, fan_in, pool)
+
+        result = write_sorted_shards(merge_runs(runs), output_path, shard_rows, block_rows, level)
+    finally:
+        shutil.rmtree(run_path)
+    return {"input_rows": num_input_rows, **result}
+
+
+class DoiIndex:
+    """Looks up the rows of DOIs in DOI sorted shards, reading only the block of rows that each DOI is in."""
+
+    def __init__(self, path: str):
+        """Load the sparse index.
+
+        :param path: the folder of the shards and the index.
+        """
+
+        self.path = path
+        self.first_dois, self.files, self.offsets = [], [], []
+        with open(os.path.join(path, INDEX_FILE_NAME), encoding="utf-8", newline="") as f:
+            reader = csv.reader(f)
+            next(reader)
+            for first_doi, file_name, offset in reader:
+                self.first_dois.append(first_doi)
+                self.files.append(file_name)
+                self.offsets.append(int(offset))
+
+    def read_block(self, i: int) -> List[List[str]]:
+        """Read a block of rows.
+
+        :param i: the number of the block in the index.
+        :return: the rows.
+        """
+
+        decompressor = zlib.decompressobj(wbits=31)
+        data = []
+        with open(os.path.join(self.path, self.files[i]), "rb") as f:
+            f.seek(self.offsets[i])
+            while not decompressor.eof:
+                chunk = f.read(64 * 1024)
+                if not chunk:
+                    break
+                data.append(decompressor.decompress(chunk))
+        return list(csv.reader(io.StringIO(b"".join(data).decode("utf-8"), newline="")))
+
+    def lookup(self, doi: str) -> Optional[Dict]:
+        """Look up a DOI.
+
+        :param doi: the DOI, in any case.
+        :return: the doi, title, language and score, or None when the DOI is not in the shards.
+        """
+
+        doi = doi.strip().upper()
+        i = bisect.bisect_right(self.first_dois, doi) - 1
+        if i < 0:
+            return None
+        for row in self.read_block(i):
+            if row[0] == doi:
+                result = dict(zip(OUTPUT_COLUMNS, [value or None for value in row]))
+                if result["score"] is not None:
+                    result["score"] = float(result["score"])
+                return result
+        return None
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command("merge")
+@click.argument("input-path", type=click.Path(exists=True, file_okay=False, dir_okay=True))
+@click.argument("output-path", type=click.Path(exists=True, file_okay=False, dir_okay=True))
+@click.option("--run-rows", type=click.INT, default=1000000, help="The number of rows sorted in memory by a process")
+@click.option("--shard-rows", type=click.INT, default=5000000, help="The number of rows in each sorted shard")
+@click.option(
+    "--block-rows",
+    type=click.INT,
+    default=1000,
+    help="The number of rows in each block of the index, which a lookup decompresses",
+)
+@click.option(
+    "--num-workers",
+    type=click.INT,
+    default=os.cpu_count(),
+    help="The number of processes that sort output files and merge runs",
+)
+@click.option(
+    "--fan-in",
+    type=click.IntRange(min=2),
+    default=256,
+    help="The maximum number of runs merged at once, which should be well below the open file limit (ulimit -n)",
+)
+@click.option("--compression-level", type=click.IntRange(1, 9), default=6, help="The gzip compression level")
+def merge_cmd(
+    input_path: str,
+    output_path: str,
+    run_rows: int,
+    shard_rows: int,
+    block_rows: int,
+    num_workers: int,
+    compression_level: int,
+    fan_in: int,
+):
+    """Merge the output files of predict-language into DOI sorted shards, with one row for each DOI, and index them."""
+
+    paths = sorted(path for path in list_files(input_path, "*") if path.endswith(OUTPUT_EXTENSIONS))
+    print(f"Found {len(paths)} output files in {input_path}")
+    start = time.time()
+    result = merge_output(
+        paths, output_path, run_rows, shard_rows, block_rows, num_workers, compression_level, fan_in=fan_in
+    )
+    print(
+        f"Merged {result['input_rows']} rows into {result['rows']} DOIs in {result['shards']} shards with "
+        f"{result['blocks']} indexed blocks in {time.time() - start:.2f}s"
+    )
+
+
+@cli.command("lookup")
+@click.argument("sorted-path", type=click.Path(exists=True, file_okay=False, dir_okay=True))
+@click.argument("dois", nargs=-1)
+def lookup_cmd(sorted_path: str, dois: List[str]):
+    """Look up the language of DOIs in sorted shards."""
+
+    index = DoiIndex(sorted_path)
+    for doi in dois:
+        row = index.lookup(doi)
+        if row is None:
+            print(f"{doi}: not found")
+        else:
+            print(f"{row['doi']}: language: {row['language']}, score: {row['score']}, title: {row['title']}")
+
+
+if __name__ == "__main__":
+    cli()
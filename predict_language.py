@@ -12,23 +12,83 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import collections
 import csv
+import datetime
 import glob
-import gzip
+import hashlib
 import html
 import io
+import itertools
+import json
 import logging
+import math
+import multiprocessing
 import os
 import os.path
+import queue
 import re
 import sys
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional, Tuple
 
 import click
-import fasttext
-import ray
-import validators
 from bs4 import BeautifulSoup
 
+from compression import CHUNK_SIZE, COMPRESSIONS, open_input, open_output_file
+from engines import ENGINES, LanguageEngine, load_engine
+from memo import LruMemo
+from prediction_cache import PredictionCache, compact_cache, fields_key
+
+DEFAULT_MODEL_PATH = os.path.join(os.path.expanduser("~"), ".fasttext/lid.176.bin")
+MANIFEST_FILE_NAME = "manifest.jsonl"
+METRICS_FILE_NAME = "metrics.jsonl"
+INDEX_FOLDER = "index"
+UNCERTAIN_FOLDER = "uncertain"
+OUTPUT_SCHEMA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "doi_language_schema.json")
+
+# The stages of process_archive that are timed
+STAGES = ["read", "preprocess", "predict", "write"]
+
+# The kinds of results that are memoized, see LruMemo
+MEMO_KINDS = ["preprocess", "predict"]
+
+# The metrics of each archive that are summed over a run
+METRICS = (
+    ["seconds", "rows", "empty_rows", "uncertain_rows", "cache_hits", "cache_misses"]
+    + [f"{stage}_seconds" for stage in STAGES]
+    + [f"{kind}_memo_{count}" for kind in MEMO_KINDS for count in ["hits", "misses"]]
+)
+
+# The output formats and their file extensions
+OUTPUT_FORMATS = {"csv": ".csv.gz", "parquet": ".parquet", "arrow": ".arrow"}
+
+# The columns of the output files
+OUTPUT_COLUMNS = ["doi", "title", "language", "score"]
+
+# The column that is added to the output files when more than one language is predicted per row
+LANGUAGES_FIELD = {
+    "name": "languages",
+    "type": "STRING",
+    "mode": "NULLABLE",
+    "description": "The most probable languages and their probability scores, for example en:0.8731;de:0.1012",
+}
+
+# The columns of the uncertain output files: the output columns, the languages, the separate predictions for the title
+# and abstract, and the text that was classified
+UNCERTAIN_COLUMNS = OUTPUT_COLUMNS + [
+    "languages",
+    "title_language",
+    "title_score",
+    "abstract_language",
+    "abstract_score",
+    "text",
+]
+
+# The number of rows between the record offsets saved in an archive index
+INDEX_INTERVAL = 10000
+
 
 def list_files(path: str, pattern: str):
     """List files in a directory.
@@ -41,32 +101,544 @@ def list_files(path: str, pattern: str):
     return glob.glob(os.path.join(path, pattern))
 
 
-def read_csv_gz(path: str, skip_header: bool = True):
+def read_csv_gz(
+    path: str,
+    skip_header: bool = True,
+    threaded: bool = False,
+    start_offset: int = 0,
+    num_rows: Optional[int] = None,
+):
     """Read a gzipped CSV file.
 
     :param path: the path to the csv.gz file.
-    :param skip_header: whether to skip the header or not.
+    :param skip_header: whether to skip the header or not, when reading from the start of the file.
+    :param threaded: whether to decompress the file in a background thread.
+    :param start_offset: the offset in the decompressed file of the first row to read, see build_index.
+    :param num_rows: the maximum number of rows to read, by default all of the rows until the end of the file are read.
     :return: yield each row to conserve memory.
     """
 
-    with gzip.open(path, "r") as f:
-        reader = csv.reader(io.TextIOWrapper(f, newline=""))
-        if skip_header:
+    with open_input(path, threaded=threaded) as f:
+        skip_bytes(f, start_offset)
+        reader = csv.reader(io.TextIOWrapper(f, encoding="utf-8", newline=""))
+        if skip_header and start_offset == 0:
             next(reader, None)
-        for row in reader:
-            yield row
+        yield from itertools.islice(reader, num_rows)
+
+
+def skip_bytes(f, n: int):
+    """Skip bytes of a file that can not seek, such as the output of a decompressor.
+
+    :param f: the binary file object.
+    :param n: the number of bytes to skip.
+    :return: None.
+    """
+
+    while n > 0:
+        chunk = f.read(min(n, CHUNK_SIZE))
+        if not chunk:
+            raise EOFError(f"Unexpected end of file, {n} bytes short")
+        n -= len(chunk)
+
+
+def build_index(csv_path: str, interval: int = INDEX_INTERVAL):
+    """Scan a gzipped CSV file once and record the offset in the decompressed file of every interval-th row.
+
+    A line ends a record when the record has an even number of quote characters so far, because quotes inside quoted
+    fields are escaped by doubling them, so records with newlines in quoted fields are handled without parsing them.
+
+    :param csv_path: the path to the csv.gz file.
+    :param interval: the number of rows between the saved offsets.
+    :return: a dictionary with the size and modification time of the file, the interval, the number of rows, excluding
+    the header, and the offsets of rows 0, interval, 2 * interval and so on.
+    """
+
+    stat = os.stat(csv_path)
+    offsets = []
+    rows = -1
+    offset = 0
+    quotes = 0
+    with open_input(csv_path) as f:
+        for line in f:
+            offset += len(line)
+            quotes += line.count(b'"')
+            if quotes % 2 == 0:
+                quotes = 0
+                rows += 1
+                if rows % interval == 0:
+                    offsets.append(offset)
+
+    # The offset recorded after the last row is the end of the file
+    if rows >= 0 and rows % interval == 0:
+        offsets.pop()
+    return dict(
+        input_size=stat.st_size,
+        input_mtime=stat.st_mtime,
+        interval=interval,
+        rows=max(rows, 0),
+        offsets=offsets,
+    )
+
+
+def load_index(csv_path: str, index_path: str, interval: int = INDEX_INTERVAL):
+    """Load the index of a gzipped CSV file, building and saving it if it does not exist or the file has changed.
+
+    :param csv_path: the path to the csv.gz file.
+    :param index_path: the folder that indexes are saved in.
+    :param interval: the number of rows between the saved offsets.
+    :return: the index, see build_index.
+    """
+
+    stat = os.stat(csv_path)
+    index_file_path = os.path.join(index_path, f"{os.path.basename(csv_path)}.json")
+    if os.path.isfile(index_file_path):
+        with open(index_file_path) as f:
+            index = json.load(f)
+        if (index["input_size"], index["input_mtime"], index["interval"]) == (stat.st_size, stat.st_mtime, interval):
+            return index
+
+    print(f"Indexing: {csv_path}")
+    index = build_index(csv_path, interval)
+    os.makedirs(index_path, exist_ok=True)
+    with open(f"{index_file_path}.tmp", "w") as f:
+        json.dump(index, f)
+    os.replace(f"{index_file_path}.tmp", index_file_path)
+    return index
+
+
+class WorkUnit(NamedTuple):
+    """An archive, or a range of the rows of an archive, that is processed by one worker.
+
+    The rows of a part start at start_offset in the decompressed archive and its output is written to a numbered part
+    file. size is the compressed size of the archive, or an estimate of the compressed size of the part.
+    """
+
+    csv_path: str
+    size: int
+    part: Optional[int] = None
+    start_offset: int = 0
+    num_rows: Optional[int] = None
+
+    @property
+    def options(self):
+        """The options for process_archive that select the rows of the unit."""
+
+        return dict(part=self.part, start_offset=self.start_offset, num_rows=self.num_rows)
+
+
+def plan_work_units(
+    csv_paths: List[str], index_path: str, max_unit_size: Optional[int] = None, interval: int = INDEX_INTERVAL
+):
+    """Split archives that are larger than max_unit_size into parts with the same number of rows, so that the largest
+    archives do not keep one worker busy long after the others have finished.
+
+    :param csv_paths: the archives.
+    :param index_path: the folder that the indexes of the split archives are saved in.
+    :param max_unit_size: the maximum compressed size of a work unit in bytes, by default archives are not split.
+    :param interval: the number of rows between the offsets saved in the indexes, parts are split on these rows.
+    :return: the work units, largest first.
+    """
+
+    units = []
+    for csv_path in csv_paths:
+        size = os.path.getsize(csv_path)
+        if max_unit_size is None or size <= max_unit_size:
+            units.append(WorkUnit(csv_path, size))
+            continue
+
+        # Split on the indexed rows, so that each part can skip straight to its first row
+        index = load_index(csv_path, index_path, interval)
+        interval, rows, offsets = index["interval"], index["rows"], index["offsets"]
+        num_parts = min(math.ceil(size / max_unit_size), len(offsets))
+        if num_parts <= 1:
+            units.append(WorkUnit(csv_path, size))
+            continue
+        starts = sorted({round(i * len(offsets) / num_parts) for i in range(num_parts)})
+        for part, (start, end) in enumerate(zip(starts, starts[1:] + [len(offsets)])):
+            num_rows = min(end * interval, rows) - start * interval
+            units.append(WorkUnit(csv_path, size * num_rows // max(rows, 1), part, offsets[start], num_rows))
+
+    return sorted(units, key=lambda unit: unit.size, reverse=True)
+
+
+# An HTML or XML start, end or self-closing tag, with optional quoted or unquoted attributes
+TAG_PATTERN = re.compile(
+    r"""</?[A-Za-z][^\t\n\r\f />\x00]*(?:(?:\s|/(?!>))+[^\s"'<>/=]+(?:\s*=\s*(?:"[^"]*"|'[^']*'|[^\s"'=<>`]+))?)*\s*/?>"""
+)
+
+# Elements whose content html.parser treats as raw text or that BeautifulSoup leaves out of get_text()
+RAW_TEXT_TAG_PATTERN = re.compile(r"<(?:script|style|template|title|textarea)\b", re.IGNORECASE)
+
+
+# A Crossref DOI, see here for explanation: https://www.crossref.org/blog/dois-and-matching-regular-expressions/
+DOI_REGEX = r"10.\d{4,9}/[-._;()/:A-Z0-9]+"
+
+# A whole-string URL with a scheme, a domain name with a top level domain or an IPv4 address, and no whitespace
+URL_REGEX = (
+    r"(?:https?|ftps?|sftp|git|ssh|irc|rtmps?|rtsp|telnet)://"
+    r"(?:[^\s/?#@]+@)?"
+    r"(?:(?:[^\W_](?:[^\W_]|-)*(?<!-)\.)+[^\W\d_]{2,}|\d{1,3}(?:\.\d{1,3}){3})"
+    r"(?::\d{1,5})?"
+    r"(?:[/?#]\S*)?"
+)
+
+# A placeholder that Crossref uses when a work has no title
+NO_TITLE_REGEX = r"\[NO TITLE AVAILABLE\]"
+
+DOI_PATTERN = re.compile(DOI_REGEX, re.IGNORECASE)
+
+# Matches fields that contain no natural language at all: a DOI, a URL or a placeholder
+JUNK_PATTERN = re.compile(f"{NO_TITLE_REGEX}|(?i:{DOI_REGEX}|{URL_REGEX})")
+
+
+def output_file_name(csv_path: str, output_format: str = "csv", compression: str = "gzip", part: Optional[int] = None):
+    """Get the name of the output file for an archive.
+
+    :param csv_path: the path to the input archive.
+    :param output_format: the output format, one of OUTPUT_FORMATS.
+    :param compression: the compression of CSV files, one of COMPRESSIONS.
+    :param part: the part number, when the archive is split into parts.
+    :return: the file name.
+    """
+
+    name = os.path.basename(csv_path)
+    if output_format == "csv" and compression == "gzip" and part is None:
+        return name
+    for suffix in [".csv.gz", ".csv"]:
+        if name.endswith(suffix):
+            name = name[: -len(suffix)]
+            break
+    if part is not None:
+        name = f"{name}-{part:05d}"
+    if output_format == "csv":
+        return f"{name}.csv{COMPRESSIONS[compression]}"
+    return f"{name}{OUTPUT_FORMATS[output_format]}"
+
+
+def load_output_schema(with_languages: bool = False):
+    """Load the schema of the doi_language table, doi_language_schema.json, as an Arrow schema.
+
+    :param with_languages: whether to add the languages column, see LANGUAGES_FIELD.
+    :return: the schema.
+    """
+
+    import pyarrow as pa
+
+    types = {"STRING": pa.string(), "FLOAT": pa.float64()}
+    with open(OUTPUT_SCHEMA_PATH) as f:
+        fields = json.load(f)
+    if with_languages:
+        fields.append(LANGUAGES_FIELD)
+    return pa.schema(
+        [pa.field(field["name"], types[field["type"]], nullable=field["mode"] == "NULLABLE") for field in fields]
+    )
+
+
+class CsvWriter:
+    """Writes output rows to a compressed CSV file."""
+
+    def __init__(
+        self,
+        path: str,
+        compression: str = "gzip",
+        level: Optional[int] = None,
+        threaded: bool = False,
+        columns: List[str] = OUTPUT_COLUMNS,
+    ):
+        """Open the file and write the header.
+
+        :param path: the path to the file.
+        :param compression: gzip or zstd.
+        :param level: the compression level.
+        :param threaded: whether to compress in a background thread.
+        :param columns: the names of the columns.
+        """
+
+        self.file = io.TextIOWrapper(
+            open_output_file(path, compression=compression, level=level, threaded=threaded),
+            encoding="utf-8",
+            newline="",
+        )
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(columns)
+
+    def write_rows(self, rows: List[Tuple]):
+        """Write rows.
+
+        :param rows: the values of the columns of each row.
+        :return: None.
+        """
+
+        self.writer.writerows(rows)
+
+    def close(self):
+        self.file.close()
+
+
+class ArrowWriter:
+    """Writes output rows to a Parquet file compressed with zstd or an Arrow IPC file, with the column types of
+    doi_language_schema.json.
+
+    Rows are buffered and written a row group at a time, so that memory stays bounded.
+    """
+
+    def __init__(self, path: str, output_format: str, row_group_size: int = 100000, with_languages: bool = False):
+        """Open the file.
+
+        :param path: the path to the file.
+        :param output_format: parquet or arrow.
+        :param row_group_size: the number of rows in each row group or record batch.
+        :param with_languages: whether to add the languages column, see LANGUAGES_FIELD.
+        """
+
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        self.pa = pa
+        self.schema = load_output_schema(with_languages)
+        self.row_group_size = row_group_size
+        self.rows = []
+        if output_format == "parquet":
+            self.writer = pq.ParquetWriter(path, self.schema, compression="zstd")
+        else:
+            self.writer = pa.ipc.new_file(path, self.schema, options=pa.ipc.IpcWriteOptions(compression="zstd"))
+
+    def write_rows(self, rows: List[Tuple]):
+        """Write rows.
+
+        :param rows: the doi, title, language and score of each row, and the languages when they are included.
+        :return: None.
+        """
+
+        self.rows.extend(rows)
+        if len(self.rows) >= self.row_group_size:
+            self.flush()
+
+    def flush(self):
+        """Write the buffered rows as a row group.
+
+        :return: None.
+        """
+
+        if not self.rows:
+            return
+        columns = list(zip(*self.rows))
+        table = self.pa.Table.from_arrays(
+            [self.pa.array(column, type=field.type) for column, field in zip(columns, self.schema)], schema=self.schema
+        )
+        self.writer.write_table(table)
+        self.rows = []
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+
+def open_output(
+    path: str,
+    output_format: str = "csv",
+    compression: str = "gzip",
+    compression_level: Optional[int] = None,
+    threaded: bool = False,
+    with_languages: bool = False,
+):
+    """Open an output file.
+
+    :param path: the path to the file.
+    :param output_format: the output format, one of OUTPUT_FORMATS.
+    :param compression: the compression of CSV files, one of COMPRESSIONS.
+    :param compression_level: the compression level of CSV files.
+    :param threaded: whether to compress CSV files in a background thread.
+    :param with_languages: whether to add the languages column, see LANGUAGES_FIELD.
+    :return: a writer with write_rows and close methods.
+    """
+
+    if output_format == "csv":
+        columns = OUTPUT_COLUMNS + [LANGUAGES_FIELD["name"]] if with_languages else OUTPUT_COLUMNS
+        return CsvWriter(path, compression=compression, level=compression_level, threaded=threaded, columns=columns)
+    return ArrowWriter(path, output_format, with_languages=with_languages)
+
+
+def sha256_file(path: str, chunk_size: int = 1024 * 1024):
+    """Calculate the SHA-256 checksum of a file.
+
+    :param path: the path to the file.
+    :param chunk_size: the number of bytes to read at a time.
+    :return: the hex digest.
+    """
+
+    checksum = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            checksum.update(chunk)
+    return checksum.hexdigest()
+
+
+def unit_name(csv_path: str, part: Optional[int] = None):
+    """Get the name of an archive, or a part of one, used to identify it in the manifest and the prediction cache.
+
+    :param csv_path: the path to the archive.
+    :param part: the part number, when the archive is split into parts.
+    :return: the name.
+    """
+
+    name = os.path.basename(csv_path)
+    if part is not None:
+        name = f"{name}.{part:05d}"
+    return name
+
+
+class RunManifest:
+    """A record of the archives that have been completed in an output directory, saved as JSON lines.
+
+    An entry is appended, flushed and synced to disk as soon as an archive is finished, so that a run that crashes can
+    be restarted and skip the archives that were already completed.
+    """
+
+    def __init__(self, path: str):
+        """Load the manifest if it exists.
+
+        :param path: the path to the manifest file.
+        """
+
+        self.path = path
+        self.entries = {}
+        if os.path.isfile(path):
+            valid_size = 0
+            with open(path, "rb") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        break
+                    if not line.endswith(b"\n"):
+                        break
+                    self.entries[unit_name(entry["name"], entry.get("part"))] = entry
+                    valid_size += len(line)
+
+            # The last line can be partially written when a run crashes, remove it so that new entries can be appended
+            if valid_size < os.path.getsize(path):
+                with open(path, "r+b") as f:
+                    f.truncate(valid_size)
+
+    def is_complete(
+        self,
+        csv_path: str,
+        output_file_path: str,
+        part: Optional[int] = None,
+        start_offset: int = 0,
+        num_rows: Optional[int] = None,
+        options: Optional[Dict] = None,
+        uncertain_file_path: Optional[str] = None,
+    ):
+        """Returns whether an archive, or a part of one, was completed in a previous run with the same output options
+        and has not changed since.
+
+        :param csv_path: the path to the input archive.
+        :param output_file_path: the path to the output file.
+        :param part: the part number, when the archive is split into parts.
+        :param start_offset: the offset of the first row of the part in the decompressed archive.
+        :param num_rows: the number of rows in the part.
+        :param options: the options of this run that change the output files, an archive completed with other options
+        is not complete.
+        :param uncertain_file_path: the path to the uncertain output file, when the run writes one.
+        :return: whether the archive or part is complete.
+        """
+
+        entry = self.entries.get(unit_name(csv_path, part))
+        if entry is None or not os.path.isfile(output_file_path):
+            return False
+        if uncertain_file_path is not None and not os.path.isfile(uncertain_file_path):
+            return False
+        if options is not None and any(entry.get(key) != value for key, value in options.items()):
+            return False
+        stat = os.stat(csv_path)
+        return (
+            entry["input_size"] == stat.st_size
+            and entry["input_mtime"] == stat.st_mtime
+            and entry["output_size"] == os.path.getsize(output_file_path)
+            and entry.get("start_offset", 0) == start_offset
+            and (num_rows is None or entry["rows"] == num_rows)
+        )
+
+    def add(self, result: Dict, options: Optional[Dict] = None):
+        """Record a completed archive.
+
+        :param result: the results returned by process_archive.
+        :param options: the options that change the output files that the archive was completed with.
+        :return: None.
+        """
+
+        entry = dict(
+            name=os.path.basename(result["csv_path"]),
+            input_size=result["input_size"],
+            input_mtime=result["input_mtime"],
+            rows=result["rows"],
+            output_size=result["output_size"],
+            sha256=result["sha256"],
+        )
+        if result.get("part") is not None:
+            entry.update(part=result["part"], start_offset=result["start_offset"])
+        if options is not None:
+            entry.update(options)
+        with open(self.path, "a") as f:
+            f.write(json.dumps(entry) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self.entries[unit_name(entry["name"], entry.get("part"))] = entry
 
 
 def is_doi(text: str):
     """Returns whether the text is a Crossref DOI or not.
 
-    See here for explanation: https://www.crossref.org/blog/dois-and-matching-regular-expressions/
-
     :param text: the text.
     :return: whether the text is a Crossref DOI or not.
     """
 
-    return re.match(r"^10.\d{4,9}/[-._;()/:A-Z0-9]+$", text, re.IGNORECASE) is not None
+    return DOI_PATTERN.fullmatch(text) is not None
+
+
+def is_junk(text: str):
+    """Returns whether the text is a DOI, a URL or the [NO TITLE AVAILABLE] placeholder, checked in a single pass.
+
+    :param text: the stripped text.
+    :return: whether the text should be thrown away.
+    """
+
+    return JUNK_PATTERN.fullmatch(text) is not None
+
+
+def strip_html(text: str):
+    """Unescape HTML entities and strip HTML and XML markup from the text.
+
+    Most titles and abstracts contain no markup at all, so the text is checked in tiers and BeautifulSoup is only used
+    for markup that the tag regex cannot remove with the same result:
+    1. Text without "<" or "&" is returned unchanged.
+    2. Text that has no "<" or "&" after unescaping entities is returned.
+    3. Simple tags are removed with a regex, when no entities, comments or raw text elements are left.
+    4. Everything else is parsed with BeautifulSoup.
+
+    :param text: the text.
+    :return: the text without markup.
+    """
+
+    if "<" not in text and "&" not in text:
+        return text
+
+    # Unescape HTML tags
+    text = html.unescape(text)
+    if "<" not in text and "&" not in text:
+        return text
+
+    # BeautifulSoup unescapes entities a second time and handles comments, declarations and raw text elements
+    if "&" not in text and "<!" not in text and "<?" not in text and RAW_TEXT_TAG_PATTERN.search(text) is None:
+        stripped = TAG_PATTERN.sub("", text)
+        if "<" not in stripped:
+            return stripped
+
+    # Strip HTML
+    soup = BeautifulSoup(text, features="html.parser")
+    return soup.get_text()
 
 
 def preprocess_text(text: str):
@@ -86,24 +658,12 @@ def preprocess_text(text: str):
     if text == "":
         return ""
 
-    # If text is only [NO TITLE AVAILABLE]
-    if text == "[NO TITLE AVAILABLE]":
-        return ""
-
-    # If DOI return None
-    if is_doi(text):
-        return ""
-
-    # If URL return None
-    if validators.url(text):
+    # If text is only [NO TITLE AVAILABLE], a DOI or a URL
+    if is_junk(text):
         return ""
 
-    # Unescape HTML tags
-    text = html.unescape(text)
-
     # Strip HTML
-    soup = BeautifulSoup(text, features="html.parser")
-    text = soup.get_text()
+    text = strip_html(text)
 
     # Remove latext
     # text = latex2text(text)
@@ -120,100 +680,1209 @@ def preprocess_text(text: str):
     return text
 
 
-@ray.remote
+def format_languages(top: Optional[List[Tuple[str, float]]]):
+    """Format the most probable languages of a text as a compact string, for example en:0.8731;de:0.1012.
+
+    :param top: the language and score tuples returned by LanguageEngine.predict_top_k.
+    :return: the string, or None if there are no languages.
+    """
+
+    if not top:
+        return None
+    return ";".join(f"{language}:{score:.4f}" for language, score in top)
+
+
+def read_batches(rows: Iterable[List[str]], batch_size: int):
+    """Group rows into batches.
+
+    :param rows: the rows.
+    :param batch_size: the maximum number of rows in a batch.
+    :return: yield lists of rows.
+    """
+
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def select_longest(candidates: List[str], memo: Optional[LruMemo] = None):
+    """Pre-process candidate texts and select the longest one, the first one when several are equally long.
+
+    Gives the same result as pre-processing every candidate and taking the longest, but pre-processing never makes a
+    text longer, so candidates that are identical to one already pre-processed, or whose raw text is shorter than the
+    best pre-processed text so far, are skipped.
+
+    :param candidates: the raw candidate texts, in order of preference.
+    :param memo: a memo of pre-processed short texts.
+    :return: the longest pre-processed text.
+    """
+
+    best, best_index = "", len(candidates)
+    done = set()
+    for i in sorted(range(len(candidates)), key=lambda i: -len(candidates[i] or "")):
+        raw = candidates[i] or ""
+        if raw in done or len(raw) < len(best) or (len(raw) == len(best) and i > best_index):
+            continue
+        done.add(raw)
+        # Only text with markup or entities is slow enough to pre-process for the memo to pay off
+        if memo is not None and ("<" in raw or "&" in raw):
+            text = memo.call("preprocess", preprocess_text, raw)
+        else:
+            text = preprocess_text(raw)
+        if len(text) > len(best) or (len(text) == len(best) and i < best_index):
+            best, best_index = text, i
+    return best
+
+
+def truncate_text(text: str, max_chars: int):
+    """Truncate a text to at most max_chars characters, without cutting a word in half when possible.
+
+    :param text: the text.
+    :param max_chars: the maximum number of characters.
+    :return: the truncated text.
+    """
+
+    if len(text) <= max_chars:
+        return text
+    truncated = text[:max_chars]
+    if not text[max_chars].isspace() and " " in truncated:
+        truncated = truncated[: truncated.rindex(" ")]
+    return truncated.rstrip()
+
+
+def preprocess_fields(row: List[str], memo: Optional[LruMemo] = None):
+    """Pre-process the titles and abstracts of an input row and select the longest title and the longest abstract,
+    Crossref first.
+
+    :param row: the input row: doi, mag_title, crossref_title, mag_abstract and crossref_abstract.
+    :param memo: a memo of pre-processed short texts.
+    :return: the title and the abstract, which are empty strings when there is none.
+    """
+
+    return select_longest([row[2], row[1]], memo), select_longest([row[4], row[3]], memo)
+
+
+def predict_batch(engine: LanguageEngine, texts: List[str], memo: Optional[LruMemo] = None):
+    """Predict the most probable language of a batch of texts, predicting each distinct text once and looking up short
+    texts that were predicted before in the memo.
+
+    :param engine: the language identification engine.
+    :param texts: the pre-processed texts.
+    :param memo: a memo of the predictions of short texts. Repeats of a short text within the batch are counted as
+    memo hits, because they are not predicted again.
+    :return: the labels and scores, in the same order as the texts, which are None for empty texts.
+    """
+
+    labels = [None] * len(texts)
+    scores = [None] * len(texts)
+
+    # The indexes of each distinct text that is not memoized
+    indexes = {}
+    for i, text in enumerate(texts):
+        if text in indexes:
+            indexes[text].append(i)
+            if memo is not None and memo.memoizable(text):
+                memo.hits["predict"] += 1
+            continue
+        prediction = None if memo is None else memo.get("predict", text)
+        if prediction is None:
+            indexes[text] = [i]
+        else:
+            labels[i], scores[i] = prediction
+
+    new_texts = list(indexes)
+    new_labels, new_scores = engine.predict_batch(new_texts)
+    for text, label, score in zip(new_texts, new_labels, new_scores):
+        for i in indexes[text]:
+            labels[i] = label
+            scores[i] = score
+        if memo is not None and label is not None:
+            memo.put("predict", text, (label, score))
+
+    return labels, scores
+
+
+def combine_text(title: str, abstract: str, max_text_chars: Optional[int] = None):
+    """Combine a pre-processed title and abstract into the text to predict.
+
+    :param title: the title.
+    :param abstract: the abstract.
+    :param max_text_chars: the maximum number of characters of text to predict, longer texts are truncated.
+    :return: the text.
+    """
+
+    text = " ".join(list(filter(None, [title, abstract]))).strip()
+    if max_text_chars is not None:
+        text = truncate_text(text, max_text_chars)
+    return text
+
+
+def preprocess_row(row: List[str], max_text_chars: Optional[int] = None):
+    """Pre-process the titles and abstracts of an input row and combine them into the text to predict.
+
+    :param row: the input row: doi, mag_title, crossref_title, mag_abstract and crossref_abstract.
+    :param max_text_chars: the maximum number of characters of text to predict, longer texts are truncated.
+    :return: the title, or None if there is no title, and the text.
+    """
+
+    title, abstract = preprocess_fields(row)
+    text = combine_text(title, abstract, max_text_chars)
+
+    # Set title to None if empty string for final dataset
+    if title == "":
+        title = None
+
+    return title, text
+
+
+def cache_model_name(model_name: str, max_text_chars: Optional[int] = None):
+    """Get the name that predictions are cached under, which includes the text length limit because it changes the
+    predictions.
+
+    :param model_name: the name of the model.
+    :param max_text_chars: the maximum number of characters of text to predict.
+    :return: the name.
+    """
+
+    if max_text_chars is None:
+        return model_name
+    return f"{model_name}:max_text_chars={max_text_chars}"
+
+
+def classify_batch(
+    engine: LanguageEngine,
+    batch: List[List[str]],
+    cache: Optional[PredictionCache] = None,
+    max_text_chars: Optional[int] = None,
+    top_k: int = 1,
+    threshold: Optional[float] = None,
+    memo: Optional[LruMemo] = None,
+):
+    """Pre-process and predict the language of a batch of input rows.
+
+    :param engine: the language identification engine.
+    :param batch: the input rows: doi, mag_title, crossref_title, mag_abstract and crossref_abstract.
+    :param cache: the prediction cache, rows found in the cache are not pre-processed or predicted again. The cache only
+    stores the most probable language, so it should not be used when top_k is more than one.
+    :param max_text_chars: the maximum number of characters of text to predict, longer texts are truncated.
+    :param top_k: the number of most probable languages to predict. When it is more than one, the output rows have a
+    languages column, see LANGUAGES_FIELD.
+    :param threshold: rows whose score is below the threshold are also returned as uncertain rows, with separate
+    predictions for the title and the abstract.
+    :param memo: a memo of the pre-processed fields and predictions of short texts, which is kept between batches.
+    :return: the output rows: doi, title, language, score and the languages when top_k is more than one, the uncertain
+    rows, see UNCERTAIN_COLUMNS, and a Counter of metrics: the number of empty and uncertain rows, cache and memo hits
+    and misses and the seconds spent pre-processing and predicting.
+    """
+
+    metrics = collections.Counter()
+    if memo is not None:
+        memo_hits, memo_misses = memo.hits.copy(), memo.misses.copy()
+    start = time.perf_counter()
+    dois, titles, labels, scores, tops = [], [], [], [], []
+    miss_indexes, miss_keys, miss_texts, miss_abstracts = [], [], [], []
+    for row in batch:
+        doi = row[0]
+
+        # Use the cached prediction if the fields have not changed. Uncertain rows are classified again, so that their
+        # titles and abstracts are predicted separately
+        key = None
+        if cache is not None:
+            key = fields_key(row[1:5])
+            cached = cache.get(doi, key)
+            if cached is not None and (threshold is None or cached[2] is None or cached[2] >= threshold):
+                dois.append(doi)
+                titles.append(cached[0])
+                labels.append(cached[1])
+                scores.append(cached[2])
+                tops.append(None)
+                continue
+
+        title, abstract = preprocess_fields(row, memo)
+        miss_indexes.append(len(dois))
+        miss_keys.append(key)
+        miss_texts.append(combine_text(title, abstract, max_text_chars))
+        miss_abstracts.append(abstract)
+        dois.append(doi)
+        titles.append(title or None)
+        labels.append(None)
+        scores.append(None)
+        tops.append(None)
+
+    # Predict
+    preprocess_end = time.perf_counter()
+    if top_k == 1:
+        miss_labels, miss_scores = predict_batch(engine, miss_texts, memo)
+        for i, label, score in zip(miss_indexes, miss_labels, miss_scores):
+            labels[i] = label
+            scores[i] = score
+    else:
+        for i, top in zip(miss_indexes, engine.predict_top_k(miss_texts, top_k)):
+            if top:
+                labels[i], scores[i] = top[0]
+                tops[i] = top
+
+    # Predict the titles and abstracts of the uncertain rows that have both separately, in a single call
+    uncertain_rows = []
+    if threshold is not None:
+        uncertain = [j for j, i in enumerate(miss_indexes) if scores[i] is not None and scores[i] < threshold]
+        both = [j for j in uncertain if titles[miss_indexes[j]] and miss_abstracts[j]]
+        abstracts = [miss_abstracts[j] for j in both]
+        if max_text_chars is not None:
+            abstracts = [truncate_text(abstract, max_text_chars) for abstract in abstracts]
+        part_labels, part_scores = predict_batch(engine, [titles[miss_indexes[j]] for j in both] + abstracts, memo)
+        separate = {}
+        for n, j in enumerate(both):
+            separate[j] = (part_labels[n], part_scores[n], part_labels[len(both) + n], part_scores[len(both) + n])
+        for j in uncertain:
+            i = miss_indexes[j]
+            uncertain_rows.append(
+                (dois[i], titles[i], labels[i], scores[i], format_languages(tops[i]))
+                + separate.get(j, (None, None, None, None))
+                + (miss_texts[j],)
+            )
+    metrics["predict_seconds"] += time.perf_counter() - preprocess_end
+
+    # Save the new predictions to the cache
+    if cache is not None:
+        cache.put_many((dois[i], key, titles[i], labels[i], scores[i]) for i, key in zip(miss_indexes, miss_keys))
+        metrics["cache_hits"] += len(batch) - len(miss_indexes)
+        metrics["cache_misses"] += len(miss_indexes)
+
+    metrics["preprocess_seconds"] += preprocess_end - start
+    metrics["empty_rows"] += labels.count(None)
+    metrics["uncertain_rows"] += len(uncertain_rows)
+    if memo is not None:
+        for kind in MEMO_KINDS:
+            metrics[f"{kind}_memo_hits"] += memo.hits[kind] - memo_hits[kind]
+            metrics[f"{kind}_memo_misses"] += memo.misses[kind] - memo_misses[kind]
+    if top_k == 1:
+        rows = list(zip(dois, titles, labels, scores))
+    else:
+        rows = list(zip(dois, titles, labels, scores, map(format_languages, tops)))
+    return rows, uncertain_rows, metrics
+
+
+def timed(items: Iterable, metrics: collections.Counter, name: str):
+    """Time how long it takes to get each item from an iterator.
+
+    :param items: the iterator.
+    :param metrics: the metrics that the time is added to.
+    :param name: the name of the metric.
+    :return: yield the items.
+    """
+
+    items = iter(items)
+    while True:
+        start = time.perf_counter()
+        item = next(items, None)
+        metrics[name] += time.perf_counter() - start
+        if item is None:
+            return
+        yield item
+
+
+def prefetch(items: Iterable, max_items: int = 2):
+    """Get the items of an iterator in a background thread, at most max_items ahead of the consumer.
+
+    Used to run a stage of process_archive concurrently with the stages after it. Exceptions raised by the iterator are
+    raised to the consumer.
+
+    :param items: the iterator.
+    :param max_items: the maximum number of items that are waiting to be consumed.
+    :return: yield the items.
+    """
+
+    done = object()
+    items_queue = queue.Queue(max_items)
+    stopped = threading.Event()
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                items_queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def run():
+        try:
+            for item in items:
+                put(item)
+                if stopped.is_set():
+                    return
+            put(done)
+        except BaseException as e:
+            put(e)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = items_queue.get()
+            if item is done:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        stopped.set()
+        thread.join()
+
+
+class ThreadedRowWriter:
+    """Writes rows with a writer in a background thread, so that writing and compressing overlap with the work that
+    produces the rows."""
+
+    def __init__(self, writer, max_batches: int = 2):
+        """Start the writer thread.
+
+        :param writer: the writer, see open_output.
+        :param max_batches: the maximum number of batches of rows waiting to be written.
+        """
+
+        self.writer = writer
+        self.queue = queue.Queue(max_batches)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            rows = self.queue.get()
+            if rows is None:
+                break
+            if self.error is None:
+                try:
+                    self.writer.write_rows(rows)
+                except BaseException as e:
+                    self.error = e
+
+    def write_rows(self, rows: List[Tuple]):
+        """Queue rows to be written.
+
+        :param rows: the rows.
+        :return: None.
+        """
+
+        if self.error is not None:
+            raise self.error
+        self.queue.put(rows)
+
+    def close(self):
+        """Write the queued rows and close the writer.
+
+        :return: None.
+        """
+
+        self.queue.put(None)
+        self.thread.join()
+        self.writer.close()
+        if self.error is not None:
+            raise self.error
+
+
 def process_archive(
-    csv_path: str, output_path: str, model_path: str = os.path.join(os.path.expanduser("~"), ".fasttext/lid.176.bin")
+    engine: LanguageEngine,
+    csv_path: str,
+    output_path: str,
+    batch_size: int = 10000,
+    cache_path: Optional[str] = None,
+    map_batches: Optional[Callable] = None,
+    output_format: str = "csv",
+    compression: str = "gzip",
+    compression_level: Optional[int] = None,
+    threaded_io: bool = False,
+    max_text_chars: Optional[int] = None,
+    part: Optional[int] = None,
+    start_offset: int = 0,
+    num_rows: Optional[int] = None,
+    top_k: int = 1,
+    threshold: Optional[float] = None,
+    pipelined: bool = False,
+    memo: Optional[LruMemo] = None,
 ):
-    """A remote ray function that predicts language for a single .csv.gz archive.
+    """Predict the language for a single .csv.gz archive, or a part of one.
 
+    :param engine: the language identification engine.
     :param csv_path: the path to the .csv.gz file.
     :param output_path: the output directory where the results should be saved.
-    :param model_path: the path to the fasttext model.
-    :return: return the results.
+    :param batch_size: the number of rows sent to the model in a single predict call.
+    :param cache_path: the prediction cache folder, rows found in the cache are not pre-processed or predicted again.
+    :param map_batches: a function that takes an iterator of batches and yields the results of classify_batch for each
+    batch, in order. Used to spread the batches of one archive over several processes. By default the batches are
+    classified in this process.
+    :param output_format: the output format, one of OUTPUT_FORMATS.
+    :param compression: the compression of CSV output files, one of COMPRESSIONS.
+    :param compression_level: the compression level of CSV output files.
+    :param threaded_io: whether to decompress the input and compress the output in background threads.
+    :param max_text_chars: the maximum number of characters of text to predict, longer texts are truncated.
+    :param part: the part number, when only a range of rows of the archive is processed, see WorkUnit.
+    :param start_offset: the offset of the first row of the part in the decompressed archive.
+    :param num_rows: the number of rows in the part.
+    :param top_k: the number of most probable languages to predict, see classify_batch.
+    :param threshold: rows whose score is below the threshold are also written to an uncertain output file in the
+    UNCERTAIN_FOLDER of the output directory, see classify_batch.
+    :param pipelined: whether to read and write in background threads, so that reading, classifying and writing run
+    concurrently with at most a few batches in between. The read and write times are then the time spent waiting for
+    each stage.
+    :param memo: a memo of the pre-processed fields and predictions of short texts, see classify_batch.
+    :return: a dictionary with the path of the archive, the part, the size and modification time of the archive, the
+    size and checksum of the output file, the processing time in seconds and the metrics: the number of rows, empty and
+    uncertain rows, cache hits and misses, the seconds spent in each of the STAGES and the rows per second.
     """
 
     # Prevent this error: _csv.Error: field larger than field limit (131072)
     csv.field_size_limit(sys.maxsize)
 
-    print(f"Running task: {csv_path}")
-    model = fasttext.load_model(model_path)
-    output_file_path = os.path.join(output_path, os.path.basename(csv_path))
-    with gzip.open(output_file_path, "w") as f:
-        # Make CSV writer and write header
-        writer = csv.writer(io.TextIOWrapper(f, newline=""))
-        writer.writerow(["doi", "title", "language", "score"])
-
-        # Process each row of the CSV file
-        for row in read_csv_gz(csv_path):
-            # Read data
-            doi = row[0]
-            mag_title = row[1]
-            crossref_title = row[2]
-            mag_abstract = row[3]
-            crossref_abstract = row[4]
-
-            # Pre-process text
-            pre_mag_title = preprocess_text(mag_title)
-            pre_crossref_title = preprocess_text(crossref_title)
-            pre_mag_abstract = preprocess_text(mag_abstract)
-            pre_crossref_abstract = preprocess_text(crossref_abstract)
-
-            # Select longest of titles if both exist and combine not None
-            title = max([pre_crossref_title, pre_mag_title], key=len)
-            abstract = max([pre_crossref_abstract, pre_mag_abstract], key=len)
-            text = " ".join(list(filter(None, [title, abstract]))).strip()
-
-            # Predict
-            label, score = None, None
-            if text != "":
-                top = model.predict(text, k=1)
-                label = top[0][0][9:]
-                score = top[1][0]
-
-            # Set title to None if empty string for final dataset
-            if title == "":
-                title = None
-
-            # Write results
-            writer.writerow([doi, title, label, score])
-
-    return csv_path
-
-
-@click.command("predict-language")
+    print(f"Running task: {unit_name(csv_path, part)}")
+    start = time.perf_counter()
+    stat = os.stat(csv_path)
+    metrics = collections.Counter({f"{stage}_seconds": 0.0 for stage in STAGES})
+    cache = None
+    if map_batches is None:
+        if cache_path is not None:
+            cache = PredictionCache(
+                cache_path, unit_name(csv_path, part), cache_model_name(engine.model_name, max_text_chars)
+            )
+
+        def map_batches(batches):
+            for batch in batches:
+                yield classify_batch(engine, batch, cache, max_text_chars, top_k, threshold, memo)
+
+    # Write to a temporary file and rename it when complete, so that a crash never leaves a truncated output file
+    output_file_path = os.path.join(output_path, output_file_name(csv_path, output_format, compression, part))
+    tmp_file_path = f"{output_file_path}.tmp"
+    writer = open_output(
+        tmp_file_path,
+        output_format,
+        compression=compression,
+        compression_level=compression_level,
+        threaded=threaded_io,
+        with_languages=top_k > 1,
+    )
+    uncertain_writer = None
+    if threshold is not None:
+        uncertain_path = os.path.join(output_path, UNCERTAIN_FOLDER)
+        os.makedirs(uncertain_path, exist_ok=True)
+        uncertain_file_path = os.path.join(uncertain_path, output_file_name(csv_path, "csv", compression, part))
+        uncertain_writer = CsvWriter(
+            f"{uncertain_file_path}.tmp", compression, level=compression_level, columns=UNCERTAIN_COLUMNS
+        )
+    if pipelined:
+        writer = ThreadedRowWriter(writer)
+        if uncertain_writer is not None:
+            uncertain_writer = ThreadedRowWriter(uncertain_writer)
+
+    # Process the rows of the CSV file in batches and write results
+    rows = read_csv_gz(csv_path, threaded=threaded_io, start_offset=start_offset, num_rows=num_rows)
+    batches = read_batches(rows, batch_size)
+    if pipelined:
+        batches = prefetch(batches)
+    batches = timed(batches, metrics, "read_seconds")
+    for results, uncertain_results, batch_metrics in map_batches(batches):
+        write_start = time.perf_counter()
+        writer.write_rows(results)
+        if uncertain_writer is not None:
+            uncertain_writer.write_rows(uncertain_results)
+        metrics["write_seconds"] += time.perf_counter() - write_start
+        metrics["rows"] += len(results)
+        metrics.update(batch_metrics)
+    write_start = time.perf_counter()
+    writer.close()
+    if uncertain_writer is not None:
+        uncertain_writer.close()
+    metrics["write_seconds"] += time.perf_counter() - write_start
+
+    # The uncertain rows are renamed first, so that a complete output file always has its uncertain rows
+    checksum = sha256_file(tmp_file_path)
+    if uncertain_writer is not None:
+        os.replace(f"{uncertain_file_path}.tmp", uncertain_file_path)
+    os.replace(tmp_file_path, output_file_path)
+    if cache is not None:
+        cache.close()
+
+    seconds = time.perf_counter() - start
+    return dict(
+        csv_path=csv_path,
+        part=part,
+        start_offset=start_offset,
+        num_rows=num_rows,
+        input_size=stat.st_size,
+        input_mtime=stat.st_mtime,
+        output_size=os.path.getsize(output_file_path),
+        sha256=checksum,
+        seconds=seconds,
+        rows=metrics["rows"],
+        empty_rows=metrics["empty_rows"],
+        uncertain_rows=metrics["uncertain_rows"],
+        cache_hits=metrics["cache_hits"],
+        cache_misses=metrics["cache_misses"],
+        **{f"{stage}_seconds": metrics[f"{stage}_seconds"] for stage in STAGES},
+        **{metric: metrics[metric] for metric in METRICS if "_memo_" in metric},
+        rows_per_second=metrics["rows"] / seconds if seconds > 0 else 0.0,
+    )
+
+
+class LanguagePredictor:
+    """Loads the model once and then predicts language for any number of archives.
+
+    Used directly by the serial and multiprocessing backends and as a Ray actor by the Ray backend.
+    """
+
+    def __init__(self, model_path: str = DEFAULT_MODEL_PATH, engine: str = "fasttext"):
+        """Load the model.
+
+        :param model_path: the path to the model.
+        :param engine: the language identification engine, one of ENGINES.
+        """
+
+        start = time.perf_counter()
+        self.engine = load_engine(model_path, engine)
+        self.load_seconds = time.perf_counter() - start
+        self.memo = None
+
+    def get_load_seconds(self):
+        """Get the time that it took to load the model.
+
+        :return: the load time in seconds.
+        """
+
+        return self.load_seconds
+
+    def get_memo(self, memo_size: int = 0, memo_max_chars: int = 256):
+        """Get the memo of pre-processed fields and predictions of this worker, which is kept between archives.
+
+        :param memo_size: the maximum size of the memo in bytes, 0 to not use a memo.
+        :param memo_max_chars: the maximum length of the texts that are memoized.
+        :return: the memo, or None.
+        """
+
+        if memo_size <= 0:
+            return None
+        if self.memo is None or (self.memo.max_bytes, self.memo.max_key_chars) != (memo_size, memo_max_chars):
+            self.memo = LruMemo(memo_size, memo_max_chars)
+        return self.memo
+
+    def process_archive(self, csv_path: str, output_path: str, memo_size: int = 0, memo_max_chars: int = 256, **kwargs):
+        """Predict the language for a single .csv.gz archive with the loaded model.
+
+        :param csv_path: the path to the .csv.gz file.
+        :param output_path: the output directory where the results should be saved.
+        :param memo_size: the maximum size of the memo of pre-processed fields and predictions in bytes, 0 to not use
+        a memo.
+        :param memo_max_chars: the maximum length of the texts that are memoized.
+        :param kwargs: the options for process_archive.
+        :return: the archive results.
+        """
+
+        memo = self.get_memo(memo_size, memo_max_chars)
+        return process_archive(self.engine, csv_path, output_path, memo=memo, **kwargs)
+
+
+class RunProgress:
+    """Aggregates the metrics of the finished archives into a progress summary with an estimated time to completion.
+
+    The metrics of each archive are also appended to a JSON lines file.
+    """
+
+    def __init__(self, units: List[WorkUnit], metrics_path: str):
+        """Start tracking progress.
+
+        :param units: the work units that will be processed.
+        :param metrics_path: the path to the JSON lines file that the metrics of each archive are appended to.
+        """
+
+        self.sizes = {unit_name(unit.csv_path, unit.part): unit.size for unit in units}
+        self.total_archives = len(units)
+        self.total_bytes = sum(self.sizes.values())
+        self.metrics_path = metrics_path
+        self.start = time.time()
+        self.archives = 0
+        self.bytes = 0
+        self.metrics = collections.Counter()
+
+    def add(self, result: Dict):
+        """Add the results of a finished archive.
+
+        :param result: the results returned by process_archive.
+        :return: None.
+        """
+
+        with open(self.metrics_path, "a") as f:
+            f.write(json.dumps(dict(time=time.time(), **result)) + "\n")
+        self.archives += 1
+        self.bytes += self.sizes[unit_name(result["csv_path"], result["part"])]
+        self.metrics.update(
+            {key: value for key, value in result.items() if key in METRICS and isinstance(value, (int, float))}
+        )
+
+    def summary(self):
+        """Summarise the progress of the run.
+
+        :return: the number of finished archives, rows per second and the estimated time to completion, which assumes
+        that the remaining archives take as long per byte as the finished ones.
+        """
+
+        elapsed = time.time() - self.start
+        rows_per_second = self.metrics["rows"] / elapsed if elapsed > 0 else 0.0
+        eta = "unknown"
+        if self.bytes > 0:
+            eta = str(datetime.timedelta(seconds=round(elapsed * (self.total_bytes - self.bytes) / self.bytes)))
+        return (
+            f"Tasks finished: {self.archives}, tasks waiting: {self.total_archives - self.archives}, "
+            f"input: {self.bytes / max(self.total_bytes, 1):.1%}, rows: {self.metrics['rows']}, "
+            f"empty rows: {self.metrics['empty_rows']}, rows/sec: {rows_per_second:.0f}, ETA: {eta}"
+        )
+
+    def stage_summary(self):
+        """Summarise the share of time spent in each stage, to show whether a run is I/O, parsing or inference bound.
+
+        :return: the seconds and percentage of time spent in each of the STAGES.
+        """
+
+        total = sum(self.metrics[f"{stage}_seconds"] for stage in STAGES)
+        seconds = {stage: self.metrics[f"{stage}_seconds"] for stage in STAGES}
+        stages = ", ".join(
+            f"{stage}: {seconds[stage]:.2f}s ({seconds[stage] / max(total, 1e-9):.1%})" for stage in STAGES
+        )
+        return f"Time per stage: {stages}"
+
+
+def memo_summary(metrics: Dict):
+    """Summarise the memo hit rates of an archive or a run.
+
+    :param metrics: the metrics of the archive or run.
+    :return: the hit rate of each kind of memoized result, or an empty string when the memo was not used.
+    """
+
+    summary = ""
+    for kind in MEMO_KINDS:
+        hits, misses = metrics.get(f"{kind}_memo_hits", 0), metrics.get(f"{kind}_memo_misses", 0)
+        if hits + misses > 0:
+            summary += f", {kind} memo hit rate: {hits / (hits + misses):.1%}"
+    return summary
+
+
+def run_archives(actors: List, units: List, run: Callable, max_in_flight: int):
+    """Run archives on a pool of Ray actors, keeping at most max_in_flight tasks submitted to Ray at any time.
+
+    Each actor is given a share of the in-flight slots, so that it has its next archive queued when it finishes one,
+    and a new archive is submitted to an actor as soon as one of its tasks finishes. When max_in_flight is less than the
+    number of actors, only max_in_flight actors are given archives.
+
+    :param actors: the actors.
+    :param units: the archives or work units to run, in the order that they should be submitted.
+    :param run: a function that takes an actor and an archive or work unit and returns an ObjectRef.
+    :param max_in_flight: the maximum number of tasks submitted at once.
+    :return: yield the results of the tasks as they finish.
+    """
+
+    import ray
+
+    pending = collections.deque(units)
+    in_flight = {}
+    for i in range(min(max(max_in_flight, 1), len(pending))):
+        actor = actors[i % len(actors)]
+        in_flight[run(actor, pending.popleft())] = actor
+
+    while in_flight:
+        # Block until a task finishes
+        finished, _ = ray.wait(list(in_flight), num_returns=1)
+        task_id = finished[0]
+        actor = in_flight.pop(task_id)
+        if pending:
+            in_flight[run(actor, pending.popleft())] = actor
+        yield ray.get(task_id)
+
+
+def imap_bounded(pool, func: Callable, items: Iterable, window: int):
+    """Map a function over items with a multiprocessing pool, in order, with at most window items submitted at once.
+
+    Unlike Pool.imap, the items are only read from the iterator as results are consumed, so memory stays bounded.
+
+    :param pool: the multiprocessing pool.
+    :param func: the function.
+    :param items: the items.
+    :param window: the maximum number of items submitted to the pool at once.
+    :return: yield the results in the order of the items.
+    """
+
+    results = collections.deque()
+    for item in items:
+        results.append(pool.apply_async(func, (item,)))
+        if len(results) >= window:
+            yield results.popleft().get()
+    while results:
+        yield results.popleft().get()
+
+
+# The options of process_archive that are passed on to classify_batch and their defaults
+CLASSIFY_OPTIONS = {"max_text_chars": None, "top_k": 1, "threshold": None}
+
+# The predictor of the multiprocessing backend, loaded before the worker processes are forked so that they share the
+# model memory copy-on-write
+_predictor: Optional[LanguagePredictor] = None
+
+# The prediction cache opened by a multiprocessing worker for the archive that it is working on
+_cache: Optional[PredictionCache] = None
+_cache_name: Optional[str] = None
+
+
+def _process_archive_worker(args):
+    unit, output_path, kwargs = args
+    return _predictor.process_archive(unit.csv_path, output_path, **unit.options, **kwargs)
+
+
+def _classify_batch_worker(args):
+    global _cache, _cache_name
+
+    batch, cache_path, name, options, memo_options = args
+    if cache_path is not None and name != _cache_name:
+        if _cache is not None:
+            _cache.close()
+        _cache = PredictionCache(
+            cache_path,
+            f"{name}.{os.getpid()}",
+            cache_model_name(_predictor.engine.model_name, options["max_text_chars"]),
+        )
+        _cache_name = name
+    return classify_batch(_predictor.engine, batch, _cache, memo=_predictor.get_memo(*memo_options), **options)
+
+
+class SerialBackend:
+    """Processes the archives one after another in this process."""
+
+    def __init__(self, model_path: str, engine: str = "fasttext", num_workers: Optional[int] = None, **kwargs):
+        """Load the model.
+
+        :param model_path: the path to the model.
+        :param engine: the language identification engine, one of ENGINES.
+        :param num_workers: not used.
+        """
+
+        self.predictor = LanguagePredictor(model_path, engine)
+        self.load_seconds = [self.predictor.get_load_seconds()]
+
+    def run(self, units: List[WorkUnit], output_path: str, **kwargs):
+        """Process archives.
+
+        :param units: the work units, in the order that they should be processed.
+        :param output_path: the output directory.
+        :param kwargs: the options for process_archive.
+        :return: yield the results of each work unit as it finishes.
+        """
+
+        for unit in units:
+            yield self.predictor.process_archive(unit.csv_path, output_path, **unit.options, **kwargs)
+
+    def close(self):
+        pass
+
+
+class MultiprocessingBackend:
+    """Processes the archives with a pool of forked processes that share one copy of the model.
+
+    With split_archives, the archives are processed one at a time and the batches of each archive are spread over the
+    processes, otherwise each process works on a whole archive.
+    """
+
+    def __init__(
+        self,
+        model_path: str,
+        engine: str = "fasttext",
+        num_workers: Optional[int] = None,
+        split_archives: bool = False,
+        **kwargs,
+    ):
+        """Load the model and start the worker processes.
+
+        :param model_path: the path to the model.
+        :param engine: the language identification engine, one of ENGINES.
+        :param num_workers: the number of processes, defaults to the number of CPUs.
+        :param split_archives: whether to spread the batches of each archive over the processes.
+        """
+
+        global _predictor
+
+        _predictor = LanguagePredictor(model_path, engine)
+        self.load_seconds = [_predictor.get_load_seconds()]
+        self.num_workers = num_workers or os.cpu_count()
+        self.split_archives = split_archives
+        self.pool = multiprocessing.get_context("fork").Pool(self.num_workers)
+
+    def run(self, units: List[WorkUnit], output_path: str, **kwargs):
+        """Process archives.
+
+        :param units: the work units, in the order that they should be processed.
+        :param output_path: the output directory.
+        :param kwargs: the options for process_archive.
+        :return: yield the results of each work unit as it finishes.
+        """
+
+        if not self.split_archives:
+            yield from self.pool.imap_unordered(
+                _process_archive_worker, [(unit, output_path, kwargs) for unit in units]
+            )
+            return
+
+        cache_path = kwargs.pop("cache_path", None)
+        options = {key: kwargs.get(key, default) for key, default in CLASSIFY_OPTIONS.items()}
+        memo_options = (kwargs.pop("memo_size", 0), kwargs.pop("memo_max_chars", 256))
+        for unit in units:
+            name = unit_name(unit.csv_path, unit.part)
+            yield _predictor.process_archive(
+                unit.csv_path,
+                output_path,
+                map_batches=lambda batches: imap_bounded(
+                    self.pool,
+                    _classify_batch_worker,
+                    ((batch, cache_path, name, options, memo_options) for batch in batches),
+                    2 * self.num_workers,
+                ),
+                **unit.options,
+                **kwargs,
+            )
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+
+class RayBackend:
+    """Processes the archives with a pool of LanguagePredictor Ray actors that each load the model once."""
+
+    def __init__(
+        self,
+        model_path: str,
+        engine: str = "fasttext",
+        num_workers: Optional[int] = None,
+        max_in_flight: Optional[int] = None,
+        **kwargs,
+    ):
+        """Start Ray and the actors.
+
+        :param model_path: the path to the model.
+        :param engine: the language identification engine, one of ENGINES.
+        :param num_workers: the number of actors, defaults to the number of CPUs in the Ray cluster.
+        :param max_in_flight: the maximum number of archives submitted to Ray at once, defaults to twice the number of
+        actors.
+        """
+
+        import ray
+
+        if not ray.is_initialized():
+            ray.init()
+        if num_workers is None:
+            num_workers = max(1, int(ray.cluster_resources().get("CPU", 1)))
+        remote_predictor = ray.remote(LanguagePredictor)
+        self.actors = [remote_predictor.remote(model_path, engine) for _ in range(num_workers)]
+        self.load_seconds = ray.get([actor.get_load_seconds.remote() for actor in self.actors])
+        self.max_in_flight = max_in_flight or 2 * num_workers
+
+    def run(self, units: List[WorkUnit], output_path: str, **kwargs):
+        """Process archives.
+
+        :param units: the work units, in the order that they should be submitted.
+        :param output_path: the output directory.
+        :param kwargs: the options for process_archive.
+        :return: yield the results of each work unit as it finishes.
+        """
+
+        yield from run_archives(
+            self.actors,
+            units,
+            lambda actor, unit: actor.process_archive.remote(unit.csv_path, output_path, **unit.options, **kwargs),
+            self.max_in_flight,
+        )
+
+    def close(self):
+        pass
+
+
+BACKENDS = {"ray": RayBackend, "multiprocessing": MultiprocessingBackend, "serial": SerialBackend}
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command("predict-language")
 @click.argument("input-path", type=click.Path(exists=True, file_okay=False, dir_okay=True))
 @click.argument("output-path", type=click.Path(exists=True, file_okay=False, dir_okay=True))
 @click.option(
     "--file-pattern", type=click.STRING, default="*.csv.gz", help="The file pattern to use when search for files"
 )
-def predict_language_cmd(input_path: str, output_path: str, file_pattern: str):
-    # Create tasks
-    task_ids = []
-    for csv_path in list_files(input_path, file_pattern):
-        print(f"Creating task: {csv_path}")
-        task_id = process_archive.remote(csv_path, output_path)
-        task_ids.append(task_id)
+@click.option(
+    "--batch-size", type=click.INT, default=10000, help="The number of rows sent to the model in a single predict call"
+)
+@click.option(
+    "--model-path",
+    type=click.Path(exists=True, file_okay=True, dir_okay=False),
+    default=DEFAULT_MODEL_PATH,
+    help="The path to the model, such as the fasttext lid.176.bin or the quantized lid.176.ftz",
+)
+@click.option(
+    "--engine",
+    type=click.Choice(list(ENGINES)),
+    default="fasttext",
+    help="The language identification engine that loads the model",
+)
+@click.option(
+    "--backend",
+    type=click.Choice(list(BACKENDS)),
+    default="ray",
+    help="How to run the archives: Ray actors, forked processes on this machine or one at a time in this process",
+)
+@click.option(
+    "--num-workers",
+    type=click.INT,
+    default=None,
+    help="The number of Ray actors or processes, defaults to the number of CPUs",
+)
+@click.option(
+    "--max-in-flight",
+    type=click.IntRange(min=1),
+    default=None,
+    help="With the ray backend, the maximum number of archives submitted to Ray at once, defaults to twice the number "
+    "of workers",
+)
+@click.option(
+    "--split-archives",
+    is_flag=True,
+    default=False,
+    help="With the multiprocessing backend, spread the batches of each archive over the processes",
+)
+@click.option(
+    "--output-format",
+    type=click.Choice(list(OUTPUT_FORMATS)),
+    default="csv",
+    help="Write gzipped CSV files, or Parquet or Arrow IPC files with typed columns, which need pyarrow",
+)
+@click.option(
+    "--compression",
+    type=click.Choice(list(COMPRESSIONS)),
+    default="gzip",
+    help="The compression of CSV output files, zstd needs the zstandard package",
+)
+@click.option(
+    "--compression-level",
+    type=click.INT,
+    default=None,
+    help="The compression level of CSV output files, defaults to 6 for gzip and 3 for zstd",
+)
+@click.option(
+    "--threaded-io/--no-threaded-io",
+    default=True,
+    help="Whether to decompress the input and compress the output in background threads",
+)
+@click.option(
+    "--pipelined/--no-pipelined",
+    default=False,
+    help="Whether to read and write batches in background threads, concurrently with classifying the next batch, "
+    "which helps when there are more CPUs than workers",
+)
+@click.option(
+    "--memo-size",
+    type=click.FLOAT,
+    default=64,
+    help="The size in megabytes of the memo of each worker, which keeps the pre-processed fields and predictions of "
+    "short repeated texts such as Editorial or Front Matter, 0 to not use a memo",
+)
+@click.option(
+    "--memo-max-chars",
+    type=click.IntRange(min=1),
+    default=256,
+    help="The maximum length of the texts that are memoized",
+)
+@click.option(
+    "--resume/--no-resume",
+    default=True,
+    help="Whether to skip the archives recorded as complete in the manifest of the output directory",
+)
+@click.option(
+    "--cache-path",
+    type=click.Path(file_okay=False, dir_okay=True),
+    default=None,
+    help="A prediction cache folder, rows with the same DOI and fields as a previous run are taken from the cache",
+)
+@click.option(
+    "--max-text-chars",
+    type=click.IntRange(min=1),
+    default=None,
+    help="Truncate the text of each row to this many characters before predicting, by default it is not truncated",
+)
+@click.option(
+    "--max-unit-size",
+    type=click.FLOAT,
+    default=None,
+    help="Split archives larger than this many megabytes into parts that are processed in parallel and written to "
+    "numbered part files, by default archives are not split",
+)
+@click.option(
+    "--top-k",
+    type=click.IntRange(min=1),
+    default=1,
+    help="Predict this many of the most probable languages of each row, which are written to a languages column",
+)
+@click.option(
+    "--threshold",
+    type=click.FloatRange(0, 1),
+    default=None,
+    help="Also write the rows whose score is below this threshold to the uncertain folder of the output directory, "
+    "with separate predictions for their titles and abstracts",
+)
+def predict_language_cmd(
+    input_path: str,
+    output_path: str,
+    file_pattern: str,
+    batch_size: int,
+    model_path: str,
+    engine: str,
+    backend: str,
+    num_workers: Optional[int],
+    max_in_flight: Optional[int],
+    split_archives: bool,
+    output_format: str,
+    compression: str,
+    compression_level: Optional[int],
+    threaded_io: bool,
+    pipelined: bool,
+    memo_size: float,
+    memo_max_chars: int,
+    resume: bool,
+    cache_path: Optional[str],
+    max_text_chars: Optional[int],
+    max_unit_size: Optional[float],
+    top_k: int,
+    threshold: Optional[float],
+):
+    if cache_path is not None and top_k > 1:
+        raise click.UsageError("--cache-path can not be used with --top-k, the cache only stores the top language")
+    if max_in_flight is not None and backend != "ray":
+        raise click.UsageError("--max-in-flight can only be used with --backend ray")
+    if split_archives and backend != "multiprocessing":
+        raise click.UsageError("--split-archives can only be used with --backend multiprocessing")
 
-    # Join tasks
-    count = 0
-    while True:
-        finished, not_finished = ray.wait(task_ids, num_returns=len(task_ids), timeout=10.0)
+    # Split the largest archives into parts, largest work units first
+    csv_paths = list_files(input_path, file_pattern)
+    if max_unit_size is not None:
+        max_unit_size = int(max_unit_size * 1024 * 1024)
+    units = plan_work_units(csv_paths, os.path.join(output_path, INDEX_FOLDER), max_unit_size)
 
-        # Add the results that have completed
-        for task_id in finished:
-            csv_path = ray.get(task_id)
-            count += 1
-            print(f"Finished task: {csv_path}")
-        task_ids = not_finished
+    # Skip the archives and parts that were completed in a previous run
+    manifest_path = os.path.join(output_path, MANIFEST_FILE_NAME)
+    if not resume and os.path.isfile(manifest_path):
+        os.remove(manifest_path)
+    manifest = RunManifest(manifest_path)
+    # The options that change the output files, archives that were completed with other options are run again
+    options = dict(
+        engine=engine,
+        model_name=os.path.basename(model_path),
+        output_format=output_format,
+        compression=compression,
+        max_text_chars=max_text_chars,
+        top_k=top_k,
+        threshold=threshold,
+    )
+    pending = []
+    for unit in units:
+        output_file_path = os.path.join(
+            output_path, output_file_name(unit.csv_path, output_format, compression, unit.part)
+        )
+        uncertain_file_path = None
+        if threshold is not None:
+            uncertain_file_path = os.path.join(
+                output_path, UNCERTAIN_FOLDER, output_file_name(unit.csv_path, "csv", compression, unit.part)
+            )
+        if manifest.is_complete(
+            unit.csv_path, output_file_path, **unit.options, options=options, uncertain_file_path=uncertain_file_path
+        ):
+            print(f"Skipping completed task: {unit_name(unit.csv_path, unit.part)}")
+        else:
+            pending.append(unit)
+    if not pending:
+        print("Complete")
+        return
 
-        print(f"Tasks finished: {count}, tasks waiting: {len(task_ids)}.")
+    # Start the workers, which each load the model once
+    runner = BACKENDS[backend](
+        model_path, engine=engine, num_workers=num_workers, max_in_flight=max_in_flight, split_archives=split_archives
+    )
+    load_seconds = runner.load_seconds
+    print(
+        f"Model loaded by {len(load_seconds)} workers, average load time: {sum(load_seconds) / len(load_seconds):.2f}s"
+    )
 
-        # Break when no tasks
-        if len(task_ids) == 0:
-            break
+    # Run tasks
+    progress = RunProgress(pending, os.path.join(output_path, METRICS_FILE_NAME))
+    for result in runner.run(
+        pending,
+        output_path,
+        batch_size=batch_size,
+        cache_path=cache_path,
+        output_format=output_format,
+        compression=compression,
+        compression_level=compression_level,
+        threaded_io=threaded_io,
+        pipelined=pipelined,
+        memo_size=int(memo_size * 1024 * 1024),
+        memo_max_chars=memo_max_chars,
+        max_text_chars=max_text_chars,
+        top_k=top_k,
+        threshold=threshold,
+    ):
+        manifest.add(result, options)
+        progress.add(result)
+        name = unit_name(result["csv_path"], result["part"])
+        print(f"Finished task: {name}, rows: {result['rows']}, time: {result['seconds']:.2f}s{memo_summary(result)}")
+        print(progress.summary())
+    runner.close()
+
+    print(
+        f"Model load time: {sum(load_seconds):.2f}s for {len(load_seconds)} workers, "
+        f"archive processing time: {progress.metrics['seconds']:.2f}s for {progress.archives} archives"
+    )
+    print(progress.stage_summary())
+    if memo_size > 0:
+        print(f"Finished run{memo_summary(progress.metrics)}")
 
+    # Merge the new predictions into the cache for the next run
+    if cache_path is not None:
+        cache_hits, cache_misses = progress.metrics["cache_hits"], progress.metrics["cache_misses"]
+        lookups = cache_hits + cache_misses
+        print(f"Cache hits: {cache_hits}, misses: {cache_misses}, hit rate: {cache_hits / max(lookups, 1):.1%}")
+        compact_cache(cache_path, cache_model_name(os.path.basename(model_path), max_text_chars))
     print("Complete")
 
 
+@cli.command("compact-cache")
+@click.argument("cache-path", type=click.Path(exists=True, file_okay=False, dir_okay=True))
+@click.option(
+    "--model-path",
+    type=click.Path(file_okay=True, dir_okay=False),
+    default=DEFAULT_MODEL_PATH,
+    help="The path to the fasttext model that the cache was built with",
+)
+@click.option(
+    "--max-text-chars",
+    type=click.IntRange(min=1),
+    default=None,
+    help="The text length limit of the runs that the cache was built with",
+)
+@click.option("--vacuum", is_flag=True, default=False, help="Rebuild the cache database to reclaim free space")
+def compact_cache_cmd(cache_path: str, model_path: str, max_text_chars: Optional[int], vacuum: bool):
+    """Merge the predictions of interrupted runs into the prediction cache."""
+
+    count = compact_cache(cache_path, cache_model_name(os.path.basename(model_path), max_text_chars), vacuum=vacuum)
+    print(f"Merged {count} delta databases")
+
+
 if __name__ == "__main__":
-    predict_language_cmd()
+    cli()
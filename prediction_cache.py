@@ -0,0 +1,161 @@
+# Copyright 2022 Curtin University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import glob
+import hashlib
+import os
+import pathlib
+import sqlite3
+from typing import Iterable, List, Optional, Tuple
+
+CACHE_FILE_NAME = "cache.sqlite"
+DELTAS_FOLDER = "deltas"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS predictions (
+    doi TEXT NOT NULL,
+    key BLOB NOT NULL,
+    title TEXT,
+    language TEXT,
+    score REAL,
+    PRIMARY KEY (doi, key)
+) WITHOUT ROWID;
+"""
+
+
+def fields_key(fields: List[str]):
+    """Hash the raw title and abstract fields of a row.
+
+    :param fields: the mag_title, crossref_title, mag_abstract and crossref_abstract fields.
+    :return: a 16 byte digest.
+    """
+
+    # Null characters are removed by create_dataset.sql, so they can be used as a separator
+    return hashlib.blake2b("\0".join(fields).encode("utf-8", "surrogatepass"), digest_size=16).digest()
+
+
+def connect(path: str, model_name: str, read_only: bool = False):
+    """Connect to a cache database, creating it if it does not exist, and check that it was built with the same model.
+
+    :param path: the path to the SQLite database.
+    :param model_name: the name of the model that made the predictions.
+    :param read_only: whether to open an existing database read only, so that many workers can read it at once.
+    :return: the connection.
+    """
+
+    if read_only:
+        conn = sqlite3.connect(f"{pathlib.Path(path).absolute().as_uri()}?mode=ro", uri=True)
+    else:
+        conn = sqlite3.connect(path)
+        conn.executescript(SCHEMA)
+        conn.execute("INSERT OR IGNORE INTO meta (name, value) VALUES ('model', ?)", (model_name,))
+        conn.commit()
+    (cache_model_name,) = conn.execute("SELECT value FROM meta WHERE name = 'model'").fetchone()
+    if cache_model_name != model_name:
+        conn.close()
+        raise ValueError(f"The cache {path} was built with the model {cache_model_name}, not {model_name}")
+    return conn
+
+
+class PredictionCache:
+    """An on-disk cache of predictions, keyed by DOI and a hash of the raw title and abstract fields.
+
+    Lookups are made against cache.sqlite in the cache folder, which is only read during a run. New predictions are
+    written to a delta database per archive in the deltas folder, so that workers never write to the same file, and
+    are merged into cache.sqlite by compact_cache.
+    """
+
+    def __init__(self, path: str, name: str, model_name: str):
+        """Open the cache.
+
+        :param path: the cache folder.
+        :param name: the name of the archive, used to name the delta database.
+        :param model_name: the name of the model that makes the predictions.
+        """
+
+        self.hits = 0
+        self.misses = 0
+        self.reader = None
+        cache_file_path = os.path.join(path, CACHE_FILE_NAME)
+        if os.path.isfile(cache_file_path):
+            self.reader = connect(cache_file_path, model_name, read_only=True)
+        deltas_path = os.path.join(path, DELTAS_FOLDER)
+        os.makedirs(deltas_path, exist_ok=True)
+        self.writer = connect(os.path.join(deltas_path, f"{name}.sqlite"), model_name)
+
+    def get(self, doi: str, key: bytes) -> Optional[Tuple[Optional[str], Optional[str], Optional[float]]]:
+        """Get a cached prediction.
+
+        :param doi: the DOI.
+        :param key: the hash of the raw fields, see fields_key.
+        :return: the title, language and score, or None if the prediction is not cached.
+        """
+
+        result = None
+        if self.reader is not None:
+            result = self.reader.execute(
+                "SELECT title, language, score FROM predictions WHERE doi = ? AND key = ?", (doi, key)
+            ).fetchone()
+        if result is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return result
+
+    def put_many(self, rows: Iterable[Tuple[str, bytes, Optional[str], Optional[str], Optional[float]]]):
+        """Save new predictions to the delta database.
+
+        :param rows: tuples of DOI, key, title, language and score.
+        :return: None.
+        """
+
+        self.writer.executemany("INSERT OR REPLACE INTO predictions VALUES (?, ?, ?, ?, ?)", rows)
+        self.writer.commit()
+
+    def close(self):
+        """Close the database connections.
+
+        :return: None.
+        """
+
+        if self.reader is not None:
+            self.reader.close()
+        self.writer.close()
+
+
+def compact_cache(path: str, model_name: str, vacuum: bool = False):
+    """Merge the delta databases into cache.sqlite and delete them.
+
+    :param path: the cache folder.
+    :param model_name: the name of the model that made the predictions.
+    :param vacuum: whether to rebuild cache.sqlite afterwards to reclaim free space.
+    :return: the number of delta databases that were merged.
+    """
+
+    delta_paths = sorted(glob.glob(os.path.join(path, DELTAS_FOLDER, "*.sqlite")))
+    conn = connect(os.path.join(path, CACHE_FILE_NAME), model_name)
+    for delta_path in delta_paths:
+        # Check the model of the delta before merging it
+        connect(delta_path, model_name).close()
+        conn.execute("ATTACH DATABASE ? AS delta", (delta_path,))
+        conn.execute("INSERT OR REPLACE INTO predictions SELECT * FROM delta.predictions")
+        conn.commit()
+        conn.execute("DETACH DATABASE delta")
+        os.remove(delta_path)
+    if vacuum:
+        conn.execute("VACUUM")
+    conn.close()
+
+    return len(delta_paths)
@@ -0,0 +1,427 @@
+# Copyright 2022 Curtin University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import collections
+import json
+import time
+from typing import Dict, List, Optional, Tuple
+
+import click
+
+from engines import ENGINES, LanguageEngine, load_engine
+from memo import LruMemo
+from predict_language import DEFAULT_MODEL_PATH, OUTPUT_COLUMNS, classify_batch
+
+# The fields of the records that are sent to the service, which are the columns of the input archives
+RECORD_FIELDS = ["doi", "mag_title", "crossref_title", "mag_abstract", "crossref_abstract"]
+
+# The percentiles of the request latencies that are reported
+LATENCY_PERCENTILES = [50, 90, 99]
+
+HTTP_REASONS = {
+    200: "OK",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    500: "Internal Server Error",
+}
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    """Get a percentile of values with the nearest rank method.
+
+    :param values: the values.
+    :param q: the percentile, between 0 and 100.
+    :return: the percentile, or None when there are no values.
+    """
+
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, int(round(q / 100 * len(values))) - 1))]
+
+
+class ServiceStats:
+    """Counts the requests, records and batches of the service and keeps the latencies of the latest requests."""
+
+    def __init__(self, window: int = 10000):
+        """Create the counters.
+
+        :param window: the number of latest request latencies that the percentiles are computed from.
+        """
+
+        self.start = time.monotonic()
+        self.latencies = collections.deque(maxlen=window)
+        self.counters = collections.Counter()
+
+    def add_request(self, num_records: int, seconds: float):
+        """Count a request.
+
+        :param num_records: the number of records in the request.
+        :param seconds: the time from receiving the request to sending its response.
+        :return: None.
+        """
+
+        self.counters["requests"] += 1
+        self.counters["records"] += num_records
+        self.latencies.append(seconds)
+
+    def add_batch(self, num_records: int, metrics: collections.Counter):
+        """Count a micro-batch.
+
+        :param num_records: the number of records in the batch.
+        :param metrics: the metrics of classify_batch.
+        :return: None.
+        """
+
+        self.counters["batches"] += 1
+        self.counters["batch_records"] += num_records
+        self.counters.update(metrics)
+
+    def summary(self) -> Dict:
+        """Summarise the counters.
+
+        :return: the uptime, the numbers of requests, records and batches, the mean batch size, the throughput in
+        records per second since the service started, the latency percentiles in milliseconds and the metrics of
+        classify_batch.
+        """
+
+        uptime = time.monotonic() - self.start
+        latencies = list(self.latencies)
+        summary = {
+            "uptime_seconds": uptime,
+            "requests": self.counters["requests"],
+            "records": self.counters["records"],
+            "batches": self.counters["batches"],
+            "mean_batch_size": self.counters["batch_records"] / max(self.counters["batches"], 1),
+            "records_per_second": self.counters["records"] / max(uptime, 1e-9),
+        }
+        for q in LATENCY_PERCENTILES:
+            value = percentile(latencies, q)
+            summary[f"p{q}_latency_ms"] = None if value is None else value * 1000
+        summary.update(
+            {key: value for key, value in self.counters.items() if key not in summary and key != "batch_records"}
+        )
+        return summary
+
+
+class MicroBatcher:
+    """Coalesces the records of concurrent requests into micro-batches.
+
+    A batch is classified when it has max_batch_size records, or max_delay seconds after its first request arrived,
+    whichever comes first, so that a request waits at most max_delay seconds for others to arrive. Requests that
+    arrived while the previous batch was classified join the next batch even when max_delay is 0. Batches are
+    classified one at a time in a worker thread, so that the event loop keeps receiving requests meanwhile.
+    """
+
+    def __init__(
+        self,
+        engine: LanguageEngine,
+        max_batch_size: int = 256,
+        max_delay: float = 0.005,
+        max_text_chars: Optional[int] = None,
+        memo: Optional[LruMemo] = None,
+        stats: Optional[ServiceStats] = None,
+    ):
+        """Create the batcher, call run to start it.
+
+        :param engine: the language identification engine.
+        :param max_batch_size: the maximum number of records in a batch, larger requests are classified on their own.
+        :param max_delay: the maximum time in seconds that a request waits for other requests.
+        :param max_text_chars: the maximum number of characters of text to predict, longer texts are truncated.
+        :param memo: a memo of the pre-processed fields and predictions of short texts.
+        :param stats: the counters of the service.
+        """
+
+        self.engine = engine
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.max_text_chars = max_text_chars
+        self.memo = memo
+        self.stats = stats if stats is not None else ServiceStats()
+        self.queue = asyncio.Queue()
+
+    async def predict(self, rows: List[List[str]]) -> List[Tuple]:
+        """Predict the languages of input rows together with the rows of other requests.
+
+        :param rows: the input rows: doi, mag_title, crossref_title, mag_abstract and crossref_abstract.
+        :return: the output rows: doi, title, language and score.
+        """
+
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((rows, future))
+        return await future
+
+    async def next_batch(self) -> List[Tuple[List[List[str]], asyncio.Future]]:
+        """Wait for the requests of the next batch.
+
+        :return: the rows and future of each request.
+        """
+
+        loop = asyncio.get_running_loop()
+        requests = [await self.queue.get()]
+        size = len(requests[0][0])
+        deadline = loop.time() + self.max_delay
+        while size < self.max_batch_size:
+            # Requests that arrived while the previous batch was classified are always taken
+            if not self.queue.empty():
+                request = self.queue.get_nowait()
+            else:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    request = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+            requests.append(request)
+            size += len(request[0])
+        return requests
+
+    async def classify(self, rows: List[List[str]]) -> List[Tuple]:
+        """Classify rows in a worker thread and count them as a batch.
+
+        :param rows: the input rows.
+        :return: the output rows.
+        """
+
+        output, _, metrics = await asyncio.get_running_loop().run_in_executor(
+            None, lambda: classify_batch(self.engine, rows, max_text_chars=self.max_text_chars, memo=self.memo)
+        )
+        self.stats.add_batch(len(rows), metrics)
+        return output
+
+    async def run(self):
+        """Classify batches until cancelled.
+
+        When a batch fails, the rows of each of its requests are classified again on their own, so that a request that
+        can not be classified only fails itself and not the other requests of the batch.
+
+        :return: None.
+        """
+
+        while True:
+            requests = await self.next_batch()
+            try:
+                output = await self.classify([row for rows, _ in requests for row in rows])
+            except Exception as e:
+                if len(requests) == 1:
+                    if not requests[0][1].done():
+                        requests[0][1].set_exception(e)
+                    continue
+                for rows, future in requests:
+                    try:
+                        request_output = await self.classify(rows)
+                    except Exception as request_error:
+                        if not future.done():
+                            future.set_exception(request_error)
+                    else:
+                        if not future.done():
+                            future.set_result(request_output)
+                continue
+
+            start = 0
+            for rows, future in requests:
+                if not future.done():
+                    future.set_result(output[start : start + len(rows)])
+                start += len(rows)
+
+
+def parse_records(body: bytes) -> List[List[str]]:
+    """Parse the records of a request.
+
+    :param body: a JSON record, or an object with a list of records in its records field. Each record has a doi and
+    optionally a mag_title, crossref_title, mag_abstract and crossref_abstract, which are strings or null.
+    :return: the input rows.
+    """
+
+    data = json.loads(body)
+    records = data["records"] if isinstance(data, dict) and "records" in data else [data]
+    if not isinstance(records, list) or not all(isinstance(record, dict) for record in records):
+        raise ValueError("expected a record or an object with a list of records")
+    for i, record in enumerate(records):
+        for field in RECORD_FIELDS:
+            value = record.get(field)
+            if value is not None and not isinstance(value, str):
+                raise ValueError(f"expected a string or null for {field} of record {i}, got {type(value).__name__}")
+    return [[record.get(field) or "" for field in RECORD_FIELDS] for record in records]
+
+
+class LanguageService:
+    """A minimal HTTP/1.1 server, with keep-alive, that predicts the languages of records.
+
+    POST /predict classifies the records in the body, see parse_records, and returns their predictions, GET /metrics
+    returns the counters of the service and GET /health returns ok.
+    """
+
+    def __init__(self, batcher: MicroBatcher):
+        """Create the service.
+
+        :param batcher: the micro-batcher that classifies the records.
+        """
+
+        self.batcher = batcher
+        self.stats = batcher.stats
+
+    async def handle_request(self, method: str, path: str, body: bytes) -> Tuple[int, Dict]:
+        """Handle a request.
+
+        :param method: the HTTP method.
+        :param path: the path.
+        :param body: the body.
+        :return: the HTTP status and the JSON response.
+        """
+
+        if path == "/health":
+            return 200, {"status": "ok"}
+        if path == "/metrics":
+            return 200, self.stats.summary()
+        if path != "/predict":
+            return 404, {"error": f"unknown path {path}"}
+        if method != "POST":
+            return 405, {"error": "use POST"}
+
+        start = time.perf_counter()
+        try:
+            rows = parse_records(body)
+        except (ValueError, KeyError) as e:
+            return 400, {"error": str(e)}
+        output = await self.batcher.predict(rows)
+        self.stats.add_request(len(rows), time.perf_counter() - start)
+        return 200, {"predictions": [dict(zip(OUTPUT_COLUMNS, row)) for row in output]}
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Handle the requests of a connection until the client closes it.
+
+        :param reader: the stream to read requests from.
+        :param writer: the stream to write responses to.
+        :return: None.
+        """
+
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                method, path, version = request_line.decode("latin-1").split()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+                try:
+                    status, response = await self.handle_request(method, path.split("?")[0], body)
+                except Exception as e:
+                    status, response = 500, {"error": str(e)}
+                keep_alive = headers.get("connection", "").lower() != "close" and version == "HTTP/1.1"
+                payload = json.dumps(response).encode("utf-8")
+                writer.write(
+                    f"HTTP/1.1 {status} {HTTP_REASONS[status]}\r\n"
+                    f"Content-Type: application/json\r\n"
+                    f"Content-Length: {len(payload)}\r\n"
+                    f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode("latin-1") + payload
+                )
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+
+async def serve(service: LanguageService, host: str = "127.0.0.1", port: int = 8080, unix_socket: Optional[str] = None):
+    """Run the service until it is cancelled.
+
+    :param service: the service.
+    :param host: the host to listen on.
+    :param port: the port to listen on.
+    :param unix_socket: the path of a Unix socket to listen on instead of a TCP port.
+    :return: None.
+    """
+
+    batcher_task = asyncio.create_task(service.batcher.run())
+    if unix_socket is not None:
+        server = await asyncio.start_unix_server(service.handle_connection, unix_socket)
+    else:
+        server = await asyncio.start_server(service.handle_connection, host, port)
+    print(f"Listening on {unix_socket or f'{host}:{port}'}")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        batcher_task.cancel()
+
+
+@click.command()
+@click.option(
+    "--model-path",
+    type=click.Path(exists=True, file_okay=True, dir_okay=False),
+    default=DEFAULT_MODEL_PATH,
+    help="The path to the model",
+)
+@click.option("--engine", type=click.Choice(list(ENGINES)), default="fasttext", help="The language engine")
+@click.option("--host", type=click.STRING, default="127.0.0.1", help="The host to listen on")
+@click.option("--port", type=click.INT, default=8080, help="The port to listen on")
+@click.option("--unix-socket", type=click.Path(), default=None, help="Listen on a Unix socket instead of a port")
+@click.option("--max-batch-size", type=click.INT, default=256, help="The maximum number of records in a micro-batch")
+@click.option(
+    "--max-delay-ms",
+    type=click.FLOAT,
+    default=2,
+    help="The latency budget: the maximum time that a request waits for other requests to batch with",
+)
+@click.option(
+    "--max-text-chars",
+    type=click.IntRange(min=1),
+    default=None,
+    help="The maximum number of characters of text to predict for each record, longer texts are truncated",
+)
+@click.option(
+    "--memo-size",
+    type=click.FLOAT,
+    default=64,
+    help="The size in megabytes of the memo of pre-processed fields and predictions of short texts, 0 disables it",
+)
+def main(
+    model_path: str,
+    engine: str,
+    host: str,
+    port: int,
+    unix_socket: Optional[str],
+    max_batch_size: int,
+    max_delay_ms: float,
+    max_text_chars: Optional[int],
+    memo_size: float,
+):
+    """Predict the languages of records sent over HTTP, keeping the model loaded."""
+
+    start = time.perf_counter()
+    language_engine = load_engine(model_path, engine)
+    print(f"Loaded {language_engine.model_name} in {time.perf_counter() - start:.2f}s")
+    memo = LruMemo(int(memo_size * 1024 * 1024)) if memo_size > 0 else None
+    batcher = MicroBatcher(language_engine, max_batch_size, max_delay_ms / 1000, max_text_chars, memo)
+    try:
+        asyncio.run(serve(LanguageService(batcher), host, port, unix_socket))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
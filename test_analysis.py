@@ -0,0 +1,83 @@
+import os
+import random
+import statistics
+import tempfile
+import unittest
+
+import analysis
+from analysis import RunningStats, ShardSummary, cube_table, read_output_rows, summarise_shard, summary_rows
+from predict_language import open_output
+
+
+class TestAnalysis(unittest.TestCase):
+    def test_running_stats(self):
+        rng = random.Random(42)
+        values = [rng.random() for _ in range(1000)]
+
+        # Statistics merged from parts of a stream are the same as the statistics of the whole stream
+        stats = RunningStats()
+        for start in range(0, 1000, 300):
+            part = RunningStats()
+            for value in values[start : start + 300]:
+                part.add(value)
+            stats.merge(part)
+        stats.merge(RunningStats())
+        self.assertEqual(1000, stats.n)
+        self.assertAlmostEqual(statistics.mean(values), stats.get_mean())
+        self.assertAlmostEqual(statistics.stdev(values), stats.get_std())
+
+        # Like AVG and STDDEV in BigQuery
+        stats = RunningStats()
+        self.assertIsNone(stats.get_mean())
+        stats.add(0.5)
+        self.assertEqual(0.5, stats.get_mean())
+        self.assertIsNone(stats.get_std())
+
+    def test_summarise_shard(self):
+        rows = [
+            ("10.1000/1", "title", "en", 0.9),
+            ("10.1000/1", "other title", "en", 0.7),
+            ("10.1000/2", "titel", "de", 0.8),
+            ("10.1000/3", "", None, None),
+            ("10.1000/4", "title", "en", 0.5),
+        ]
+        analysis._metadata = {"10.1000/1": (2020, "journal-article"), "10.1000/3": (2020, "journal-article")}
+        try:
+            with tempfile.TemporaryDirectory() as tmp:
+                for output_format, file_name in [("csv", "a.csv.gz"), ("parquet", "a.parquet"), ("arrow", "a.arrow")]:
+                    path = os.path.join(tmp, file_name)
+                    writer = open_output(path, output_format)
+                    writer.write_rows(rows)
+                    writer.close()
+                    self.assertEqual(
+                        [(doi, language, score) for doi, _, language, score in rows], list(read_output_rows(path))
+                    )
+
+                summary = ShardSummary()
+                summary.merge(summarise_shard(path))
+        finally:
+            analysis._metadata = {}
+
+        names = {"en": "English", "de": "German"}
+        self.assertEqual(
+            [
+                ["English", "en", 3, 60.0, 0.7, 0.2],
+                ["German", "de", 1, 20.0, 0.8, None],
+                ["Unknown: no title or abstract", "null", 1, 20.0, None, None],
+            ],
+            [
+                [round(value, 6) if isinstance(value, float) else value for value in row]
+                for row in summary_rows(summary, names)
+            ],
+        )
+
+        # Each DOI is counted once, and outputs without a language are left out of the cube
+        cube = cube_table(summary, names)
+        self.assertEqual(
+            [(2020, "journal-article", "en", "English", 1)], [tuple(row)[:5] for row in cube.itertuples(index=False)]
+        )
+        self.assertAlmostEqual(0.8, cube.avg_score_sum[0] / cube.avg_score_weight[0])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,135 @@
+import gzip
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from click.testing import CliRunner
+
+from engines import ENGINES
+from predict_language import MultiprocessingBackend, SerialBackend, WorkUnit, cli, imap_bounded, run_archives
+from test_classify_batch import FakeEngine
+
+
+class FakeResult:
+    def __init__(self, pool, value):
+        self.pool = pool
+        self.value = value
+
+    def get(self):
+        self.pool.pending -= 1
+        return self.value
+
+
+class FakePool:
+    """Runs functions when they are submitted and records the most results that were pending at once."""
+
+    def __init__(self):
+        self.pending = 0
+        self.max_pending = 0
+
+    def apply_async(self, func, args):
+        self.pending += 1
+        self.max_pending = max(self.max_pending, self.pending)
+        return FakeResult(self, func(*args))
+
+
+class FakeRef:
+    def __init__(self, value):
+        self.value = value
+
+
+class FakeRay:
+    """Stands in for the ray module: tasks finish in the order that they were submitted."""
+
+    def __init__(self):
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def submit(self, actor, unit):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        return FakeRef((actor, unit))
+
+    def wait(self, refs, num_returns):
+        self.in_flight -= num_returns
+        return refs[:num_returns], refs[num_returns:]
+
+    def get(self, ref):
+        return ref.value
+
+
+def write_archive(path, num_rows):
+    with gzip.open(path, "wt", encoding="utf-8", newline="") as f:
+        f.write("doi,mag_title,crossref_title,mag_abstract,crossref_abstract\n")
+        for i in range(num_rows):
+            title = "the study of" if i % 3 else "die Studie der"
+            f.write(f"10.1/{i},,{title} {i},,\n")
+
+
+def read_output(path):
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        return f.read()
+
+
+class TestBackends(unittest.TestCase):
+    def test_imap_bounded(self):
+        pool = FakePool()
+        self.assertEqual([i * i for i in range(20)], list(imap_bounded(pool, lambda i: i * i, iter(range(20)), 3)))
+        self.assertEqual(3, pool.max_pending)
+        self.assertEqual(0, pool.pending)
+
+    def test_run_archives(self):
+        # max_in_flight is applied as given, also when it is less than the number of actors
+        for max_in_flight, expected_actors in [(2, {"a", "b"}), (6, {"a", "b", "c", "d"})]:
+            ray = FakeRay()
+            with mock.patch.dict("sys.modules", {"ray": ray}):
+                results = list(run_archives(["a", "b", "c", "d"], list(range(10)), ray.submit, max_in_flight))
+            self.assertEqual(list(range(10)), sorted(unit for _, unit in results))
+            self.assertEqual(max_in_flight, ray.max_in_flight)
+            self.assertEqual(expected_actors, {actor for actor, _ in results})
+
+    def test_serial_and_multiprocessing(self):
+        with tempfile.TemporaryDirectory() as path, mock.patch.dict(ENGINES, {"fake": FakeEngine}):
+            input_path = os.path.join(path, "input")
+            os.makedirs(input_path)
+            units = []
+            for name, num_rows in [("000000000000.csv.gz", 50), ("000000000001.csv.gz", 7)]:
+                write_archive(os.path.join(input_path, name), num_rows)
+                units.append(WorkUnit(os.path.join(input_path, name), num_rows))
+
+            outputs = {}
+            for name, backend in [
+                ("serial", SerialBackend("fake.bin", engine="fake")),
+                ("multiprocessing", MultiprocessingBackend("fake.bin", engine="fake", num_workers=2)),
+                (
+                    "split",
+                    MultiprocessingBackend("fake.bin", engine="fake", num_workers=2, split_archives=True),
+                ),
+            ]:
+                output_path = os.path.join(path, name)
+                os.makedirs(output_path)
+                results = list(backend.run(units, output_path, batch_size=4))
+                backend.close()
+                self.assertEqual([50, 7], sorted((result["rows"] for result in results), reverse=True))
+                outputs[name] = {
+                    unit.csv_path: read_output(os.path.join(output_path, os.path.basename(unit.csv_path)))
+                    for unit in units
+                }
+
+            self.assertEqual(outputs["serial"], outputs["multiprocessing"])
+            self.assertEqual(outputs["serial"], outputs["split"])
+            self.assertIn("10.1/1,the study of 1,en,0.75", outputs["serial"][units[0].csv_path])
+
+    def test_unsupported_options(self):
+        with tempfile.TemporaryDirectory() as path:
+            model_path = os.path.join(path, "fake.bin")
+            open(model_path, "wb").close()
+            args = ["predict-language", path, path, "--model-path", model_path]
+            runner = CliRunner()
+            result = runner.invoke(cli, args + ["--backend", "serial", "--split-archives"])
+            self.assertEqual(2, result.exit_code)
+            self.assertIn("--split-archives", result.output)
+            result = runner.invoke(cli, args + ["--backend", "multiprocessing", "--max-in-flight", "4"])
+            self.assertEqual(2, result.exit_code)
+            self.assertIn("--max-in-flight", result.output)
@@ -0,0 +1,77 @@
+import os
+import unittest
+
+from engines import LanguageEngine
+from predict_language import classify_batch
+
+
+class FakeEngine(LanguageEngine):
+    """Predicts English for texts that only contain English words and German for the rest, with a lower score for
+    texts that mix both."""
+
+    def __init__(self, model_path: str = "fake"):
+        self.model_name = os.path.basename(model_path)
+        self.calls = 0
+
+    def predict(self, texts, k):
+        self.calls += 1
+        labels, scores = [], []
+        for text in texts:
+            words = text.split()
+            english = sum(word in {"the", "study", "of"} for word in words) / len(words)
+            top = sorted([("en", english), ("de", 1 - english)], key=lambda item: -item[1])[:k]
+            labels.append([label for label, _ in top])
+            scores.append([score for _, score in top])
+        return labels, scores
+
+
+class TestClassifyBatch(unittest.TestCase):
+    batch = [
+        ["10.1/1", "", "the study", "", "of the study"],
+        ["10.1/2", "", "die Studie", "", "the study of"],
+        ["10.1/3", "", "", "", ""],
+        ["10.1/4", "", "the Studie", "", ""],
+    ]
+
+    def test_classify_batch(self):
+        rows, uncertain_rows, metrics = classify_batch(FakeEngine(), self.batch)
+        self.assertEqual(
+            [
+                ("10.1/1", "the study", "en", 1.0),
+                ("10.1/2", "die Studie", "en", 0.6),
+                ("10.1/3", None, None, None),
+                ("10.1/4", "the Studie", "en", 0.5),
+            ],
+            rows,
+        )
+        self.assertEqual([], uncertain_rows)
+        self.assertEqual(1, metrics["empty_rows"])
+
+    def test_top_k(self):
+        rows, _, _ = classify_batch(FakeEngine(), self.batch, top_k=2)
+        self.assertEqual(("10.1/2", "die Studie", "en", 0.6, "en:0.6000;de:0.4000"), rows[1])
+        self.assertEqual(("10.1/3", None, None, None, None), rows[2])
+
+    def test_threshold(self):
+        model = FakeEngine()
+        rows, uncertain_rows, metrics = classify_batch(model, self.batch, threshold=0.8)
+        self.assertEqual(4, len(rows))
+        self.assertEqual(2, metrics["uncertain_rows"])
+
+        # The title and abstract of a row that has both are predicted separately, in one call for the whole batch
+        self.assertEqual(2, model.calls)
+        self.assertEqual(
+            [
+                ("10.1/2", "die Studie", "en", 0.6, None, "de", 1.0, "en", 1.0, "die Studie the study of"),
+                ("10.1/4", "the Studie", "en", 0.5, None, None, None, None, None, "the Studie"),
+            ],
+            uncertain_rows,
+        )
+
+    def test_abstract_engine(self):
+        class IncompleteEngine(LanguageEngine):
+            model_name = "incomplete"
+
+        # Engines that do not implement predict fail when they are created, not in the middle of a run
+        with self.assertRaises(TypeError):
+            IncompleteEngine()
@@ -0,0 +1,112 @@
+import io
+import os
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from compression import COMPRESSIONS, ThreadedReader, ThreadedWriter, open_input, open_output_file
+
+DATA = b"".join(f"10.1/{i},The study of {i}\n".encode("utf-8") for i in range(20000))
+
+
+class FailingFile(io.RawIOBase):
+    """A file that fails after its first read or write."""
+
+    def __init__(self):
+        super().__init__()
+        self.calls = 0
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return True
+
+    def readinto(self, b):
+        self.calls += 1
+        if self.calls > 1:
+            raise ValueError("read failed")
+        b[:1] = b"x"
+        return 1
+
+    def write(self, b):
+        self.calls += 1
+        if self.calls > 1:
+            raise ValueError("write failed")
+        return len(b)
+
+
+def write_shim(path, name, script):
+    """Write an executable shell script to a folder, which is put first on the PATH to stand in for a command."""
+
+    shim_path = os.path.join(path, name)
+    with open(shim_path, "w") as f:
+        f.write(f"#!/bin/sh\n{script}\n")
+    os.chmod(shim_path, 0o755)
+
+
+class TestCompression(unittest.TestCase):
+    def round_trip(self, path, **kwargs):
+        with open_output_file(path, **kwargs) as f:
+            for i in range(0, len(DATA), 4096):
+                f.write(DATA[i : i + 4096])
+        return path
+
+    def test_round_trip(self):
+        with tempfile.TemporaryDirectory() as path, mock.patch("shutil.which", return_value=None):
+            for compression in ["gzip", "zstd"]:
+                for threaded in [False, True]:
+                    file_path = os.path.join(path, f"{compression}-{threaded}.csv{COMPRESSIONS[compression]}")
+                    self.round_trip(file_path, compression=compression, threaded=threaded)
+                    for threaded_read in [False, True]:
+                        with open_input(file_path, reader="gzip", threaded=threaded_read) as f:
+                            self.assertEqual(DATA, f.read())
+
+            # Files that are not compressed are read as they are
+            file_path = os.path.join(path, "plain.csv")
+            with open(file_path, "wb") as f:
+                f.write(DATA)
+            with open_input(file_path, threaded=True) as f:
+                self.assertEqual(DATA, f.read())
+
+    def test_threaded_reader_error(self):
+        reader = ThreadedReader(FailingFile())
+        self.assertEqual(b"x", reader.read(1))
+        with self.assertRaisesRegex(ValueError, "read failed"):
+            reader.read(1)
+        reader.close()
+
+    def test_threaded_writer_error(self):
+        writer = ThreadedWriter(FailingFile())
+        writer.write(b"a")
+        writer.write(b"b")
+        deadline = time.monotonic() + 10
+        while writer.error is None and time.monotonic() < deadline:
+            time.sleep(0.01)
+        with self.assertRaisesRegex(ValueError, "write failed"):
+            writer.write(b"c")
+        with self.assertRaisesRegex(ValueError, "write failed"):
+            writer.close()
+
+    def test_external_process(self):
+        with tempfile.TemporaryDirectory() as path:
+            bin_path = os.path.join(path, "bin")
+            os.makedirs(bin_path)
+            environ = {"PATH": f"{bin_path}{os.pathsep}{os.environ['PATH']}"}
+
+            # A pigz that runs gzip reads and writes the same files as the gzip module
+            write_shim(bin_path, "pigz", 'exec gzip "$@"')
+            with mock.patch.dict(os.environ, environ):
+                file_path = self.round_trip(os.path.join(path, "pigz.csv.gz"))
+                with open_input(file_path, reader="pigz") as f:
+                    self.assertEqual(DATA, f.read())
+
+            # A pigz that fails raises when the file written to it is closed, and at the end of the file read from it
+            write_shim(bin_path, "pigz", 'if [ "$1" != "-dc" ]; then cat > /dev/null; fi; exit 3')
+            with mock.patch.dict(os.environ, environ):
+                with self.assertRaisesRegex(OSError, "pigz exited with code 3"):
+                    self.round_trip(os.path.join(path, "failed.csv.gz"))
+                with self.assertRaisesRegex(OSError, "pigz exited with code 3"):
+                    with open_input(file_path, reader="pigz") as f:
+                        f.read()
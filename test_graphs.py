@@ -0,0 +1,82 @@
+import unittest
+
+import pandas as pd
+
+from graphs import CHARTS, Cube, SUM_COLUMNS, build_cube, chart_data, chart_fingerprint, concatenate_others
+
+
+def make_downloaded():
+    rows = [
+        (2020, "journal-article", "en", "English", 30, 0.9, 20.0),
+        (2020, "book", "en", "English", 10, 0.7, None),
+        (2021, "journal-article", "en", "English", 20, 0.8, 5.0),
+        (2020, "journal-article", "de", "German", 10, 0.6, 4.0),
+        (2021, "journal-article", "fr", "French", 5, 0.5, 2.0),
+    ]
+    downloaded = pd.DataFrame(
+        rows, columns=["published_year", "crossref_type", "code", "name", "total", "avg_score", "mean_citations"]
+    )
+    for col in SUM_COLUMNS[1:]:
+        downloaded[col] = downloaded.total // 2
+    downloaded["mean_citations2y"] = downloaded.mean_citations
+    return downloaded
+
+
+class TestCube(unittest.TestCase):
+    def test_rollup(self):
+        cube = Cube(build_cube(make_downloaded()))
+
+        rolled = cube.rollup(["name"])
+        self.assertEqual(["English", "French", "German"], rolled.name.tolist())
+        self.assertEqual([60, 5, 10], rolled.total.tolist())
+
+        # Averages are weighted by the number of outputs and unknown averages are left out
+        self.assertAlmostEqual((30 * 0.9 + 10 * 0.7 + 20 * 0.8) / 60, rolled.avg_score[0])
+        self.assertAlmostEqual((30 * 20 + 20 * 5) / 50, rolled.mean_citations[0])
+
+        # Filters
+        rolled = cube.rollup(["published_year"], crossref_types=["journal-article"], exclude_codes=["de"])
+        self.assertEqual([2020, 2021], rolled.published_year.tolist())
+        self.assertEqual([30, 25], rolled.total.tolist())
+        rolled = cube.rollup(["code"], published_years=[2020], codes=["en"])
+        self.assertEqual([40], rolled.total.tolist())
+        self.assertTrue(pd.isna(cube.rollup(["crossref_type"], crossref_types=["book"]).mean_citations[0]))
+
+        # Roll-ups are kept, and copies are returned so that charts can change them
+        rolled = cube.rollup(["name"])
+        rolled["total"] = 0
+        self.assertEqual([60, 5, 10], cube.rollup(["name"]).total.tolist())
+        self.assertEqual(4, len(cube.rollups))
+
+    def test_partial_cube(self):
+        # Cubes built by analysis.py only have the total and the average score
+        data = build_cube(make_downloaded())[
+            ["published_year", "crossref_type", "code", "name", "total", "avg_score_sum", "avg_score_weight"]
+        ]
+        rolled = Cube(data).rollup(["name"])
+        self.assertEqual([60, 5, 10], rolled.total.tolist())
+        self.assertIn("avg_score", rolled.columns)
+        self.assertNotIn("mean_citations", rolled.columns)
+        self.assertEqual(["total"], CHARTS[0].columns)
+
+    def test_concatenate_others(self):
+        cube = Cube(build_cube(make_downloaded()))
+        graph_data = concatenate_others(cube.rollup(["name"]), slices=1)
+        self.assertEqual(["English", "Others"], graph_data["index"].tolist())
+        self.assertEqual([60, 15], graph_data.total.tolist())
+
+    def test_chart_fingerprint(self):
+        cube = Cube(build_cube(make_downloaded()))
+        chart = CHARTS[0]
+        fingerprint = chart_fingerprint(chart, chart_data(chart, cube))
+        self.assertEqual(fingerprint, chart_fingerprint(chart, chart_data(chart, cube)))
+
+        # Charts change when their data or their spec changes
+        downloaded = make_downloaded()
+        downloaded.loc[0, "total"] += 1
+        self.assertNotEqual(fingerprint, chart_fingerprint(chart, chart_data(chart, Cube(build_cube(downloaded)))))
+        self.assertNotEqual(fingerprint, chart_fingerprint(CHARTS[2], chart_data(chart, cube)))
+
+
+if __name__ == "__main__":
+    unittest.main()
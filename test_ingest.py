@@ -0,0 +1,82 @@
+import os
+import tempfile
+import unittest
+
+from ingest import balance_files, clean_text, parse_fields, transform_record, write_shards
+from predict_language import read_csv_gz
+
+
+class TestIngest(unittest.TestCase):
+    def test_clean_text(self):
+        self.assertEqual("Title", clean_text("  Title\x00 "))
+        self.assertIsNone(clean_text(None))
+        self.assertIsNone(clean_text(" \x00 "))
+        self.assertIsNone(clean_text(" [NO TITLE AVAILABLE] ", "[NO TITLE AVAILABLE]"))
+        self.assertEqual("[NO TITLE AVAILABLE]", clean_text("[NO TITLE AVAILABLE]"))
+
+    def test_transform_record(self):
+        record = {
+            "doi": " 10.1000/abc ",
+            "crossref": {"title": ["A title", "[NO TITLE AVAILABLE]"], "abstract": "An abstract"},
+            "mag": {"OriginalTitle": "", "abstract": "A MAG abstract\x00"},
+        }
+        self.assertEqual(
+            [
+                ["10.1000/ABC", None, "A title", "A MAG abstract", "An abstract"],
+                ["10.1000/ABC", None, None, "A MAG abstract", "An abstract"],
+            ],
+            list(transform_record(record)),
+        )
+
+        # Records without Crossref titles are dropped, as by the UNNEST of create_dataset.sql
+        self.assertEqual([], list(transform_record({"doi": "10.1000/abc", "crossref": {"title": []}})))
+        self.assertEqual([], list(transform_record({"doi": "10.1000/abc", "mag": None})))
+
+        # Crossref metadata, with other field paths
+        fields = parse_fields(["doi=DOI", "crossref_titles=title", "crossref_abstract=abstract"])
+        self.assertEqual(
+            [["10.1000/ABC", None, "A title", None, None]],
+            list(transform_record({"DOI": "10.1000/abc", "title": ["A title"]}, fields)),
+        )
+
+    def test_balance_files(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            paths = []
+            for name, size in [("a", 10), ("b", 40), ("c", 20), ("d", 20)]:
+                paths.append(os.path.join(tmp, name))
+                with open(paths[-1], "wb") as f:
+                    f.write(b"x" * size)
+
+            assigned = balance_files(paths, 2)
+            self.assertEqual([["b", "a"], ["c", "d"]], [[os.path.basename(p) for p in files] for files in assigned])
+            self.assertEqual(1, len(balance_files(paths[:1], 4)))
+
+    def test_write_shards(self):
+        rows = [[f"10.1000/{i}", None, "A title", None, "An abstract"] for i in range(100)]
+        with tempfile.TemporaryDirectory() as tmp:
+            num_rows, shards = write_shards(iter(rows), tmp, 3, shard_size=300)
+            self.assertEqual(100, num_rows)
+            self.assertEqual(["000300000000.csv.gz", "000300000001.csv.gz"], shards[:2])
+
+            read = [row for shard in shards for row in read_csv_gz(os.path.join(tmp, shard))]
+            self.assertEqual([[value or "" for value in row] for row in rows], read)
+            self.assertTrue(all(len(list(read_csv_gz(os.path.join(tmp, shard)))) == 10 for shard in shards))
+            self.assertEqual(sorted(shards), sorted(os.listdir(tmp)))
+
+    def test_write_shards_interrupted(self):
+        def fail():
+            for i in range(100):
+                yield [f"10.1000/{i}", None, "A title", None, "An abstract"]
+            raise ValueError("interrupted")
+
+        # The shards that were complete are renamed, the one being written is left as a temporary file
+        with tempfile.TemporaryDirectory() as tmp:
+            with self.assertRaises(ValueError):
+                write_shards(fail(), tmp, 0, shard_size=300)
+            names = sorted(os.listdir(tmp))
+            self.assertEqual(["000000000009.csv.gz.tmp"], [name for name in names if not name.endswith(".csv.gz")])
+            self.assertEqual(9, len([name for name in names if name.endswith(".csv.gz")]))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,109 @@
+import gzip
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from click.testing import CliRunner
+
+from engines import ENGINES
+from predict_language import RunManifest, cli
+from test_classify_batch import FakeEngine
+
+
+class TestRunManifest(unittest.TestCase):
+    def make_result(self, csv_path: str, output_file_path: str):
+        stat = os.stat(csv_path)
+        return dict(
+            csv_path=csv_path,
+            input_size=stat.st_size,
+            input_mtime=stat.st_mtime,
+            rows=1,
+            output_size=os.path.getsize(output_file_path),
+            sha256="",
+        )
+
+    def test_is_complete(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            csv_path = os.path.join(tmp, "input.csv.gz")
+            output_file_path = os.path.join(tmp, "output.csv.gz")
+            manifest_path = os.path.join(tmp, "manifest.jsonl")
+            for path in [csv_path, output_file_path]:
+                with open(path, "w") as f:
+                    f.write("data")
+
+            manifest = RunManifest(manifest_path)
+            self.assertFalse(manifest.is_complete(csv_path, output_file_path))
+            manifest.add(self.make_result(csv_path, output_file_path))
+            self.assertTrue(manifest.is_complete(csv_path, output_file_path))
+
+            # Reloaded from disk, ignoring a partially written line
+            with open(manifest_path, "a") as f:
+                f.write('{"name": "other')
+            manifest = RunManifest(manifest_path)
+            self.assertTrue(manifest.is_complete(csv_path, output_file_path))
+            manifest.add(self.make_result(csv_path, output_file_path))
+            with open(manifest_path) as f:
+                self.assertEqual(2, len(f.readlines()))
+
+            # A changed input or a missing output is not complete
+            with open(csv_path, "a") as f:
+                f.write("more data")
+            self.assertFalse(RunManifest(manifest_path).is_complete(csv_path, output_file_path))
+            os.remove(output_file_path)
+            self.assertFalse(RunManifest(manifest_path).is_complete(csv_path, output_file_path))
+
+    def test_options(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            csv_path = os.path.join(tmp, "input.csv.gz")
+            output_file_path = os.path.join(tmp, "output.csv.gz")
+            for path in [csv_path, output_file_path]:
+                with open(path, "w") as f:
+                    f.write("data")
+
+            options = dict(output_format="csv", compression="gzip", max_text_chars=None)
+            manifest = RunManifest(os.path.join(tmp, "manifest.jsonl"))
+            manifest.add(self.make_result(csv_path, output_file_path), options)
+            self.assertTrue(manifest.is_complete(csv_path, output_file_path, options=options))
+            self.assertFalse(manifest.is_complete(csv_path, output_file_path, options={**options, "max_text_chars": 5}))
+
+    def test_rerun_with_changed_option(self):
+        with tempfile.TemporaryDirectory() as tmp, mock.patch.dict(ENGINES, {"fasttext": FakeEngine}):
+            input_path, output_path = os.path.join(tmp, "input"), os.path.join(tmp, "output")
+            os.makedirs(input_path)
+            os.makedirs(output_path)
+            model_path = os.path.join(tmp, "fake.bin")
+            open(model_path, "wb").close()
+            with gzip.open(os.path.join(input_path, "000000000000.csv.gz"), "wt") as f:
+                f.write("doi,mag_title,crossref_title,mag_abstract,crossref_abstract\n10.1/1,,die the study,,\n")
+
+            def run(*args):
+                command = ["predict-language", input_path, output_path, "--model-path", model_path]
+                result = CliRunner().invoke(cli, command + ["--backend", "serial", *args])
+                self.assertEqual(0, result.exit_code, result.output)
+                return result.output
+
+            self.assertNotIn("Skipping", run())
+            self.assertIn("Skipping completed task", run())
+
+            # An archive completed with other options that change the output is run again
+            self.assertNotIn("Skipping", run("--max-text-chars", "5"))
+            with gzip.open(os.path.join(output_path, "000000000000.csv.gz"), "rt") as f:
+                self.assertIn("10.1/1,die the study,de,1.0", f.read())
+            self.assertIn("Skipping completed task", run("--max-text-chars", "5"))
+
+            # A threshold writes uncertain files and top-k changes the columns, so both run the archives again
+            self.assertNotIn("Skipping", run("--max-text-chars", "5", "--threshold", "0.9"))
+            self.assertTrue(os.path.isfile(os.path.join(output_path, "uncertain", "000000000000.csv.gz")))
+            self.assertIn("Skipping completed task", run("--max-text-chars", "5", "--threshold", "0.9"))
+            os.remove(os.path.join(output_path, "uncertain", "000000000000.csv.gz"))
+            self.assertNotIn("Skipping", run("--max-text-chars", "5", "--threshold", "0.9"))
+            self.assertNotIn("Skipping", run("--max-text-chars", "5", "--top-k", "2"))
+            with gzip.open(os.path.join(output_path, "000000000000.csv.gz"), "rt") as f:
+                self.assertEqual("doi,title,language,score,languages", f.readline().strip())
+
+            # Predictions of another model are not reused
+            self.assertIn("Skipping completed task", run("--max-text-chars", "5", "--top-k", "2"))
+            other_model_path = os.path.join(tmp, "other.bin")
+            open(other_model_path, "wb").close()
+            self.assertNotIn("Skipping", run("--max-text-chars", "5", "--top-k", "2", "--model-path", other_model_path))
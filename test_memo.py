@@ -0,0 +1,95 @@
+import unittest
+from unittest import mock
+
+from memo import LruMemo
+from predict_language import predict_batch, preprocess_fields
+from test_classify_batch import FakeEngine
+
+
+class TestLruMemo(unittest.TestCase):
+    def test_get_put(self):
+        memo = LruMemo()
+        self.assertIsNone(memo.get("predict", "Editorial"))
+        memo.put("predict", "Editorial", ("en", 0.9))
+        self.assertEqual(("en", 0.9), memo.get("predict", "Editorial"))
+
+        # Kinds are memoized separately
+        self.assertIsNone(memo.get("preprocess", "Editorial"))
+        self.assertEqual({"predict": 1}, memo.hits)
+        self.assertEqual({"predict": 1, "preprocess": 1}, memo.misses)
+
+        # Empty and long strings are not memoized or counted
+        memo = LruMemo(max_key_chars=10)
+        memo.put("predict", "", "en")
+        memo.put("predict", "a" * 11, "en")
+        self.assertIsNone(memo.get("predict", "a" * 11))
+        self.assertEqual(0, len(memo.entries))
+        self.assertEqual({}, memo.misses)
+
+    def test_eviction(self):
+        memo = LruMemo()
+        memo.put("preprocess", "key0", "value")
+        entry_size = memo.bytes
+        memo = LruMemo(max_bytes=entry_size * 3)
+        for i in range(3):
+            memo.put("preprocess", f"key{i}", "value")
+        self.assertEqual(entry_size * 3, memo.bytes)
+
+        # Using key0 makes key1 the least recently used entry, which is evicted by key3
+        memo.get("preprocess", "key0")
+        memo.put("preprocess", "key3", "value")
+        self.assertEqual(entry_size * 3, memo.bytes)
+        self.assertIsNone(memo.get("preprocess", "key1"))
+        for key in ["key0", "key2", "key3"]:
+            self.assertEqual("value", memo.get("preprocess", key))
+
+    def test_call(self):
+        calls = []
+
+        def upper(text):
+            calls.append(text)
+            return text.upper()
+
+        memo = LruMemo()
+        self.assertEqual("FRONT MATTER", memo.call("preprocess", upper, "front matter"))
+        self.assertEqual("FRONT MATTER", memo.call("preprocess", upper, "front matter"))
+        self.assertEqual(["front matter"], calls)
+
+    def test_preprocess_fields(self):
+        # Fields with markup are memoized and give the same results as without the memo
+        row = ["10.1000/1", "", "<i>Editorial</i>", "", "A plain abstract"]
+        memo = LruMemo()
+        expected = preprocess_fields(row)
+        self.assertEqual(expected, preprocess_fields(row, memo))
+        self.assertEqual(expected, preprocess_fields(row, memo))
+        self.assertEqual({"preprocess": 1}, memo.hits)
+        self.assertEqual(1, len(memo.entries))
+
+    def test_predict_batch(self):
+        # Texts predicted before are looked up instead of predicted again
+        engine = FakeEngine()
+        memo = LruMemo()
+        texts = ["the study", "", "die Studie"]
+        expected = engine.predict_batch(texts)
+        self.assertEqual(expected, predict_batch(engine, texts, memo))
+        engine.calls = 0
+        self.assertEqual(expected, predict_batch(engine, texts, memo))
+        self.assertEqual(0, engine.calls)
+        self.assertEqual({"predict": 2}, memo.hits)
+
+    def test_predict_batch_duplicates(self):
+        # Each distinct text of a batch is predicted once, with or without a memo
+        texts = ["the study", "die Studie", "the study", "", "the study", "die Studie"]
+        for memo in [None, LruMemo()]:
+            engine = FakeEngine()
+            expected = engine.predict_batch(texts)
+            with mock.patch.object(engine, "predict", wraps=engine.predict) as predict:
+                self.assertEqual(expected, predict_batch(engine, texts, memo))
+            self.assertEqual(["the study", "die Studie"], predict.call_args[0][0])
+            if memo is not None:
+                self.assertEqual({"predict": 3}, memo.hits)
+                self.assertEqual({"predict": 2}, memo.misses)
+
+
+if __name__ == "__main__":
+    unittest.main()
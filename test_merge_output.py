@@ -0,0 +1,123 @@
+import os
+import random
+import tempfile
+import unittest
+
+from merge_output import DoiIndex, choose_row, merge_output, write_runs, write_sorted_shards
+from predict_language import open_output, read_csv_gz
+
+
+class TestMergeOutput(unittest.TestCase):
+    def test_choose_row(self):
+        rows = [
+            ["10.1000/1", "", "", ""],
+            ["10.1000/1", "A title", "en", "0.5"],
+            ["10.1000/1", "Ein Titel", "de", "0.9"],
+            ["10.1000/1", "Un titre", "fr", "0.9"],
+        ]
+        # The choice does not depend on the order of the duplicates
+        for _ in range(5):
+            random.shuffle(rows)
+            self.assertEqual(["10.1000/1", "Ein Titel", "de", "0.9"], choose_row(rows))
+        self.assertEqual(["10.1000/1", "", "", ""], choose_row([["10.1000/1", "", "", ""]]))
+
+    def test_merge_output(self):
+        rng = random.Random(42)
+        dois = [f"10.1000/{i:04d}" for i in range(1000)]
+        rows = [(doi, f"title {doi}", "en", 0.5) for doi in dois]
+        # Duplicates of some DOIs, with a higher score, in other files
+        rows += [(doi, f"titre {doi}", "fr", 0.9) for doi in dois[::7]]
+        rng.shuffle(rows)
+
+        with tempfile.TemporaryDirectory() as input_path, tempfile.TemporaryDirectory() as output_path:
+            paths = []
+            for i, output_format in enumerate(["csv", "parquet", "csv"]):
+                paths.append(os.path.join(input_path, f"{i:012d}.{'csv.gz' if output_format == 'csv' else 'parquet'}"))
+                writer = open_output(paths[-1], output_format)
+                writer.write_rows(rows[i::3])
+                writer.close()
+
+            result = merge_output(
+                paths, output_path, run_rows=100, shard_rows=300, block_rows=50, num_workers=2, level=1
+            )
+            self.assertEqual({"input_rows": len(rows), "rows": 1000, "shards": 4, "blocks": 20}, result)
+            self.assertEqual(
+                ["doi-00000.csv.gz", "doi-00001.csv.gz", "doi-00002.csv.gz", "doi-00003.csv.gz", "doi_index.csv"],
+                sorted(os.listdir(output_path)),
+            )
+
+            # The shards are sorted by DOI and can be read as regular .csv.gz files
+            merged = [row for i in range(4) for row in read_csv_gz(os.path.join(output_path, f"doi-{i:05d}.csv.gz"))]
+            self.assertEqual(dois, [row[0] for row in merged])
+            self.assertEqual(["10.1000/0007", "titre 10.1000/0007", "fr", "0.9"], merged[7])
+
+            index = DoiIndex(output_path)
+            self.assertEqual(
+                {"doi": "10.1000/0999", "title": "title 10.1000/0999", "language": "en", "score": 0.5},
+                index.lookup(" 10.1000/0999"),
+            )
+            self.assertEqual("fr", index.lookup("10.1000/0350")["language"])
+            self.assertIsNone(index.lookup("10.1000/1000"))
+            self.assertIsNone(index.lookup("10.0999/1"))
+
+    def test_same_names(self):
+        # Output files with the same name before the extension are sorted at the same time without sharing runs
+        with tempfile.TemporaryDirectory() as input_path, tempfile.TemporaryDirectory() as output_path:
+            paths = []
+            for i, extension in enumerate([".csv.gz", ".parquet", ".arrow"]):
+                paths.append(os.path.join(input_path, f"000000000000{extension}"))
+                writer = open_output(paths[-1], {".csv.gz": "csv", ".parquet": "parquet", ".arrow": "arrow"}[extension])
+                writer.write_rows([(f"10.1000/{i}{j:03d}", "A title", "en", 0.5) for j in range(100)])
+                writer.close()
+
+            result = merge_output(paths, output_path, run_rows=30, num_workers=3, level=1)
+            self.assertEqual({"input_rows": 300, "rows": 300, "shards": 1, "blocks": 1}, result)
+
+    def test_fan_in(self):
+        rng = random.Random(42)
+        rows = [(f"10.1000/{i:04d}", f"title {i}", "en", round(rng.random(), 2)) for i in range(300)]
+        rows += [(f"10.1000/{i:04d}", f"titre {i}", "fr", round(rng.random(), 2)) for i in range(0, 300, 3)]
+        rng.shuffle(rows)
+
+        with tempfile.TemporaryDirectory() as input_path:
+            paths = []
+            for i in range(20):
+                paths.append(os.path.join(input_path, f"{i:012d}.csv.gz"))
+                writer = open_output(paths[-1])
+                writer.write_rows(rows[i::20])
+                writer.close()
+
+            # The rows of small files are packed into the same runs
+            with tempfile.TemporaryDirectory() as run_path:
+                runs, num_rows = write_runs(0, paths, run_path, 1000)
+                self.assertEqual((1, len(rows)), (len(runs), num_rows))
+
+            # 40 runs are merged two at a time, in several passes, with the same result as merging them at once
+            shards = {}
+            for fan_in in [2, 256]:
+                with tempfile.TemporaryDirectory() as output_path:
+                    result = merge_output(paths, output_path, run_rows=10, block_rows=50, num_workers=2, fan_in=fan_in)
+                    self.assertEqual({"input_rows": len(rows), "rows": 300, "shards": 1, "blocks": 6}, result)
+                    self.assertEqual(["doi-00000.csv.gz", "doi_index.csv"], sorted(os.listdir(output_path)))
+                    shards[fan_in] = list(read_csv_gz(os.path.join(output_path, "doi-00000.csv.gz")))
+            self.assertEqual(shards[256], shards[2])
+            self.assertEqual([f"10.1000/{i:04d}" for i in range(300)], [row[0] for row in shards[2]])
+
+    def test_write_sorted_shards_interrupted(self):
+        def fail():
+            for i in range(100):
+                yield [f"10.1000/{i:04d}", "A title", "en", "0.5"]
+            raise ValueError("interrupted")
+
+        # The complete shards are renamed, the shard being written and the index are left as temporary files
+        with tempfile.TemporaryDirectory() as output_path:
+            with self.assertRaises(ValueError):
+                write_sorted_shards(fail(), output_path, shard_rows=40, block_rows=20)
+            self.assertEqual(
+                ["doi-00000.csv.gz", "doi-00001.csv.gz", "doi-00002.csv.gz.tmp", "doi_index.csv.tmp"],
+                sorted(os.listdir(output_path)),
+            )
+
+
+if __name__ == "__main__":
+    unittest.main()
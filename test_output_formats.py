@@ -0,0 +1,58 @@
+import json
+import os
+import tempfile
+import unittest
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from predict_language import OUTPUT_SCHEMA_PATH, open_output
+
+ROWS = [
+    ("10.1/1", "The study of languages", "en", 0.98),
+    ("10.1/2", None, None, None),
+    ("10.1/3", "Die Studie", "de", 0.5),
+]
+
+
+def read_table(path, output_format):
+    if output_format == "parquet":
+        return pq.read_table(path)
+    return pa.ipc.open_file(path).read_all()
+
+
+class TestOutputFormats(unittest.TestCase):
+    def test_output_formats(self):
+        with open(OUTPUT_SCHEMA_PATH) as f:
+            fields = json.load(f)
+        types = {"STRING": pa.string(), "FLOAT": pa.float64()}
+
+        with tempfile.TemporaryDirectory() as path:
+            for output_format in ["parquet", "arrow"]:
+                file_path = os.path.join(path, f"output.{output_format}")
+                # A row group size smaller than the rows, so that more than one row group is written
+                writer = open_output(file_path, output_format)
+                writer.row_group_size = 2
+                writer.write_rows(ROWS[:2])
+                writer.write_rows(ROWS[2:])
+                writer.close()
+
+                table = read_table(file_path, output_format)
+                self.assertEqual([field["name"] for field in fields], table.schema.names)
+                for field in fields:
+                    self.assertEqual(types[field["type"]], table.schema.field(field["name"]).type)
+                    self.assertEqual(field["mode"] == "NULLABLE", table.schema.field(field["name"]).nullable)
+                self.assertEqual(ROWS, [tuple(row.values()) for row in table.to_pylist()])
+                if output_format == "parquet":
+                    self.assertEqual(2, pq.ParquetFile(file_path).num_row_groups)
+
+    def test_languages_column(self):
+        with tempfile.TemporaryDirectory() as path:
+            file_path = os.path.join(path, "output.parquet")
+            writer = open_output(file_path, "parquet", with_languages=True)
+            writer.write_rows([row + (None if row[2] is None else f"{row[2]}:{row[3]:.4f}",) for row in ROWS])
+            writer.close()
+
+            table = pq.read_table(file_path)
+            self.assertEqual(pa.string(), table.schema.field("languages").type)
+            self.assertEqual(["en:0.9800", None, "de:0.5000"], table.column("languages").to_pylist())
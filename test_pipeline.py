@@ -0,0 +1,44 @@
+import unittest
+
+from predict_language import ThreadedRowWriter, prefetch
+
+
+class ListWriter:
+    def __init__(self):
+        self.rows = []
+        self.closed = False
+
+    def write_rows(self, rows):
+        self.rows.extend(rows)
+
+    def close(self):
+        self.closed = True
+
+
+class TestPipeline(unittest.TestCase):
+    def test_prefetch(self):
+        self.assertEqual(list(range(100)), list(prefetch(iter(range(100)))))
+
+        # Exceptions are raised to the consumer
+        def fail():
+            yield 1
+            raise ValueError("failed")
+
+        items = prefetch(fail())
+        self.assertEqual(1, next(items))
+        with self.assertRaises(ValueError):
+            next(items)
+
+        # The background thread stops when the consumer stops early
+        items = prefetch(iter(range(100)), max_items=1)
+        self.assertEqual(0, next(items))
+        items.close()
+
+    def test_threaded_row_writer(self):
+        writer = ListWriter()
+        threaded_writer = ThreadedRowWriter(writer)
+        for i in range(10):
+            threaded_writer.write_rows([(i, "a"), (i, "b")])
+        threaded_writer.close()
+        self.assertEqual([(i, letter) for i in range(10) for letter in "ab"], writer.rows)
+        self.assertTrue(writer.closed)
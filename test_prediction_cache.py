@@ -0,0 +1,35 @@
+import os
+import tempfile
+import unittest
+
+from prediction_cache import PredictionCache, compact_cache, fields_key
+
+
+class TestPredictionCache(unittest.TestCase):
+    def test_fields_key(self):
+        fields = ["Title", "", "Abstract", ""]
+        self.assertEqual(fields_key(fields), fields_key(list(fields)))
+        self.assertNotEqual(fields_key(fields), fields_key(["", "Title", "Abstract", ""]))
+
+    def test_cache(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            key = fields_key(["Title", "", "", ""])
+
+            # Predictions are only visible after they have been merged into the cache
+            cache = PredictionCache(tmp, "archive.csv.gz", "lid.176.bin")
+            self.assertIsNone(cache.get("10.1234/ABC", key))
+            cache.put_many([("10.1234/ABC", key, "Title", "en", 0.5), ("10.1234/DEF", key, None, None, None)])
+            cache.close()
+            self.assertEqual(1, compact_cache(tmp, "lid.176.bin"))
+            self.assertEqual([], os.listdir(os.path.join(tmp, "deltas")))
+
+            cache = PredictionCache(tmp, "archive.csv.gz", "lid.176.bin")
+            self.assertEqual(("Title", "en", 0.5), cache.get("10.1234/ABC", key))
+            self.assertEqual((None, None, None), cache.get("10.1234/DEF", key))
+            self.assertIsNone(cache.get("10.1234/ABC", fields_key(["Changed title", "", "", ""])))
+            self.assertEqual((2, 1), (cache.hits, cache.misses))
+            cache.close()
+
+            # A cache built with a different model is not used
+            with self.assertRaises(ValueError):
+                PredictionCache(tmp, "archive.csv.gz", "lid.176.ftz")
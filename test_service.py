@@ -0,0 +1,109 @@
+import asyncio
+import json
+import unittest
+
+from service import LanguageService, MicroBatcher, parse_records, percentile
+from test_classify_batch import FakeEngine
+
+
+class TestService(unittest.TestCase):
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(50, percentile(values, 50))
+        self.assertEqual(99, percentile(values, 99))
+        self.assertEqual(100, percentile(values, 100))
+        self.assertEqual(7, percentile([7], 99))
+        self.assertIsNone(percentile([], 50))
+
+    def test_parse_records(self):
+        self.assertEqual(
+            [["10.1/1", "", "the study", "", ""]], parse_records(b'{"doi": "10.1/1", "crossref_title": "the study"}')
+        )
+        self.assertEqual(
+            [["10.1/1", "", "", "", ""], ["10.1/2", "", "", "", ""]],
+            parse_records(b'{"records": [{"doi": "10.1/1"}, {"doi": "10.1/2"}]}'),
+        )
+        with self.assertRaises(ValueError):
+            parse_records(b'{"records": [1]}')
+        with self.assertRaisesRegex(ValueError, "crossref_title of record 1"):
+            parse_records(b'{"records": [{"doi": "10.1/1"}, {"doi": "10.1/2", "crossref_title": 123}]}')
+
+    def test_micro_batching(self):
+        engine = FakeEngine()
+
+        async def run():
+            batcher = MicroBatcher(engine, max_batch_size=8, max_delay=0.05)
+            task = asyncio.create_task(batcher.run())
+            try:
+                rows = [[f"10.1/{i}", "", "the study" if i % 2 else "die Studie", "", ""] for i in range(20)]
+                outputs = await asyncio.gather(*(batcher.predict([row]) for row in rows))
+            finally:
+                task.cancel()
+            return batcher, outputs
+
+        batcher, outputs = asyncio.run(run())
+
+        # Each request gets its own predictions, and concurrent requests are classified together
+        self.assertEqual([f"10.1/{i}" for i in range(20)], [output[0][0] for output in outputs])
+        self.assertEqual(["de", "en"] * 10, [output[0][2] for output in outputs])
+        self.assertEqual(3, engine.calls)
+        self.assertEqual(3, batcher.stats.counters["batches"])
+        self.assertEqual(20, batcher.stats.counters["batch_records"])
+
+    def test_failed_request(self):
+        engine = FakeEngine()
+
+        async def run():
+            batcher = MicroBatcher(engine, max_batch_size=8, max_delay=0.05)
+            task = asyncio.create_task(batcher.run())
+            try:
+                good = [["10.1/1", "", "the study", "", ""]]
+                bad = [["10.1/2", "", 123, "", ""]]
+                return await asyncio.gather(batcher.predict(good), batcher.predict(bad), return_exceptions=True)
+            finally:
+                task.cancel()
+
+        # A request that can not be classified fails on its own, not the other requests of its batch
+        good, bad = asyncio.run(run())
+        self.assertEqual([("10.1/1", "the study", "en", 1.0)], good)
+        self.assertIsInstance(bad, Exception)
+
+    def test_handle_request(self):
+        async def run():
+            batcher = MicroBatcher(FakeEngine(), max_delay=0)
+            service = LanguageService(batcher)
+            task = asyncio.create_task(batcher.run())
+            try:
+                body = json.dumps({"records": [{"doi": "10.1/1", "crossref_title": "the study"}, {"doi": "10.1/2"}]})
+                return [
+                    await service.handle_request("POST", "/predict", body.encode()),
+                    await service.handle_request("POST", "/predict", b"not json"),
+                    await service.handle_request("POST", "/predict", b'{"doi": "10.1/1", "crossref_title": 123}'),
+                    await service.handle_request("GET", "/predict", b""),
+                    await service.handle_request("GET", "/other", b""),
+                    await service.handle_request("GET", "/metrics", b""),
+                ]
+            finally:
+                task.cancel()
+
+        predict, bad, bad_field, method, missing, metrics = asyncio.run(run())
+        self.assertEqual(
+            (
+                200,
+                {
+                    "predictions": [
+                        {"doi": "10.1/1", "title": "the study", "language": "en", "score": 1.0},
+                        {"doi": "10.1/2", "title": None, "language": None, "score": None},
+                    ]
+                },
+            ),
+            predict,
+        )
+        self.assertEqual([400, 400, 405, 404], [bad[0], bad_field[0], method[0], missing[0]])
+        self.assertEqual(1, metrics[1]["requests"])
+        self.assertEqual(2, metrics[1]["records"])
+        self.assertEqual(1, metrics[1]["empty_rows"])
+
+
+if __name__ == "__main__":
+    unittest.main()
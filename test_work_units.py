@@ -0,0 +1,60 @@
+import csv
+import gzip
+import os
+import tempfile
+import unittest
+
+from predict_language import build_index, plan_work_units, read_csv_gz
+
+
+class TestWorkUnits(unittest.TestCase):
+    def make_archive(self, path: str, num_rows: int):
+        rows = [["doi", "mag_title", "crossref_title", "mag_abstract", "crossref_abstract"]]
+        for i in range(num_rows):
+            # Quoted fields with newlines and escaped quotes span several lines
+            abstract = f'An "abstract"\nwith\n{i} lines' if i % 3 == 0 else ""
+            rows.append([f"10.13003/{i}", f"Title {i}", "", abstract, ""])
+        with gzip.open(path, "wt", newline="") as f:
+            csv.writer(f).writerows(rows)
+        return rows[1:]
+
+    def test_build_index(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            csv_path = os.path.join(tmp, "input.csv.gz")
+            rows = self.make_archive(csv_path, 25)
+            index = build_index(csv_path, interval=10)
+            self.assertEqual(25, index["rows"])
+            self.assertEqual(3, len(index["offsets"]))
+            for i, offset in enumerate(index["offsets"]):
+                self.assertEqual(
+                    rows[i * 10 : i * 10 + 2], list(read_csv_gz(csv_path, start_offset=offset, num_rows=2))
+                )
+
+            # The offset after the last row is not saved
+            self.make_archive(csv_path, 20)
+            self.assertEqual(2, len(build_index(csv_path, interval=10)["offsets"]))
+
+    def test_plan_work_units(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            large_path = os.path.join(tmp, "large.csv.gz")
+            small_path = os.path.join(tmp, "small.csv.gz")
+            rows = self.make_archive(large_path, 95)
+            self.make_archive(small_path, 5)
+            index_path = os.path.join(tmp, "index")
+
+            # Archives are not split by default
+            units = plan_work_units([small_path, large_path], index_path)
+            self.assertEqual([large_path, small_path], [unit.csv_path for unit in units])
+            self.assertEqual([None, None], [unit.part for unit in units])
+
+            # The large archive is split into parts that cover all of its rows, in order
+            max_unit_size = os.path.getsize(large_path) // 3 + 1
+            units = plan_work_units([small_path, large_path], index_path, max_unit_size, interval=10)
+            parts = sorted((unit for unit in units if unit.csv_path == large_path), key=lambda unit: unit.part)
+            self.assertEqual([0, 1, 2], [unit.part for unit in parts])
+            self.assertEqual(95, sum(unit.num_rows for unit in parts))
+            part_rows = []
+            for unit in parts:
+                part_rows.extend(read_csv_gz(large_path, start_offset=unit.start_offset, num_rows=unit.num_rows))
+            self.assertEqual(rows, part_rows)
+            self.assertTrue(os.path.isfile(os.path.join(index_path, "large.csv.gz.json")))